@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from embedding_index import EmbeddingIndex, atomic_write, paths_fingerprint
+
+# IVF 索引目录下的文件
+IVF_CENTROIDS = "centroids.npy"  # (nlist, d) 归一化后的聚类中心
+IVF_OFFSETS = "offsets.npy"      # (nlist + 1,) 每个倒排列表在 vectors 中的起止行
+IVF_IDS = "ids.npy"              # (n,) 重排后每一行对应原矩阵中的行号
+IVF_VECTORS = "vectors.npy"      # (n, d) 按倒排列表重排的向量，同一列表内连续存放
+IVF_META = "meta.json"
+
+DEFAULT_NPROBE = 8
+ASSIGN_CHUNK_ROWS = 65536
+
+
+def spherical_kmeans(data, nlist, n_iter=20, sample_size=None, seed=123):
+    """
+    纯 NumPy 的球面 k-means（向量已归一化，用内积作相似度）。
+    - sample_size: 训练样本上限，大库只用采样训练中心，再整体分配
+    返回归一化后的中心矩阵 (nlist, d)。
+    """
+    rng = np.random.default_rng(seed)
+    n = data.shape[0]
+    nlist = max(1, min(nlist, n))
+    if sample_size and n > sample_size:
+        train = np.asarray(data[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+    else:
+        train = np.asarray(data, dtype=np.float32)
+
+    centroids = train[rng.choice(train.shape[0], nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(train @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, train)
+        counts = np.bincount(assign, minlength=nlist)
+        # 空簇：用随机样本重新初始化
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = train[rng.choice(train.shape[0], len(empty), replace=False)]
+        centroids = EmbeddingIndex.normalize(sums)
+    return centroids
+
+
+def assign_lists(matrix, centroids):
+    """分块计算每一行所属的倒排列表，避免一次性生成 n x nlist 的大矩阵"""
+    n = matrix.shape[0]
+    assign = np.empty(n, dtype=np.int32)
+    for start in range(0, n, ASSIGN_CHUNK_ROWS):
+        block = np.asarray(matrix[start:start + ASSIGN_CHUNK_ROWS], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+class IvfIndex:
+    """
+    IVF（倒排文件）近似最近邻索引：
+      - 离线用 k-means 把向量划分到 nlist 个列表，并按列表重排存储
+      - 查询时只扫描与 query 最相近的 nprobe 个列表
+    nprobe 越大召回越高、越慢；nprobe == nlist 时等价于精确搜索。
+    """
+
+    def __init__(self, base, centroids, offsets, ids, vectors, nprobe=DEFAULT_NPROBE):
+        self.base = base  # EmbeddingIndex，用于 path 映射
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = ids
+        self.vectors = vectors
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, base, nlist=None, n_iter=20, sample_per_list=256, seed=123):
+        """从 EmbeddingIndex 构建 IVF 索引（内存中）"""
+        n = len(base)
+        if nlist is None:
+            nlist = max(1, int(np.sqrt(n)))
+        centroids = spherical_kmeans(base.matrix, nlist, n_iter=n_iter,
+                                     sample_size=nlist * sample_per_list, seed=seed)
+        assign = assign_lists(base.matrix, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=centroids.shape[0])
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        vectors = np.ascontiguousarray(base.matrix[order])
+        return cls(base, centroids, offsets, order.astype(np.int64), vectors)
+
+    def save(self, ivf_dir):
+        os.makedirs(ivf_dir, exist_ok=True)
+        atomic_write(os.path.join(ivf_dir, IVF_CENTROIDS), lambda f: np.save(f, self.centroids))
+        atomic_write(os.path.join(ivf_dir, IVF_OFFSETS), lambda f: np.save(f, self.offsets))
+        atomic_write(os.path.join(ivf_dir, IVF_IDS), lambda f: np.save(f, np.asarray(self.ids)))
+        atomic_write(os.path.join(ivf_dir, IVF_VECTORS), lambda f: np.save(f, np.asarray(self.vectors)))
+        meta = {"n": len(self), "nlist": self.nlist, "paths": paths_fingerprint(self.base.paths)}
+        atomic_write(os.path.join(ivf_dir, IVF_META),
+                      lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    @classmethod
+    def load(cls, base, ivf_dir, nprobe=DEFAULT_NPROBE):
+        """
+        memmap 加载 IVF 索引；与 base 条数或 path 列表（内容与顺序）不一致时视为过期，抛出 ValueError。
+        同样条数的库重新打包后行号可能对应不同的图片，只比条数会把结果映射到错误的 path。
+        """
+        with open(os.path.join(ivf_dir, IVF_META), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["n"] != len(base):
+            raise ValueError(f"IVF 索引已过期: 索引 {meta['n']} 条, 向量库 {len(base)} 条")
+        if meta.get("paths") != paths_fingerprint(base.paths):
+            raise ValueError("IVF 索引已过期: path 列表与向量库不一致，请重新运行 python ann_index.py")
+        return cls(
+            base,
+            np.load(os.path.join(ivf_dir, IVF_CENTROIDS)),
+            np.load(os.path.join(ivf_dir, IVF_OFFSETS)),
+            np.load(os.path.join(ivf_dir, IVF_IDS), mmap_mode="r"),
+            np.load(os.path.join(ivf_dir, IVF_VECTORS), mmap_mode="r"),
+            nprobe=nprobe,
+        )
+
+    def search(self, query, k=4, nprobe=None):
+        """与 EmbeddingIndex.search 相同的返回格式：[(path, sim), ...]"""
+        if len(self) == 0:
+            return []
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        q = EmbeddingIndex.normalize(np.asarray(query, dtype=np.float32).ravel())
+
+        coarse = self.centroids @ q
+        if nprobe < self.nlist:
+            probe = np.argpartition(coarse, -nprobe)[-nprobe:]
+        else:
+            probe = np.arange(self.nlist)
+
+        # 同一列表内的向量连续存放，按切片计算避免 fancy index 拷贝
+        spans = [(self.offsets[c], self.offsets[c + 1]) for c in probe if self.offsets[c + 1] > self.offsets[c]]
+        if not spans:
+            return []
+        scores = np.concatenate([self.vectors[s:e] @ q for s, e in spans])
+        rows = np.concatenate([np.arange(s, e) for s, e in spans])
+
+        k = min(k, len(rows))
+        top = np.argpartition(scores, -k)[-k:] if k < len(rows) else np.arange(len(rows))
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(self.base.paths[int(self.ids[rows[i]])], float(scores[i])) for i in top]
+
+
+def main(argv=None):
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    store_dir = os.path.join(base_dir, "database")
+    parser = argparse.ArgumentParser(description="从打包后的 embedding 库离线构建 IVF 索引")
+    parser.add_argument("--store-dir", default=store_dir)
+    parser.add_argument("--embed-dir", default=os.path.join(store_dir, "embeddings_output"))
+    parser.add_argument("--ivf-dir", default=os.path.join(store_dir, "ivf"))
+    parser.add_argument("--nlist", type=int, default=None, help="倒排列表数，默认 sqrt(n)")
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    base = EmbeddingIndex.load(args.store_dir, args.embed_dir)
+    ivf = IvfIndex.build(base, nlist=args.nlist, n_iter=args.iters)
+    ivf.save(args.ivf_dir)
+    print(f"已构建 IVF 索引: {len(ivf)} 条, nlist={ivf.nlist} -> {args.ivf_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
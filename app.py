@@ -1,11 +1,24 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, Response, g
 import os
+import mimetypes
 import time
-import shutil
-import glob
 import json
+import storage
+import upload_ingest
+import hashlib
+from gallery_index import GalleryIndex
+import thumbnails
+import metrics
+from job_queue import JobQueue
+from blob_pack import BlobArchive
+from werkzeug.security import safe_join
+from werkzeug.wsgi import FileWrapper
+from werkzeug.exceptions import RequestEntityTooLarge
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = upload_ingest.MAX_CONTENT_LENGTH
+# 部署在 nginx / Apache 后面时设置 USE_X_SENDFILE=1，由前端服务器直接发送文件
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
 UPLOAD_FOLDER = 'uploads'
 MOVED_FOLDER = 'moved'
@@ -19,6 +32,38 @@ os.makedirs(XIANGAO_FOLDER, exist_ok=True)
 os.makedirs(BACK_GROUND, exist_ok=True)
 os.makedirs(BACK_GROUND_PERSON, exist_ok=True)
 
+# 冷的 moved 原图由 blob_pack 打包进 archive/ 的段文件，URL 不变，按偏移读取
+ARCHIVE_FOLDER = 'archive'
+archive = BlobArchive(ARCHIVE_FOLDER)
+ARCHIVED_FOLDERS = (MOVED_FOLDER,)
+
+# 各图库目录按用户的文件索引（列表接口分页 / ETag 用），worker 写入时同步更新
+moved_index = GalleryIndex(MOVED_FOLDER, archive=archive)
+xiangao_index = GalleryIndex(XIANGAO_FOLDER)
+background_person_index = GalleryIndex(BACK_GROUND_PERSON)
+MAX_PAGE_SIZE = 500
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # 秒，图库图片的浏览器 / CDN 缓存时间
+
+# 与 ark worker 共享的任务队列：每个上传文件一个任务，携带当时的 metadata 快照
+JOB_DB = 'jobs.sqlite'
+ARK1_QUEUE = 'ark1'  # background/ -> background_person/
+ARK2_QUEUE = 'ark2'  # uploads/ -> xiangao/
+job_queue = JobQueue(JOB_DB)
+# 任务输出目录，进度里的 output 相对这些目录
+JOB_OUTPUT_BASE = {ARK1_QUEUE: BACK_GROUND_PERSON, ARK2_QUEUE: XIANGAO_FOLDER}
+JOB_WAIT_MAX = 30  # 秒，GET /jobs/<id>?wait= 长轮询的最长等待
+JOB_STREAM_MAX = 300  # 秒，单个 SSE 连接的最长时间，到期后客户端带 Last-Event-ID 重连
+JOB_STREAM_HEARTBEAT = 15  # 秒，SSE 心跳，防止代理断开空闲连接
+JOB_POLL_INTERVAL = 0.2  # 秒，服务端检查任务库是否有新提交（PRAGMA data_version，不查表）
+JOB_LIST_WINDOW = 24 * 3600  # 秒，GET /jobs 默认返回最近这么久内有变化的任务
+
+# 指标：本进程的请求 / 上传 / 队列深度，加上 worker 定期写到 METRICS_DIR 的快照，一起由 /metrics 输出
+METRICS_DIR = 'metrics'
+metrics.configure('app')
+metrics.registry.add_collector(lambda: job_queue.metric_rows([ARK1_QUEUE, ARK2_QUEUE]))
+http_requests = metrics.registry.counter('http_requests', 'HTTP 请求数', ('endpoint', 'method', 'status'))
+http_request_seconds = metrics.registry.histogram('http_request_seconds', 'HTTP 请求处理耗时（秒）', ('endpoint',))
+
 
 def get_user_folder(base, user_id):
     folder = os.path.join(base, f"user_{user_id}")
@@ -27,15 +72,199 @@ def get_user_folder(base, user_id):
 
 
 def timestamp_filename(ext):
-    """根据当前时间戳生成文件名"""
-    ts = int(time.time() * 1000)  # 毫秒
-    return f"{ts}{ext}"
+    """根据当前时间戳生成唯一文件名（毫秒时间戳 + 序号 + 进程后缀，同一请求内的多个文件不会重名）"""
+    return storage.new_filename(ext)
+
+
+def gallery_listing(index, base, user_id):
+    """
+    用户图库列表：按文件名倒序的 URL 列表。
+    - ?limit=&after= 游标分页，下一页游标放在 X-Next-Cursor 响应头（没有更多时不返回）
+    - ETag 由索引 generation 与分页参数生成，If-None-Match 命中时返回 304
+    """
+    user_folder = os.path.basename(get_user_folder(base, user_id))
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    after = request.args.get('after')
+
+    generation = index.sync(user_folder)
+    etag = hashlib.sha1(f"{generation}:{limit}:{after}".encode("utf-8")).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        names, next_cursor = index.page(user_folder, limit=limit, after=after)
+        resp = jsonify([f"/{base}/{user_folder}/{name}" for name in names])
+        if next_cursor is not None:
+            resp.headers['X-Next-Cursor'] = next_cursor
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def send_immutable(path, mimetype=None):
+    """
+    图库文件名带时间戳、写入后不再修改：长期缓存（immutable）+ 内容哈希 ETag（写入时记在 xattr 里），
+    If-None-Match 命中返回 304，支持 Range 断点续传；文件体交给 WSGI 服务器的 file_wrapper（sendfile）发送。
+    """
+    try:
+        etag = storage.file_sha256(path)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return jsonify({'error': 'File not found'}), 404
+    if request.if_none_match.contains(etag):
+        # 重新验证命中：不打开文件，直接 304
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = IMMUTABLE_MAX_AGE
+    else:
+        resp = send_file(os.path.abspath(path), mimetype=mimetype, etag=etag, conditional=True, max_age=IMMUTABLE_MAX_AGE)
+    resp.cache_control.immutable = True
+    return resp
+
+
+def send_gallery_file(base, user_folder, filename):
+    """
+    发送图库文件；带 ?w= 时发送缓存的缩略图（首次请求时生成，存于原图目录的 .thumbs/ 下），
+    ?fmt= 可选 webp（默认）/ jpeg / png。
+    """
+    # URL 里只有文件名，实际位于分片目录（或尚未迁移的平铺位置）
+    src = safe_join(base, user_folder, filename)
+    if src is None:
+        return jsonify({'error': 'File not found'}), 404
+    found = storage.find_path(os.path.dirname(src), os.path.basename(src))
+    if found is None and base in ARCHIVED_FOLDERS and archive.locate(base, user_folder, filename):
+        return send_archived(base, user_folder, filename)
+    src = found or src
+    if 'w' in request.args:
+        width = thumbnails.snap_width(request.args.get('w'))
+        fmt = request.args.get('fmt', thumbnails.DEFAULT_FORMAT)
+        if width is None or fmt not in thumbnails.FORMATS:
+            return jsonify({'error': 'invalid w or fmt'}), 400
+        try:
+            thumb = thumbnails.get_derivative(src, width, fmt)
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return jsonify({'error': 'File not found'}), 404
+        except OSError:
+            return jsonify({'error': 'not an image'}), 415
+        if thumb:
+            return send_immutable(thumb, mimetype=thumbnails.FORMATS[fmt][1])
+    return send_immutable(src)
+
+
+def send_archived(base, user_folder, filename):
+    """
+    发送已归档进段文件的原图：ETag 为内容哈希，支持 If-None-Match / Range；
+    ?w= 缩略图仍缓存在原图所在分片目录的 .thumbs/ 下（按内容哈希区分版本）。
+    """
+    row = archive.locate(base, user_folder, filename)
+    if row is None:
+        return jsonify({'error': 'File not found'}), 404
+    etag = row[3]
+    if 'w' in request.args:
+        width = thumbnails.snap_width(request.args.get('w'))
+        fmt = request.args.get('fmt', thumbnails.DEFAULT_FORMAT)
+        if width is None or fmt not in thumbnails.FORMATS:
+            return jsonify({'error': 'invalid w or fmt'}), 400
+
+        def load():
+            data = archive.read_bytes(base, user_folder, filename)
+            if data is None:
+                raise FileNotFoundError(filename)
+            return data
+
+        user_dir = os.path.join(base, user_folder)
+        src = os.path.join(user_dir, storage.shard_of(filename), filename)
+        try:
+            thumb = thumbnails.get_blob_derivative(src, etag, load, width, fmt)
+        except FileNotFoundError:
+            return jsonify({'error': 'File not found'}), 404
+        except OSError:
+            return jsonify({'error': 'not an image'}), 415
+        if thumb:
+            return send_immutable(thumb, mimetype=thumbnails.FORMATS[fmt][1])
+
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        opened = archive.open(base, user_folder, filename)
+        if opened is None:
+            return jsonify({'error': 'File not found'}), 404
+        reader, size, etag, mtime = opened
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        resp = app.response_class(FileWrapper(reader), mimetype=mimetype, direct_passthrough=True)
+        resp.content_length = size
+        resp.last_modified = mtime
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = IMMUTABLE_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp.make_conditional(request, accept_ranges=True, complete_length=row[2])
+
+
+def metadata_user_id(fields):
+    """从 metadata 字段里取 user_id，解析失败返回 None（由路由返回 400）"""
+    try:
+        return json.loads(fields.get('metadata', '')).get("user_id")
+    except Exception:
+        return None
+
+
+def user_folder_or_none(base, user_id):
+    return get_user_folder(base, user_id) if user_id else None
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # 按路由模板统计（/xiangao/<user_folder>/<path:filename>），不按具体 URL，标签数量有限
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    start = g.get('request_start')
+    if start is not None:
+        http_request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式：app 自身指标 + 各 worker 的最新快照"""
+    body = metrics.render(metrics.registry.collect(), *metrics.read_snapshots(METRICS_DIR))
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.errorhandler(upload_ingest.IngestError)
+def ingest_error(e):
+    resp = jsonify({'error': e.message})
+    resp.status_code = e.status
+    if e.status == 503:
+        resp.headers['Retry-After'] = str(upload_ingest.RETRY_AFTER)
+    return resp
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({'error': 'request body too large'}), 413
 
 #保存到background文件夹
 @app.route('/background', methods=['POST'])
 def background():
+    # 文件边接收边写入用户的 background 目录（metadata 字段先于文件到达）
+    with upload_ingest.StreamingForm(
+        request,
+        resolve_dir=lambda fields: user_folder_or_none(BACK_GROUND, metadata_user_id(fields)),
+        user_of=metadata_user_id,
+    ) as form:
+        return save_background(form)
+
+
+def save_background(form):
     # 1. metadata 解析
-    metadata_str = request.form.get('metadata')
+    metadata_str = form.fields.get('metadata')
     if not metadata_str:
         return jsonify({'error': 'metadata required'}), 400
 
@@ -50,6 +279,7 @@ def background():
     user_background_folder = get_user_folder(BACK_GROUND, user_id)
     # 3. 处理文件上传
     saved = []
+    jobs = []  # 任务 id，客户端用 /jobs/<id> 或 /jobs/stream 获取进度
     flag = metadata.get("flag")
     if not flag:
         return jsonify({'error': 'flag required in metadata'}), 400
@@ -57,16 +287,17 @@ def background():
       background_files = []
       user_background_person_folder = get_user_folder(BACK_GROUND_PERSON, user_id)
       os.makedirs(user_background_person_folder, exist_ok=True)
-      filenames = request.form.getlist('filenames') 
+      filenames = form.fields.getlist('filenames') 
       if not user_id or not filenames:
           return jsonify({'error': 'user_id and filenames required'}), 400
       for fname in filenames:
-        src = os.path.join(user_background_person_folder, fname)
-        if not os.path.exists(src):
+        src = storage.find_path(user_background_person_folder, fname)
+        if src is None:
             continue
         # 保存到 uploads
-        dest_background = os.path.join(user_background_folder, fname)
-        shutil.copy(src, dest_background)
+        dest_background = storage.placed_path(user_background_folder, fname)
+        storage.link_or_copy(src, dest_background)
+        jobs.append(job_queue.enqueue(ARK1_QUEUE, os.path.relpath(dest_background, BACK_GROUND), metadata))
         saved.append(f"user_{user_id}/{fname}")
       # 2. 保存 metadata.json
       metadata_path = os.path.join(user_background_folder, "metadata.json")
@@ -74,34 +305,39 @@ def background():
           json.dump(metadata, f, ensure_ascii=False, indent=2)
       return jsonify({
         'saved': saved,
+        'jobs': jobs,
         'metadata_file': metadata_path
     }), 200
 
-    files = request.files.getlist('files')
-    
+    # 2. 保存 metadata.json（任务本身带 metadata 快照；这份供兜底入队的文件使用）
+    metadata_path = os.path.join(user_background_folder, "metadata.json")
+    with open(metadata_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
 
-    for f in files:
+    hashes = []
+    for f in form.files:
         if f.filename == '':
             continue
         ext = os.path.splitext(f.filename)[1].lower()
         new_filename = timestamp_filename(ext)
 
-        background_path = os.path.join(user_background_folder, new_filename)
-        f.save(background_path)
+        background_path = storage.placed_path(user_background_folder, new_filename)
+        f.commit(background_path)
+        jobs.append(job_queue.enqueue(ARK1_QUEUE, os.path.relpath(background_path, BACK_GROUND), metadata))
         saved.append(background_path)
-          # 2. 保存 metadata.json
-    metadata_path = os.path.join(user_background_folder, "metadata.json")
-    with open(metadata_path, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=2)
+        hashes.append(f.sha256)
     return jsonify({
         'saved': saved,
+        'sha256': hashes,
+        'jobs': jobs,
         'metadata_file': metadata_path
     }), 200
 
 @app.route('/transfer_background', methods=['POST'])
 def transfer_background():
     """
-    将选中的 background_person 图片复制到 uploads 和 moved 文件夹，然后删除 background_person
+    将选中的 background_person 图片放到 uploads 和 moved 文件夹，然后删除 background_person
+    （硬链接 + rename，不复制文件数据）
     """
     user_id = request.form.get('user_id')
     filenames = request.form.getlist('filenames')  # 多选文件名列表
@@ -112,6 +348,7 @@ def transfer_background():
     uploaded_files = []
     moved_files = []
     deleted_files = []
+    jobs = []
 
     user_background_folder = get_user_folder(BACK_GROUND_PERSON, user_id)
     user_upload_folder = get_user_folder(UPLOAD_FOLDER, user_id)
@@ -121,26 +358,30 @@ def transfer_background():
     os.makedirs(user_moved_folder, exist_ok=True)
 
     for fname in filenames:
-        src = os.path.join(user_background_folder, fname)
-        if not os.path.exists(src):
+        src = storage.find_path(user_background_folder, fname)
+        if src is None:
             continue
 
-        # 保存到 uploads
-        dest_upload = os.path.join(user_upload_folder, fname)
-        shutil.copy(src, dest_upload)
-        uploaded_files.append(f"user_{user_id}/{fname}")
-
-        # 保存到 moved
-        dest_moved = os.path.join(user_moved_folder, fname)
-        shutil.copy(src, dest_moved)
+        # 先链接到 moved，再把原文件 rename 到 uploads（worker 看到它时 moved 已就绪）
+        dest_moved = storage.placed_path(user_moved_folder, fname)
+        storage.link_or_copy(src, dest_moved)
+        moved_index.add_path(dest_moved)
         moved_files.append(f"user_{user_id}/{fname}")
 
-    # 查找图片文件
-    pattern = os.path.join(user_background_folder, '*')
-    files = glob.glob(pattern)
-    for f in files:
+        dest_upload = storage.placed_path(user_upload_folder, fname)
+        storage.move(src, dest_upload)
+        jobs.append(job_queue.enqueue(ARK2_QUEUE, os.path.relpath(dest_upload, UPLOAD_FOLDER)))
+        background_person_index.remove_path(src)
+        thumbnails.remove_derivatives(src)
+        uploaded_files.append(f"user_{user_id}/{fname}")
+        deleted_files.append(fname)
+
+    # 清空该用户的 background_person（各分片目录）
+    for _, f in storage.scan_user_dir(user_background_folder):
       try:
           os.remove(f)
+          background_person_index.remove_path(f)
+          thumbnails.remove_derivatives(f)
           deleted_files.append(os.path.basename(f))
       except Exception as e:
           print(f"Failed to delete {f}: {e}")
@@ -148,39 +389,45 @@ def transfer_background():
     return jsonify({
         'uploaded': uploaded_files,
         'moved': moved_files,
-        'deleted': deleted_files
+        'deleted': deleted_files,
+        'jobs': jobs
     }), 200
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    user_id = request.form.get('user_id')
-    if not user_id:
-        return jsonify({'error': 'user_id required'}), 400
-
-    files = request.files.getlist('files')
-    saved = []
-
-    user_upload_folder = get_user_folder(UPLOAD_FOLDER, user_id)
-    user_moved_folder = get_user_folder(MOVED_FOLDER, user_id)
-
-    for f in files:
-        if f.filename == '':
-            continue
-        ext = os.path.splitext(f.filename)[1].lower()  # 保留原扩展名
-        new_filename = timestamp_filename(ext)
-
-        upload_path = os.path.join(user_upload_folder, new_filename)
-        f.save(upload_path)
-        saved.append(upload_path)
-
-        # 移动到 moved
-        moved_path = os.path.join(user_moved_folder, new_filename)
-        if os.name == 'nt':
-            os.system(f'copy "{upload_path}" "{moved_path}"')
-        else:
-            os.system(f'cp "{upload_path}" "{moved_path}"')
-
-    return jsonify({'saved': saved}), 200
+    # 文件边接收边写入用户的 uploads 目录（user_id 字段先于文件到达），边写边算 sha256
+    with upload_ingest.StreamingForm(
+        request,
+        resolve_dir=lambda fields: user_folder_or_none(UPLOAD_FOLDER, fields.get('user_id')),
+        user_of=lambda fields: fields.get('user_id'),
+    ) as form:
+        user_id = form.fields.get('user_id')
+        if not user_id:
+            return jsonify({'error': 'user_id required'}), 400
+
+        saved = []
+        hashes = []
+        jobs = []
+
+        user_upload_folder = get_user_folder(UPLOAD_FOLDER, user_id)
+        user_moved_folder = get_user_folder(MOVED_FOLDER, user_id)
+
+        for f in form.files:
+            if f.filename == '':
+                continue
+            ext = os.path.splitext(f.filename)[1].lower()  # 保留原扩展名
+            new_filename = timestamp_filename(ext)
+
+            upload_path = storage.placed_path(user_upload_folder, new_filename)
+            moved_path = storage.placed_path(user_moved_folder, new_filename)
+            # 数据只写一次，moved 为硬链接；最后 rename 到 uploads，worker 不会读到写了一半的文件
+            f.commit(upload_path, extra_paths=[moved_path])
+            jobs.append(job_queue.enqueue(ARK2_QUEUE, os.path.relpath(upload_path, UPLOAD_FOLDER)))
+            moved_index.add_path(moved_path)
+            saved.append(upload_path)
+            hashes.append(f.sha256)
+
+    return jsonify({'saved': saved, 'sha256': hashes, 'jobs': jobs}), 200
 
 @app.route('/background_person', methods=['GET'])
 def list_background_person():
@@ -188,14 +435,7 @@ def list_background_person():
     if not user_id:
         return jsonify({'error': 'user_id required'}), 400
 
-    files_list = []
-    user_folder = get_user_folder(BACK_GROUND_PERSON, user_id)
-
-    for fname in os.listdir(user_folder):
-        if fname.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-            files_list.append(f"/background_person/user_{user_id}/{fname}")
-
-    return jsonify(sorted(files_list, reverse=True)), 200  # 倒序返回
+    return gallery_listing(background_person_index, BACK_GROUND_PERSON, user_id)  # 倒序返回
 
 @app.route('/moved', methods=['GET'])
 def list_moved():
@@ -203,13 +443,7 @@ def list_moved():
     if not user_id:
         return jsonify({'error': 'user_id required'}), 400
 
-    moved_files = []
-    user_moved_folder = get_user_folder(MOVED_FOLDER, user_id)
-    for fname in os.listdir(user_moved_folder):
-        if fname.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-            moved_files.append(f"/moved/user_{user_id}/{fname}")
-
-    return jsonify(sorted(moved_files, reverse=True)), 200  # 倒序返回
+    return gallery_listing(moved_index, MOVED_FOLDER, user_id)  # 倒序返回
 
 
 @app.route('/xiangao', methods=['GET'])
@@ -218,23 +452,17 @@ def list_xiangao():
     if not user_id:
         return jsonify({'error': 'user_id required'}), 400
 
-    xiangao_files = []
-    user_xiangao_folder = get_user_folder(XIANGAO_FOLDER, user_id)
-    for fname in os.listdir(user_xiangao_folder):
-        if fname.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-            xiangao_files.append(f"/xiangao/user_{user_id}/{fname}")
-
-    return jsonify(sorted(xiangao_files, reverse=True)), 200  # 倒序返回
+    return gallery_listing(xiangao_index, XIANGAO_FOLDER, user_id)  # 倒序返回
 
 
 @app.route('/moved/<user_folder>/<path:filename>', methods=['GET'])
 def get_moved_file(user_folder, filename):
-    return send_from_directory(os.path.join(MOVED_FOLDER, user_folder), filename)
+    return send_gallery_file(MOVED_FOLDER, user_folder, filename)
 
 
 @app.route('/xiangao/<user_folder>/<path:filename>', methods=['GET'])
 def get_xiangao_file(user_folder, filename):
-    return send_from_directory(os.path.join(XIANGAO_FOLDER, user_folder), filename)
+    return send_gallery_file(XIANGAO_FOLDER, user_folder, filename)
 
 @app.route('/background_person/<user_folder>/<path:filename>', methods=['GET'])
 def get_background_person_file(user_folder, filename):
@@ -242,10 +470,7 @@ def get_background_person_file(user_folder, filename):
     通过 URL 获取 background_person 文件夹下指定用户的某个文件
     示例 URL: /background_person/user_123/img1.png
     """
-    directory = os.path.join(BACK_GROUND_PERSON, user_folder)
-    if not os.path.exists(os.path.join(directory, filename)):
-        return jsonify({'error': 'File not found'}), 404
-    return send_from_directory(directory, filename)
+    return send_gallery_file(BACK_GROUND_PERSON, user_folder, filename)
 
 @app.route('/delete', methods=['POST'])
 def delete_files():
@@ -259,9 +484,16 @@ def delete_files():
 
     # moved 文件名保持原后缀
     user_moved_folder = get_user_folder(MOVED_FOLDER, user_id)
-    moved_path = os.path.join(user_moved_folder, filename)
-    if os.path.exists(moved_path):
+    moved_path = storage.find_path(user_moved_folder, filename)
+    if moved_path:
         os.remove(moved_path)
+        moved_index.remove_path(moved_path)
+        thumbnails.remove_derivatives(moved_path)
+        deleted.append(f"moved/{filename}")
+    elif archive.delete(MOVED_FOLDER, os.path.basename(user_moved_folder), filename):
+        # 已归档：只删索引行，段文件空间由 blob_pack 压缩回收
+        moved_index.remove(os.path.basename(user_moved_folder), filename)
+        thumbnails.remove_derivatives(os.path.join(user_moved_folder, storage.shard_of(filename), filename))
         deleted.append(f"moved/{filename}")
 
     # xiangao 文件统一后缀 .png
@@ -269,9 +501,11 @@ def delete_files():
     xiangao_filename = f"{name_no_ext}.png"
 
     user_xiangao_folder = get_user_folder(XIANGAO_FOLDER, user_id)
-    xiangao_path = os.path.join(user_xiangao_folder, xiangao_filename)
-    if os.path.exists(xiangao_path):
+    xiangao_path = storage.find_path(user_xiangao_folder, xiangao_filename)
+    if xiangao_path:
         os.remove(xiangao_path)
+        xiangao_index.remove_path(xiangao_path)
+        thumbnails.remove_derivatives(xiangao_path)
         deleted.append(f"xiangao/{xiangao_filename}")
 
     return jsonify({'deleted': deleted}), 200
@@ -287,14 +521,13 @@ def delete_background_person():
 
     user_folder = get_user_folder(BACK_GROUND_PERSON, user_id)
 
-    # 查找图片文件
-    pattern = os.path.join(user_folder, '*')
-    files = glob.glob(pattern)
     deleted_files = []
 
-    for f in files:
+    for _, f in storage.scan_user_dir(user_folder):
         try:
             os.remove(f)
+            background_person_index.remove_path(f)
+            thumbnails.remove_derivatives(f)
             deleted_files.append(os.path.basename(f))
         except Exception as e:
             print(f"Failed to delete {f}: {e}")
@@ -305,5 +538,123 @@ def delete_background_person():
     }), 200
 
 
+def job_view(job):
+    """任务状态的对外表示：各版本进度附上可直接访问的图片 URL"""
+    base = JOB_OUTPUT_BASE.get(job['queue'])
+    progress = []
+    for p in job['progress']:
+        item = {'version': p['version'], 'state': p['state']}
+        if p['output'] and base:
+            # output 为 user_x/分片/文件名，URL 不含分片（与列表接口一致）
+            parts = p['output'].split(os.sep)
+            item['url'] = f"/{base}/{parts[0]}/{parts[-1]}"
+        if p['error']:
+            item['error'] = p['error']
+        progress.append(item)
+    return {
+        'id': job['id'],
+        'queue': job['queue'],
+        'file': job['path'].replace(os.sep, '/'),
+        'state': job['state'],  # queued / running / done / failed
+        'attempts': job['attempts'],
+        'error': job['error'],
+        'progress': progress,
+        'updated_at': job['updated_at'],
+        'seq': job['seq'],  # 变化序号，长轮询 / SSE 的游标
+    }
+
+
+def wait_for_change(version, deadline):
+    """
+    阻塞到任务库相对 version（查询前读取的 data_version）有新的提交（来自 worker 或其他请求）
+    或到达 deadline，返回是否有变化
+    """
+    while True:
+        if job_queue.data_version() != version:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(JOB_POLL_INTERVAL)
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    任务状态与各版本进度。长轮询：?wait=秒&since=上次返回的 seq，
+    任务有新变化（某个版本完成 / 状态改变）时立即返回，否则最多等 wait 秒后返回当前状态。
+    """
+    wait = min(request.args.get('wait', 0, type=float), JOB_WAIT_MAX)
+    since = request.args.get('since', type=int)
+    deadline = time.monotonic() + wait
+    while True:
+        version = job_queue.data_version()
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'job not found'}), 404
+        if since is None or job['seq'] > since or job['state'] in ('done', 'failed'):
+            break
+        if not wait_for_change(version, deadline):
+            break
+    return jsonify(job_view(job))
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    用户最近有变化的任务：默认 JOB_LIST_WINDOW 内（?since= 为时间戳时改为该时间之后），
+    ?after= 为上次返回的最大 seq 时只返回之后有变化的
+    """
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'user_id required'}), 400
+    after = request.args.get('after', 0, type=int)
+    since = request.args.get('since', time.time() - JOB_LIST_WINDOW, type=float)
+    jobs = job_queue.group_jobs(f"user_{user_id}", after=after, updated_since=None if after else since,
+                                limit=MAX_PAGE_SIZE)
+    return jsonify([job_view(job) for job in jobs])
+
+
+@app.route('/jobs/stream', methods=['GET'])
+def job_stream():
+    """
+    Server-Sent Events：推送该用户任务的每一次变化（event: job，data 同 /jobs/<id>），
+    取代客户端反复请求 /background_person 列表。事件 id 为任务的 seq（写事务内分配的递增变化序号，
+    不依赖各进程的时钟），断线重连时浏览器自动带上 Last-Event-ID，从断点继续；
+    首次连接（或 ?after= 给出 GET /jobs 返回的最大 seq）只推送之后的变化，当前状态先用 GET /jobs 获取。
+    """
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'user_id required'}), 400
+    group = f"user_{user_id}"
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('after')
+    if cursor is None or not cursor.isdigit():
+        # 首次连接；旧版本以 updated_at 为事件 id，重连时从当前位置开始
+        cursor = job_queue.current_seq()
+    after = int(cursor)
+
+    def events(cursor):
+        yield f"retry: {int(JOB_POLL_INTERVAL * 5000)}\n\n"
+        deadline = time.monotonic() + JOB_STREAM_MAX
+        heartbeat = time.monotonic() + JOB_STREAM_HEARTBEAT
+        changed = True
+        while time.monotonic() < deadline:
+            version = job_queue.data_version()
+            if changed:
+                for job in job_queue.group_jobs(group, after=cursor, limit=MAX_PAGE_SIZE):
+                    cursor = job['seq']
+                    data = json.dumps(job_view(job), ensure_ascii=False)
+                    yield f"id: {cursor}\nevent: job\ndata: {data}\n\n"
+                heartbeat = time.monotonic() + JOB_STREAM_HEARTBEAT
+            elif time.monotonic() >= heartbeat:
+                yield ": keep-alive\n\n"
+                heartbeat = time.monotonic() + JOB_STREAM_HEARTBEAT
+            changed = wait_for_change(version, min(deadline, heartbeat))
+
+    return Response(events(after), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # nginx 不缓冲，事件立即送达
+    })
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8001, debug=True)
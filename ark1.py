@@ -1,24 +1,62 @@
 import os
 import time
-import base64
+import socket
+import threading
 import datetime
 import shutil
-import tempfile
-import requests
 from PIL import Image
 import concurrent.futures
+import contextlib
+import collections
 from volcenginesdkarkruntime import Ark
 import json
-import numpy as np
-from pathlib import Path
+from embedding_index import EmbeddingIndex
+from descriptors import DescriptorIndex, describe, asset_path
+from ann_index import IvfIndex
+from upload_watcher import UploadWatcher
+from job_scheduler import FairScheduler, KeyLimiter
+from ark_async import AsyncGenerator, describe_error
+from ark_pool import KeyPool
+from image_cache import PreparedImageCache
+from result_cache import ResultCache
+import phash
+from phash import NearDupIndex, embedding_scope
+from storage import file_sha256, link_or_copy
+from gallery_index import GalleryIndex
+import thumbnails
+from job_queue import JobQueue, adopt_orphans, group_of_path
+import metrics
 
 # 配置项
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "background")
 XIANGAO_DIR = os.path.join(BASE_DIR, "background_person")
 MOVED_DIR = os.path.join(BASE_DIR, "moved_background")
-POLL_INTERVAL = 3  # 秒，轮询间隔
+EMBED_STORE_DIR = os.path.join(BASE_DIR, "database")  # 打包后的 embeddings.npy 所在目录
+EMBED_DIR = os.path.join(EMBED_STORE_DIR, "embeddings_output")
+IVF_DIR = os.path.join(EMBED_STORE_DIR, "ivf")  # python ann_index.py 离线构建
+ANN_MIN_SIZE = 50000  # 向量库条数达到该值且存在 IVF 索引时改用近似检索
+ANN_NPROBE = 8  # 每次查询扫描的倒排列表数，越大召回越高
+# tuijian 的查询 embedding：缩小后再上传（与 convert.py 的 EMBED_MAX_SIZE / EMBED_QUALITY 保持一致，库内向量与查询向量才可比）。
+# 修改后须先用 convert.py --embed 按新尺寸重新计算图库，库的尺寸（embeddings_meta.json）与这里不一致时只用本地描述子回答
+EMBED_MAX_SIZE = 1024
+EMBED_QUALITY = 85
+EMBED_DEADLINE = 10  # 秒，远端 embedding 超过这么久未返回时先用本地描述子的结果回答（远端结果返回后仍写入缓存）
+EMBED_WORKERS = 4
+LOCAL_MATCH_THRESHOLD = 0.99  # 本地描述子相似度达到该值视为图库里的同一张图，直接用它的 embedding
+POLL_INTERVAL = 3  # 秒，轮询回退间隔 / 失败重试间隔
 ALLOWED_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff"}
+MAX_CONCURRENT_JOBS = 32  # 同时处理的上传文件数（生成请求在事件循环中等待，不额外占线程）
+MAX_JOBS_PER_USER = 2  # 单个 user_* 目录同时处理的文件数，避免一个用户占满所有 worker
+KEY_MAX_CONCURRENCY = 2  # 每个 API key 同时在途的请求数
+KEY_REQUESTS_PER_MINUTE = 60  # 每个 API key 的限速，None 表示不限速
+JOB_DB = os.path.join(BASE_DIR, "jobs.sqlite")  # 与 app.py 共享的任务队列
+JOB_QUEUE = "ark1"
+JOB_LEASE_SECONDS = 180  # 任务租约（执行期间定期续约），worker 崩溃后最多这么久任务会被重新领取
+QUEUE_POLL_INTERVAL = 0.5  # 秒，队列为空 / worker 已满时的检查间隔
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+METRICS_DIR = os.path.join(BASE_DIR, "metrics")  # 指标快照目录，app 的 /metrics 读取
+SPAN_LOG = os.path.join(BASE_DIR, "logs", "ark1.spans.jsonl")  # 每个处理阶段一行 JSON
 
 # ARK / 模型 配置
 API_KEYS = [
@@ -35,7 +73,7 @@ ARK_API_KEY_V = os.environ.get("ARK_API_KEY_V")
 if not ARK_API_KEY_V:
     raise RuntimeError("请先在环境变量 ARK_API_KEY_V 中设置 API key for embedding")
 
-ARK_BASE_URL = "https://ark.cn-beijing.volces.com/api/v3"
+ARK_BASE_URL = os.environ.get("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
 MODEL = "doubao-seededit-3-0-i2i-250628"
 PROMPTS = [
     ("作为AI图像生成模型，当我上传一张不含人物的风景照片时，请在图像中自然融入逼真的人物。人物应呈现出仿佛正在此地进行专业摄影的姿态，动作优雅且符合网红或时尚摄影的风格。确保人物的服装、造型和配饰与背景的场景、气候及氛围高度协调，呈现出和谐的整体效果。人物需与背景在光影、透视和比例上完美融合，仅添加人物，不更改原有风景。人物的详细信息如下："),
@@ -55,115 +93,315 @@ SEEDS = [123, 123, 123, 123]  # 不同的 seed 值
 GUIDANCE_SCALE = 5.5
 SIZE = "adaptive"
 WATERMARK = True
-
-# 初始化多个客户端（每个 API key 一个客户端）
-ark_clients = [Ark(base_url=ARK_BASE_URL, api_key=key) for key in API_KEYS]
-ark_client_v = Ark(api_key=ARK_API_KEY_V)
-
-def image_to_base64(image_path):
-    """Convert an image file to base64 string."""
-    try:
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            # Determine MIME type based on file extension
-            ext = Path(image_path).suffix.lower()
-            mime_types = {
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.png': 'image/png',
-                '.bmp': 'image/bmp',
-                '.gif': 'image/gif'
-            }
-            mime_type = mime_types.get(ext, 'image/jpeg')
-            return f"data:{mime_type};base64,{encoded_string}"
-    except Exception as e:
-        print(f"Error converting {image_path} to base64: {str(e)}")
-        return None
-
-def generate_embedding(image_path, client):
+GENERATE_TIMEOUT = 60  # 秒，四个版本的总等待时间，超时未完成的请求会被取消
+HEDGE_AFTER = 25  # 秒，单个请求这么久仍未完成时在另一把 key 上对冲一次，None 表示不对冲
+LATENCY_WINDOW = 200  # 记录最近多少个任务的首个版本 / 全部版本耗时
+
+# 生成请求走 asyncio 管线：每个 API key 一个 AsyncArk 客户端，所有任务共享，按 key 限制并发与速率
+generator = AsyncGenerator(
+    ARK_BASE_URL, API_KEYS, MODEL,
+    guidance_scale=GUIDANCE_SCALE, size=SIZE, watermark=WATERMARK,
+    key_max_concurrency=KEY_MAX_CONCURRENCY, key_requests_per_minute=KEY_REQUESTS_PER_MINUTE,
+    hedge_after=HEDGE_AFTER,
+)
+# embedding 走同样的健康跟踪与换 key 重试（重试交给 pool，SDK 自身不重试）
+ark_client_v = Ark(base_url=os.environ.get("ARK_BASE_URL_V", ARK_BASE_URL), api_key=ARK_API_KEY_V, max_retries=0)
+embedding_pool = KeyPool([ARK_API_KEY_V], name="embedding")
+
+# 上传图片的预处理结果缓存：四个生成版本与 embedding 共用同一份 JPEG/base64
+PREPROCESS_CACHE_BYTES = 64 * 1024 * 1024
+preprocess_cache = PreparedImageCache(PREPROCESS_CACHE_BYTES)
+
+# 生成结果缓存：同一张图 + 同一 prompt/seed/模型 重复提交时直接硬链接已有结果，不再调用 ARK
+RESULT_CACHE_DIR = os.path.join(BASE_DIR, "result_cache", "ark1")
+RESULT_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES)
+
+# 感知哈希近重复索引（与 ark2 共用）：同一用户近期传过几乎相同的图（连拍、同一景点）时复用那张图的生成结果，
+# tuijian 在全局范围内复用已算过的 embedding，不再调用远端接口
+NEAR_DUP_DB = os.path.join(BASE_DIR, "phash.sqlite")
+near_dups = NearDupIndex(NEAR_DUP_DB)
+
+job_queue = JobQueue(JOB_DB)
+
+# background_person 的列表索引（app 的 /background_person 接口读取），写出结果后即时更新
+gallery = GalleryIndex(XIANGAO_DIR)
+
+# 首个版本与全部版本完成耗时分开统计（首个版本决定用户多久能看到结果）
+variant_latency = {"first": collections.deque(maxlen=LATENCY_WINDOW), "all": collections.deque(maxlen=LATENCY_WINDOW)}
+variant_seconds = metrics.registry.histogram("variant_seconds", "首个 / 全部版本生成完成耗时（秒）", ("which",))
+variants_total = metrics.registry.counter("variants", "生成版本数", ("outcome",))
+jobs_total = metrics.registry.counter("jobs", "处理的任务数", ("queue", "flag", "outcome"))
+# tuijian 由哪一层给出结果：cache（内容哈希）/ near（感知哈希近重复）/ local（描述子明显匹配）/ remote / local_fallback（远端失败或超时）
+tuijian_answers = metrics.registry.counter("tuijian_answers", "tuijian 各层回答的请求数", ("tier",))
+near_dup_lookups = metrics.registry.counter("near_dup_lookups", "近重复查询次数", ("kind", "outcome"))
+
+NO_LIMIT = contextlib.nullcontext()
+key_limiter_v = KeyLimiter(KEY_MAX_CONCURRENCY, KEY_REQUESTS_PER_MINUTE)
+
+def generate_embedding(image_path, client, limiter=None, pool=None):
     """Generate embedding for a single image using base64 encoding."""
     try:
-        base64_image = image_to_base64(image_path)
-        if not base64_image:
-            return None
-            
-        resp = client.multimodal_embeddings.create(
-            model="doubao-embedding-vision-250615",
-            encoding_format="float",
-            input=[
-                {"text": "Image embedding", "type": "text"},
-                {"image_url": {"url": base64_image}, "type": "image_url"}
-            ]
-        )
+        # 与生成请求共用预处理缓存，不再单独读取并编码原图
+        base64_image = "data:image/jpeg;base64," + prepare_image_base64(image_path, max_size=EMBED_MAX_SIZE, quality=EMBED_QUALITY)
+
+        def create(key_index):
+            with limiter or NO_LIMIT:
+                return client.multimodal_embeddings.create(
+                    model="doubao-embedding-vision-250615",
+                    encoding_format="float",
+                    input=[
+                        {"text": "Image embedding", "type": "text"},
+                        {"image_url": {"url": base64_image}, "type": "image_url"}
+                    ]
+                )
+
+        resp = pool.call(create) if pool else create(0)
         return resp.data.embedding
     except Exception as e:
         print(f"Error processing {image_path}: {str(e)}")
         return None
 
-def load_all_embeddings(embed_dir):
-    """Load all embeddings from JSON files in the directory."""
-    embeddings = []
-    for filename in os.listdir(embed_dir):
-        if filename.endswith(".json"):
-            file_path = os.path.join(embed_dir, filename)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                embeddings.append((data["path"], data["embedding"]))
-    return embeddings
+_embedding_index = None
+_descriptor_index = None
+embed_executor = concurrent.futures.ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
+
+def get_embedding_index():
+    """返回常驻内存的 embedding 索引，首次调用时加载"""
+    global _embedding_index
+    if _embedding_index is None:
+        # 优先 memmap 加载打包格式（python embedding_index.py 生成），否则解析 JSON
+        index = EmbeddingIndex.load(EMBED_STORE_DIR, EMBED_DIR)
+        kind = "精确"
+        if len(index) >= ANN_MIN_SIZE and os.path.exists(IVF_DIR):
+            try:
+                index = IvfIndex.load(index, IVF_DIR, nprobe=ANN_NPROBE)
+                kind = f"IVF nlist={index.nlist} nprobe={ANN_NPROBE}"
+            except Exception as e:
+                print(f"[{datetime.datetime.now().isoformat()}] IVF 索引不可用，使用精确检索: {e}")
+        _embedding_index = index
+        print(f"[{datetime.datetime.now().isoformat()}] 已加载 embedding 索引: {len(index)} 条（{kind}）")
+        embed_size = getattr(index, "base", index).embed_size
+        if embed_size != EMBED_MAX_SIZE:
+            print(f"[{datetime.datetime.now().isoformat()}] 警告: 图库 embedding 按 {embed_size} 计算，查询按 {EMBED_MAX_SIZE}，"
+                  f"两者不可比，tuijian 只用本地描述子回答；请运行 convert.py --embed 重新计算图库")
+    return _embedding_index
+
+def get_descriptor_index():
+    """与 embedding 库按行对齐的本地描述子（python descriptors.py 生成，缺失或过期时启动时重建）"""
+    global _descriptor_index
+    if _descriptor_index is None:
+        base = getattr(get_embedding_index(), "base", get_embedding_index())
+        _descriptor_index = DescriptorIndex.load_or_build(EMBED_STORE_DIR, base.paths)
+    return _descriptor_index
+
+def recommend(filepath, k=4):
+    """
+    tuijian：返回 ([(path, sim)], 回答的层级)，逐层尝试，越往后越贵：
+      1. cache：内容哈希相同的图算过 embedding
+      2. near：感知哈希近重复的图（任意用户）算过 embedding
+      3. local：本地描述子与图库某张图几乎相同，直接用那张图的 embedding
+      4. remote：调用远端 embedding；EMBED_DEADLINE 内没有结果（或失败）时用描述子排出的候选回答
+    查询向量（1、2、4）按 EMBED_MAX_SIZE 计算，只在图库也按这个尺寸计算时使用，否则只用本地描述子（3 与兜底）。
+    """
+    index = get_embedding_index()
+    base = getattr(index, "base", index)
+    comparable = base.embed_size == EMBED_MAX_SIZE
+    scope = embedding_scope(EMBED_MAX_SIZE)
+    image_hash = file_sha256(filepath)
+
+    embedding = near_dups.cached_embedding(scope, image_hash) if comparable else None
+    if embedding is not None:
+        return index.search(embedding, k=k), "cache"
+
+    hashes = image_hashes(filepath)
+    if comparable and hashes is not None:
+        with metrics.span("near_dup") as span:
+            found = near_dups.find(scope, hashes, limit=1)
+            embedding = near_dups.embedding(found[0][2]) if found else None
+            span["hit"] = embedding is not None
+        if embedding is not None:
+            return index.search(embedding, k=k), "near"
+
+    local = []
+    descriptor_index = get_descriptor_index()
+    if len(descriptor_index):
+        with metrics.span("local_descriptor") as span:
+            try:
+                local = descriptor_index.search(describe(filepath), k=k)
+            except OSError as e:
+                print(f"[{datetime.datetime.now().isoformat()}] 计算本地描述子失败: {e}")
+            span["best"] = round(local[0][1], 4) if local else None
+        if local and local[0][1] >= LOCAL_MATCH_THRESHOLD:
+            return index.search(base.matrix[local[0][0]], k=k), "local"
+    if not comparable:
+        return [(base.paths[i], sim) for i, sim in local], "local_fallback"
+
+    def remember(future):
+        embedding = future.result()
+        if embedding and hashes is not None:
+            near_dups.add(scope, image_hash, hashes, embedding)
+
+    with metrics.span("embedding"):
+        future = embed_executor.submit(generate_embedding, filepath, ark_client_v, key_limiter_v, embedding_pool)
+        future.add_done_callback(remember)  # 超时先回答的情况下，远端结果返回后也能留给下一次
+        try:
+            embedding = future.result(timeout=EMBED_DEADLINE)
+        except concurrent.futures.TimeoutError:
+            print(f"[{datetime.datetime.now().isoformat()}] 远端 embedding 超过 {EMBED_DEADLINE}s 未返回: {filepath}")
+            embedding = None
+    if embedding:
+        return index.search(embedding, k=k), "remote"
+    return [(base.paths[i], sim) for i, sim in local], "local_fallback"
 
 def prepare_image_base64(image_path, max_size=1024, quality=85):
     """
-    压缩并转换图片为 base64。
+    压缩并转换图片为 base64（结果按内容哈希缓存，同一张图只编码一次）。
     - max_size: 限制最长边
-    - quality: JPEG/WEBP 压缩质量
+    - quality: JPEG 压缩质量
     """
-    from io import BytesIO
-    img = Image.open(image_path).convert("RGB")
-
-    # 等比缩放
-    w, h = img.size
-    scale = min(max_size / max(w, h), 1.0)  # 只缩小，不放大
-    if scale < 1.0:
-        new_w, new_h = int(w * scale), int(h * scale)
-        img = img.resize((new_w, new_h), Image.LANCZOS)
-
-    # 保存到内存 buffer
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True)
-    b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    return b64
-
-def generate_image_from_local_to_temp(image_path, client, version, prompt, seed):
+    return preprocess_cache.get_base64(image_path, max_size=max_size, quality=quality)
+
+
+def image_hashes(image_path):
+    """原图的感知哈希，无法解码时返回 None（不影响正常处理）"""
+    try:
+        return phash.compute(image_path)
+    except Exception as e:
+        print(f"[{datetime.datetime.now().isoformat()}] 计算感知哈希失败: {image_path}，错误: {e}")
+        return None
+
+
+def generate_variants(image_path, prompts, output_paths, on_progress=None, near_scope=None):
     """
-    调用 ARK 接口生成图片并下载到临时文件，返回临时文件路径和版本号。
+    并发生成多个版本（由 KeyPool 为每个版本选 key），结果直接流式写入 output_paths。
+    命中结果缓存的版本直接硬链接，不发起请求；给了 near_scope 时，再按感知哈希查找该 scope 内
+    近期处理过的近重复图片，复用它们的缓存结果。返回成功的版本号列表。
+    on_progress(version, output_path=None, error=None) 在每个版本完成（或失败）时立即调用。
     """
-    try:
-        # 压缩后转 base64
+    on_progress = on_progress or (lambda version, output_path=None, error=None: None)
+    image_hash = file_sha256(image_path)
+
+    def keys_for(sha256):
+        return [
+            result_cache.make_key(sha256, prompts[i], SEEDS[i], GUIDANCE_SCALE, MODEL, size=SIZE, watermark=WATERMARK)
+            for i in range(len(prompts))
+        ]
+
+    cache_keys = keys_for(image_hash)
+    succeeded = []
+    pending = []
+
+    def publish_cached(i, source):
+        gallery.add_path(output_paths[i])
+        thumbnails.prewarm(output_paths[i])
+        succeeded.append(i + 1)
+        variants_total.inc(outcome="cached")
+        on_progress(i + 1, output_paths[i])
+        print(f"[{datetime.datetime.now().isoformat()}] 版本 v{i + 1} 命中{source}: {output_paths[i]}")
+
+    with metrics.span("cache_lookup") as span:
+        for i, key in enumerate(cache_keys):
+            if result_cache.lookup(key, output_paths[i]):
+                publish_cached(i, "结果缓存")
+            else:
+                pending.append(i)
+        span["hits"] = len(succeeded)
+    if not pending:
+        return succeeded
+
+    hashes = image_hashes(image_path) if near_scope else None
+    if hashes is not None:
+        missing = len(pending)
+        with metrics.span("near_dup") as span:
+            for dist, sha256, _ in near_dups.find(near_scope, hashes, exclude_sha256=image_hash):
+                near_keys = keys_for(sha256)
+                for i in list(pending):
+                    if result_cache.lookup(near_keys[i], output_paths[i], count_miss=False):
+                        pending.remove(i)
+                        result_cache.store(cache_keys[i], output_paths[i])  # 同一张图再次提交时直接精确命中
+                        publish_cached(i, f"近重复结果（距离 {dist}，原图 {sha256[:12]}）")
+                if not pending:
+                    break
+            span["hits"] = missing - len(pending)
+        near_dup_lookups.inc(kind="result", outcome="hit" if len(pending) < missing else "miss")
+        if not pending:
+            near_dups.add(near_scope, image_hash, hashes)
+            return sorted(succeeded)
+
+    # 压缩后转 base64（所有版本共用同一份）
+    with metrics.span("preprocess"):
         b64 = prepare_image_base64(image_path, max_size=1024, quality=85)
+    started = time.monotonic()
+    # 每个版本交给 KeyPool 选最健康的 key，失败换 key 重试、慢请求对冲
+    futures = {
+        generator.submit(b64, prompts[i], SEEDS[i], output_paths[i]): i
+        for i in pending
+    }
+    first_latency = None
+    remaining = set(pending)
+
+    # 按完成顺序逐个发布：每个版本一写完就进图库、缓存并上报，不等最慢的 key
+    with metrics.span("generate", variants=len(pending)) as span:
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=GENERATE_TIMEOUT):
+                i = futures[future]
+                version = i + 1
+                remaining.discard(i)
+                if future.exception() is not None:
+                    variants_total.inc(outcome="failed")
+                    on_progress(version, error=describe_error(future))
+                    print(f"[{datetime.datetime.now().isoformat()}] 版本 v{version} 生成失败，跳过: {describe_error(future)}")
+                    continue
+                if first_latency is None:
+                    first_latency = time.monotonic() - started
+                succeeded.append(version)
+                variants_total.inc(outcome="generated")
+                with metrics.span("publish", version=version):
+                    gallery.add_path(output_paths[i])
+                    thumbnails.prewarm(output_paths[i])
+                    result_cache.store(cache_keys[i], output_paths[i])
+                    on_progress(version, output_paths[i])
+                print(f"[{datetime.datetime.now().isoformat()}] 版本 v{version} 生成成功 "
+                      f"({time.monotonic() - started:.1f}s): {future.result()}")
+        except concurrent.futures.TimeoutError:
+            for future, i in futures.items():
+                if i in remaining:
+                    future.cancel()
+                    variants_total.inc(outcome="timeout")
+                    on_progress(i + 1, error="timeout")
+                    print(f"[{datetime.datetime.now().isoformat()}] 版本 v{i + 1} 超时未完成，已取消")
+        span["succeeded"] = len(succeeded)
+        span["first"] = round(first_latency, 3) if first_latency is not None else None
+
+    total_latency = time.monotonic() - started
+    if first_latency is not None:
+        variant_latency["first"].append(first_latency)
+        variant_seconds.observe(first_latency, which="first")
+    if len(succeeded) == len(cache_keys):
+        variant_latency["all"].append(total_latency)
+        variant_seconds.observe(total_latency, which="all")
+    print(f"[{datetime.datetime.now().isoformat()}] 首个版本 "
+          f"{f'{first_latency:.1f}s' if first_latency is not None else '-'}，全部版本 {total_latency:.1f}s；"
+          f"近期 {latency_summary()}")
+    print(f"[{datetime.datetime.now().isoformat()}] 结果缓存统计: {result_cache.stats()}")
+    print(f"[{datetime.datetime.now().isoformat()}] key 状态: {generator.pool.snapshot()}")
+    if hashes is not None and succeeded:
+        near_dups.add(near_scope, image_hash, hashes)
+    return sorted(succeeded)
+
+
+def latency_summary():
+    """最近 LATENCY_WINDOW 个任务的首个版本 / 全部版本耗时中位数与 p90"""
+    parts = []
+    for kind, label in (("first", "首个"), ("all", "全部")):
+        samples = sorted(variant_latency[kind])
+        if samples:
+            p50 = samples[len(samples) // 2]
+            p90 = samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+            parts.append(f"{label} p50 {p50:.1f}s / p90 {p90:.1f}s")
+    return "，".join(parts) or "无数据"
 
-        # 调用 SDK 接口
-        imagesResponse = client.images.generate(
-            model=MODEL,
-            prompt=prompt,
-            image="data:image/jpeg;base64," + b64,
-            seed=seed,
-            guidance_scale=GUIDANCE_SCALE,
-            size=SIZE,
-            watermark=WATERMARK
-        )
-
-        # 下载到临时文件
-        url = imagesResponse.data[0].url
-        resp = requests.get(url, timeout=30)
-        resp.raise_for_status()
-        fd, tmp_path = tempfile.mkstemp(suffix=".png")  # 直接保存为 PNG
-        os.close(fd)
-        with open(tmp_path, "wb") as f:
-            f.write(resp.content)
-        return tmp_path, version
-    except Exception as e:
-        print(f"[{datetime.datetime.now().isoformat()}] 版本 {version} 生成失败: {e}")
-        return None, version
 
 def safe_is_image_readable(path):
     """尝试用 PIL 打开图片，判断是否可读（用于避免读取到正在写入中的文件）"""
@@ -178,13 +416,14 @@ def ensure_dirs():
     for d in (UPLOAD_DIR, XIANGAO_DIR, MOVED_DIR):
         os.makedirs(d, exist_ok=True)
 
-def process_one_file(filepath):
+def process_one_file(filepath, metadata=None, on_progress=None):
     """
-    处理单个文件：根据子文件夹的JSON flag决定逻辑。
+    处理单个文件：根据任务携带的 metadata（没有时读取子文件夹的JSON）的 flag 决定逻辑。
     - 如果 flag 是 zhidao，则使用修改后的prompt生成四张图片，保存到 background_person（保持目录结构）。
     - 如果 flag 是 tuijian，则生成embedding，找到相似度最高的四张图，从assets复制到 background_person（保持目录结构）。
     - 如果 flag 是 weitiao，则仅读取style字段，拼接到prompt中，生成四张图片，保存到 background_person（保持目录结构）。
     成功后把原文件移动到 moved_background（保持目录结构）。
+    on_progress 见 generate_variants，tuijian 每复制一张也会调用。
     """
     # 相对于 UPLOAD_DIR 的路径
     rel_path = os.path.relpath(filepath, UPLOAD_DIR)
@@ -204,27 +443,31 @@ def process_one_file(filepath):
 
     print(f"[{datetime.datetime.now().isoformat()}] 开始处理: {rel_path}")
 
-    # 查找子文件夹下的 JSON 文件（假设只有一个）
-    json_dir = os.path.join(UPLOAD_DIR, rel_dir)
-    json_files = [f for f in os.listdir(json_dir) if f.endswith('.json')]
-    if not json_files:
-        print(f"[{datetime.datetime.now().isoformat()}] 未找到 JSON 文件，跳过: {rel_path}")
-        return
-
-    json_path = os.path.join(json_dir, json_files[0])
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            json_data = json.load(f)
-    except Exception as e:
-        print(f"[{datetime.datetime.now().isoformat()}] 读取 JSON 失败: {e}")
-        return
+    if metadata is not None:
+        # 任务入队时的 metadata 快照，不受之后同目录 metadata.json 被覆盖的影响
+        json_data = metadata
+    else:
+        # 兜底入队的文件没有快照：查找用户目录下的 JSON 文件（假设只有一个；原图可能在其分片子目录中）
+        json_dir = os.path.join(UPLOAD_DIR, group_of_path(rel_path))
+        json_files = [f for f in os.listdir(json_dir) if f.endswith('.json')]
+        if not json_files:
+            print(f"[{datetime.datetime.now().isoformat()}] 未找到 JSON 文件，跳过: {rel_path}")
+            return
+
+        json_path = os.path.join(json_dir, json_files[0])
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                json_data = json.load(f)
+        except Exception as e:
+            print(f"[{datetime.datetime.now().isoformat()}] 读取 JSON 失败: {e}")
+            return
 
     flag = json_data.get("flag", "")
+    near_scope = f"{JOB_QUEUE}:{group_of_path(rel_path)}"  # 近重复结果只在同一用户内复用
     if flag not in ["zhidao", "tuijian", "weitiao"]:
         print(f"[{datetime.datetime.now().isoformat()}] 无效 flag: {flag}，跳过: {rel_path}")
         return
 
-    tmp_files = []
     try:
         if flag == "zhidao":
             # 读取字段并融入 prompt
@@ -238,23 +481,7 @@ def process_one_file(filepath):
             modified_prompts = [p + detail_str for p in PROMPTS]
 
             # 并发调用四个 API
-            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-                futures = [
-                    executor.submit(generate_image_from_local_to_temp, filepath, ark_clients[i], i+1, modified_prompts[i], SEEDS[i])
-                    for i in range(4)
-                ]
-                results = concurrent.futures.wait(futures, timeout=60)  # 设置超时
-
-            # 处理生成结果
-            for future in results.done:
-                tmp_path, version = future.result()
-                if tmp_path:
-                    output_path = output_paths[version-1]
-                    shutil.move(tmp_path, output_path)
-                    print(f"[{datetime.datetime.now().isoformat()}] 版本 v{version} 生成成功: {output_path}")
-                    tmp_files.append(tmp_path)
-                else:
-                    print(f"[{datetime.datetime.now().isoformat()}] 版本 v{version} 生成失败，跳过")
+            generate_variants(filepath, modified_prompts, output_paths, on_progress, near_scope)
 
         elif flag == "weitiao":
             # 仅读取 style 字段并融入 prompt
@@ -263,60 +490,33 @@ def process_one_file(filepath):
             modified_prompts = [p + detail_str for p in PROMPTS_WEITIAO]
 
             # 并发调用四个 API
-            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-                futures = [
-                    executor.submit(generate_image_from_local_to_temp, filepath, ark_clients[i], i+1, modified_prompts[i], SEEDS[i])
-                    for i in range(4)
-                ]
-                results = concurrent.futures.wait(futures, timeout=60)  # 设置超时
-
-            # 处理生成结果
-            for future in results.done:
-                tmp_path, version = future.result()
-                if tmp_path:
-                    output_path = output_paths[version-1]
-                    shutil.move(tmp_path, output_path)
-                    print(f"[{datetime.datetime.now().isoformat()}] 版本 v{version} 生成成功: {output_path}")
-                    tmp_files.append(tmp_path)
-                else:
-                    print(f"[{datetime.datetime.now().isoformat()}] 版本 v{version} 生成失败，跳过")
+            generate_variants(filepath, modified_prompts, output_paths, on_progress, near_scope)
 
         elif flag == "tuijian":
-            # 生成 embedding
-            embedding = generate_embedding(filepath, ark_client_v)
-            if not embedding:
-                print(f"[{datetime.datetime.now().isoformat()}] 生成 embedding 失败，跳过: {rel_path}")
-                return
-
-            # 加载所有 embeddings
-            embed_dir = os.path.join(BASE_DIR, "database", "embeddings_output")
-            all_embs = load_all_embeddings(embed_dir)
-
-            if not all_embs:
+            if len(get_embedding_index()) == 0:
                 print(f"[{datetime.datetime.now().isoformat()}] 未找到任何 embeddings，跳过: {rel_path}")
                 return
 
-            # 计算相似度
-            sims = []
-            for path, other_emb in all_embs:
-                if np.linalg.norm(embedding) == 0 or np.linalg.norm(other_emb) == 0:
-                    sim = 0.0
-                else:
-                    sim = np.dot(embedding, other_emb) / (np.linalg.norm(embedding) * np.linalg.norm(other_emb))
-                sims.append((path, sim))
-
-            # 选择 top 4
-            top4 = sorted(sims, key=lambda x: x[1], reverse=True)[:4]
+            top4, tier = recommend(filepath)
+            tuijian_answers.inc(tier=tier)
+            if not top4:
+                print(f"[{datetime.datetime.now().isoformat()}] 生成 embedding 失败，跳过: {rel_path}")
+                return
+            print(f"[{datetime.datetime.now().isoformat()}] tuijian 由 {tier} 层给出结果: {rel_path}")
 
             # 复制 assets 中的图片
             for i, (path, sim) in enumerate(top4):
-                asset_path = path.replace("database", "assets", 1)
-                if os.path.exists(asset_path):
+                source = asset_path(path)
+                if os.path.exists(source):
                     output_path = output_paths[i]
-                    shutil.copy(asset_path, output_path)
-                    print(f"[{datetime.datetime.now().isoformat()}] 复制 top {i+1} (sim: {sim:.4f}): {asset_path} -> {output_path}")
+                    link_or_copy(source, output_path)
+                    gallery.add_path(output_path)
+                    thumbnails.prewarm(output_path)
+                    if on_progress:
+                        on_progress(i + 1, output_path)
+                    print(f"[{datetime.datetime.now().isoformat()}] 复制 top {i+1} (sim: {sim:.4f}): {source} -> {output_path}")
                 else:
-                    print(f"[{datetime.datetime.now().isoformat()}] assets 文件不存在: {asset_path}")
+                    print(f"[{datetime.datetime.now().isoformat()}] assets 文件不存在: {source}")
 
         # 所有处理完成后移动原文件
         if os.path.exists(moved_target):
@@ -324,47 +524,89 @@ def process_one_file(filepath):
             backup_target = f"{moved_target}.{ts}.bak"
             os.rename(moved_target, backup_target)
 
-        shutil.move(filepath, moved_target)
+        with metrics.span("finalize"):
+            shutil.move(filepath, moved_target)
         print(f"[{datetime.datetime.now().isoformat()}] 原图已移动到: {moved_target}")
 
     except Exception as e:
         print(f"[{datetime.datetime.now().isoformat()}] 处理失败: {rel_path}，错误: {e}")
         # 出错则保留原文件在 uploads
-    finally:
-        # 清理临时文件
-        for tmp_path in tmp_files:
-            if tmp_path and os.path.exists(tmp_path):
-                try:
-                    os.remove(tmp_path)
-                except Exception:
-                    pass
-
-def iter_all_images(root_dir):
-    """递归遍历 root_dir 下的所有图片文件，返回文件路径生成器"""
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        for fname in filenames:
-            if fname.startswith("."):
-                continue
-            ext = os.path.splitext(fname)[1].lower()
-            if ext not in ALLOWED_EXTS:
-                continue
-            fpath = os.path.join(dirpath, fname)
-            yield fpath
+
+def handle_job(job):
+    """执行一个队列任务：原图被移走即视为成功，仍在上传目录则按失败退避重试"""
+    fpath = os.path.join(UPLOAD_DIR, job.path)
+    flag = (job.metadata or {}).get("flag", "")
+    outcome = "error"
+    with metrics.trace(job.id, queue=JOB_QUEUE, path=job.path, attempt=job.attempts), \
+            metrics.span("job", flag=flag) as span:
+        try:
+            if not os.path.exists(fpath):
+                # 原图已不在上传目录（已被处理或删除），任务无需再做
+                job_queue.complete(job.id, WORKER_ID)
+                outcome = "gone"
+                return
+            # 检查文件是否可读（避免部分写入）
+            if not safe_is_image_readable(fpath):
+                job_queue.fail(job.id, WORKER_ID, "图片不可读", retry_after=POLL_INTERVAL)
+                outcome = "unreadable"
+                return
+            with job_queue.keep_alive(job.id, WORKER_ID, JOB_LEASE_SECONDS):
+                process_one_file(fpath, job.metadata, job_queue.reporter(job.id, XIANGAO_DIR))
+            if os.path.exists(fpath):
+                outcome = "failed" if job_queue.fail(job.id, WORKER_ID, "处理失败，原图仍在上传目录") else "lease_lost"
+            else:
+                outcome = "done" if job_queue.complete(job.id, WORKER_ID) else "lease_lost"
+        except Exception as e:
+            job_queue.fail(job.id, WORKER_ID, e)
+            raise
+        finally:
+            span["outcome"] = outcome
+            jobs_total.inc(queue=JOB_QUEUE, flag=flag, outcome=outcome)
 
 def main_loop():
     ensure_dirs()
-    print(f"监控目录: {UPLOAD_DIR}，输出目录: {XIANGAO_DIR}，已处理原图目录: {MOVED_DIR}")
+    print(f"[{datetime.datetime.now().isoformat()}] 近重复索引清理过期记录: {near_dups.prune()} 条")
+    metrics.configure("ark1", snapshot_dir=METRICS_DIR, span_log=SPAN_LOG)
+    get_embedding_index()
+    get_descriptor_index()
+    generator.start()
+    # inotify 监听只做兜底：没有对应任务的文件（旧版 app / 手工拷贝）补入队列
+    watcher = UploadWatcher(UPLOAD_DIR, ALLOWED_EXTS, poll_interval=POLL_INTERVAL).start()
+    threading.Thread(
+        target=adopt_orphans, args=(watcher, job_queue, JOB_QUEUE, UPLOAD_DIR), name="orphan-adopter", daemon=True
+    ).start()
+    scheduler = FairScheduler(
+        handle_job,
+        lambda job: group_of_path(job.path),
+        workers=MAX_CONCURRENT_JOBS,
+        per_group_limit=MAX_JOBS_PER_USER,
+    ).start()
+    for collector in (result_cache.metric_rows, generator.pool.metric_rows, embedding_pool.metric_rows,
+                      lambda: job_queue.metric_rows([JOB_QUEUE])):
+        metrics.registry.add_collector(collector)
+    metrics.registry.add_collector(lambda: [
+        ("worker_jobs", "gauge", "本 worker 内排队 / 执行中的任务数", {"state": "pending"}, scheduler.pending_count()),
+        ("worker_jobs", "gauge", "本 worker 内排队 / 执行中的任务数", {"state": "running"}, scheduler.running_count()),
+    ])
+    print(f"任务队列: {JOB_DB}，上传目录: {UPLOAD_DIR}，输出目录: {XIANGAO_DIR}，已处理原图目录: {MOVED_DIR}，"
+          f"兜底监听方式: {watcher.mode}，并发任务数: {MAX_CONCURRENT_JOBS}")
     try:
         while True:
-            for fpath in sorted(iter_all_images(UPLOAD_DIR)):
-                # 检查文件是否可读（避免部分写入）
-                if not safe_is_image_readable(fpath):
-                    continue
-                # 处理文件
-                process_one_file(fpath)
-            time.sleep(POLL_INTERVAL)
+            # 只在有空闲 worker 时领取任务，避免租约在本地排队期间流逝
+            if scheduler.pending_count() + scheduler.running_count() >= MAX_CONCURRENT_JOBS:
+                time.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            job = job_queue.claim(JOB_QUEUE, WORKER_ID, JOB_LEASE_SECONDS, per_group_limit=MAX_JOBS_PER_USER)
+            if job is None:
+                time.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            scheduler.submit(job)
     except KeyboardInterrupt:
         print("退出监控")
+    finally:
+        scheduler.stop(wait=False)
+        watcher.close()
+        generator.close()
 
 if __name__ == "__main__":
     main_loop()
@@ -1,28 +1,48 @@
 import os
 import time
-import base64
+import socket
 import datetime
 import shutil
 import tempfile
-import requests
+import threading
 from PIL import Image
 import numpy as np
-from volcenginesdkarkruntime import Ark
+from upload_watcher import UploadWatcher
+from ark_async import AsyncGenerator
+from image_cache import PreparedImageCache
+from result_cache import ResultCache
+import phash
+from phash import NearDupIndex
+from storage import file_sha256
+from gallery_index import GalleryIndex
+import thumbnails
+from job_queue import JobQueue, adopt_orphans, group_of_path
+import metrics
 
 # 配置项
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))  # 或者直接指定你想要的路径
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 XIANGAO_DIR = os.path.join(BASE_DIR, "xiangao")
 MOVED_DIR = os.path.join(BASE_DIR, "moved_images")
-POLL_INTERVAL = 3  # 秒，轮询间隔
+POLL_INTERVAL = 3  # 秒，轮询回退间隔 / 失败重试间隔
 ALLOWED_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff"}
+JOB_DB = os.path.join(BASE_DIR, "jobs.sqlite")  # 与 app.py 共享的任务队列
+JOB_QUEUE = "ark2"
+JOB_LEASE_SECONDS = 180  # 任务租约（执行期间定期续约），worker 崩溃后最多这么久任务会被重新领取
+QUEUE_POLL_INTERVAL = 0.5  # 秒，队列为空时的检查间隔
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+METRICS_DIR = os.path.join(BASE_DIR, "metrics")  # 指标快照目录，app 的 /metrics 读取
+SPAN_LOG = os.path.join(BASE_DIR, "logs", "ark2.spans.jsonl")  # 每个处理阶段一行 JSON
 
 # ARK / 模型 配置
 API_KEY = os.environ.get("ARK_API_KEY")
 if not API_KEY:
     raise RuntimeError("请先在环境变量 ARK_API_KEY 中设置 ARK_API_KEY")
 
-ARK_BASE_URL = "https://ark.cn-beijing.volces.com/api/v3"
+# 可选：ARK_API_KEYS=key1,key2,... 提供多个 key，由 KeyPool 按健康度路由（未设置时只用 ARK_API_KEY）
+API_KEYS = [k.strip() for k in os.environ.get("ARK_API_KEYS", "").split(",") if k.strip()] or [API_KEY]
+
+ARK_BASE_URL = os.environ.get("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
 MODEL = "doubao-seededit-3-0-i2i-250628"
 PROMPT = ("请为这张图的人物生成简单的线稿，要求仅黑色线条，不需要很多细节，"
           "大约在10-20笔线条左右，描绘出人物的外形和动作（不需要绘制背景，让背景纯白即可），"
@@ -31,19 +51,100 @@ GUIDANCE_SCALE = 5.5
 SEED = 123
 SIZE = "adaptive"
 WATERMARK = True
-
-# 初始化客户端（复用）
-ark_client = Ark(base_url=ARK_BASE_URL, api_key=API_KEY)
-
-
-def make_background_transparent(input_path, output_path, threshold=200):
+TRANSPARENT_MODE = "bilevel"  # 线稿透明化输出格式：bilevel（1-bit 调色板）/ la（灰度+alpha）/ palette（原自适应调色板）
+TRANSPARENT_THRESHOLD = 200
+GENERATE_TIMEOUT = 60  # 秒，生成 + 下载的总超时
+HEDGE_AFTER = 25  # 秒，多个 key 时单个请求这么久未完成就在另一把 key 上对冲，None 表示不对冲
+
+# 生成请求走 asyncio 管线（客户端与下载连接池复用），经 KeyPool 选 key、失败重试
+generator = AsyncGenerator(
+    ARK_BASE_URL, API_KEYS, MODEL,
+    guidance_scale=GUIDANCE_SCALE, size=SIZE, watermark=WATERMARK,
+    hedge_after=HEDGE_AFTER,
+)
+
+# 上传图片的预处理结果缓存（处理失败重试时不必重新编码）
+PREPROCESS_CACHE_BYTES = 16 * 1024 * 1024
+preprocess_cache = PreparedImageCache(PREPROCESS_CACHE_BYTES)
+
+# 最终线稿（透明化之后）的结果缓存：同一张图重复提交时直接硬链接，不再调用 ARK
+RESULT_CACHE_DIR = os.path.join(BASE_DIR, "result_cache", "ark2")
+RESULT_CACHE_BYTES = 512 * 1024 * 1024
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES)
+
+# 感知哈希近重复索引（与 ark1 共用）：同一用户近期传过几乎相同的图（连拍）时复用那张图的线稿
+NEAR_DUP_DB = os.path.join(BASE_DIR, "phash.sqlite")
+near_dups = NearDupIndex(NEAR_DUP_DB)
+
+job_queue = JobQueue(JOB_DB)
+
+# xiangao 的列表索引（app 的 /xiangao 接口读取），写出线稿后即时更新
+gallery = GalleryIndex(XIANGAO_DIR)
+
+jobs_total = metrics.registry.counter("jobs", "处理的任务数", ("queue", "flag", "outcome"))
+near_dup_lookups = metrics.registry.counter("near_dup_lookups", "近重复查询次数", ("kind", "outcome"))
+
+
+_buffers = threading.local()
+
+
+def _buffer(name, shape, dtype):
+    """按线程复用的 numpy 缓冲区，同尺寸图片连续处理时不重复分配"""
+    key = (name, shape, np.dtype(dtype).str)
+    cache = getattr(_buffers, "arrays", None)
+    if cache is None:
+        cache = _buffers.arrays = {}
+    buf = cache.get(key)
+    if buf is None:
+        # 每个名字只保留最近一种尺寸
+        for old in [k for k in cache if k[0] == name]:
+            del cache[old]
+        buf = cache[key] = np.empty(shape, dtype=dtype)
+    return buf
+
+
+def _ink_mask(img, threshold):
+    """单次向量化阈值：返回 (RGB 三通道最小值 <= threshold) 的布尔掩码，即“非白色”像素"""
+    rgb = np.asarray(img)
+    h, w = rgb.shape[:2]
+    channel_min = _buffer("min", (h, w), np.uint8)
+    np.minimum(rgb[..., 0], rgb[..., 1], out=channel_min)
+    np.minimum(channel_min, rgb[..., 2], out=channel_min)
+    ink = _buffer("ink", (h, w), np.bool_)
+    np.less_equal(channel_min, threshold, out=ink)
+    return ink
+
+
+def make_background_transparent(input_path, output_path, threshold=200, mode="palette"):
     """
     把白色背景变透明，并保存为压缩 PNG。
-    优化：
-      - 自动优化颜色索引（optimize=True）
-      - 转调色板模式（P 模式）减少颜色通道
-      - 保留透明度
+    mode:
+      - "palette": 转 RGBA 后自适应调色板量化 + optimize（保留线条原色，最慢）
+      - "bilevel": 线稿专用，1-bit 调色板 PNG（白色透明 / 其余纯黑），不做量化
+      - "la": 线稿专用，灰度 + alpha PNG，保留线条灰度（抗锯齿），不做量化
     """
+    if mode == "bilevel":
+        img = Image.open(input_path).convert("RGB")
+        ink = _ink_mask(img, threshold)
+        packed = np.packbits(ink, axis=1)
+        out = Image.frombytes("P", img.size, packed.tobytes(), "raw", "P;1")
+        out.putpalette([255, 255, 255, 0, 0, 0])
+        out.save(output_path, "PNG", transparency=0, bits=1)
+        return
+
+    if mode == "la":
+        img = Image.open(input_path).convert("RGB")
+        ink = _ink_mask(img, threshold)
+        alpha = _buffer("alpha", ink.shape, np.uint8)
+        np.multiply(ink, 255, out=alpha, casting="unsafe")
+        # 透明区域的灰度统一置白，避免 JPEG 噪点拖累 PNG 压缩
+        gray = _buffer("gray", ink.shape, np.uint8)
+        gray.fill(255)
+        np.copyto(gray, np.asarray(img.convert("L")), where=ink)
+        out = Image.merge("LA", (Image.fromarray(gray), Image.fromarray(alpha)))
+        out.save(output_path, "PNG")
+        return
+
     img = Image.open(input_path).convert("RGBA")
     data = np.array(img)
     r, g, b, a = data.T
@@ -58,56 +159,36 @@ def make_background_transparent(input_path, output_path, threshold=200):
     img.save(output_path, "PNG", optimize=True)
 
 
-
 def prepare_image_base64(image_path, max_size=1024, quality=85):
     """
-    压缩并转换图片为 base64。
+    压缩并转换图片为 base64（结果按内容哈希缓存，同一张图只编码一次）。
     - max_size: 限制最长边
-    - quality: JPEG/WEBP 压缩质量
+    - quality: JPEG 压缩质量
     """
-    from io import BytesIO
-    img = Image.open(image_path).convert("RGB")
-
-    # 等比缩放
-    w, h = img.size
-    scale = min(max_size / max(w, h), 1.0)  # 只缩小，不放大
-    if scale < 1.0:
-        new_w, new_h = int(w * scale), int(h * scale)
-        img = img.resize((new_w, new_h), Image.LANCZOS)
+    return preprocess_cache.get_base64(image_path, max_size=max_size, quality=quality)
 
-    # 保存到内存 buffer
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True)
-    b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    return b64
 
 
 def generate_image_from_local_to_temp(image_path):
     """
-    调用 ARK 接口生成图片并下载到临时文件，返回临时文件路径。
+    调用 ARK 接口生成图片并流式下载到临时文件，返回临时文件路径。
+    （线稿还要经过背景透明化，所以先落到临时文件，再写入 xiangao）
     """
     # 压缩后转 base64
-    b64 = prepare_image_base64(image_path, max_size=1024, quality=85)
-
-    # 调用 SDK 接口
-    imagesResponse = ark_client.images.generate(
-        model=MODEL,
-        prompt=PROMPT,
-        image="data:image/jpeg;base64," + b64,  # 注意这里改成 jpeg
-        seed=SEED,
-        guidance_scale=GUIDANCE_SCALE,
-        size=SIZE,
-        watermark=WATERMARK
-    )
+    with metrics.span("preprocess"):
+        b64 = prepare_image_base64(image_path, max_size=1024, quality=85)
 
-    # 下载到临时文件
-    url = imagesResponse.data[0].url
-    resp = requests.get(url, timeout=30)
-    resp.raise_for_status()
     fd, tmp_path = tempfile.mkstemp(suffix=".jpg")
     os.close(fd)
-    with open(tmp_path, "wb") as f:
-        f.write(resp.content)
+    future = generator.submit(b64, PROMPT, SEED, tmp_path)
+    try:
+        with metrics.span("generate"):
+            future.result(timeout=GENERATE_TIMEOUT)
+    except BaseException:
+        future.cancel()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
     return tmp_path
 
 
@@ -126,10 +207,56 @@ def ensure_dirs():
         os.makedirs(d, exist_ok=True)
 
 
-def process_one_file(filepath):
+def cache_key_for(image_sha256):
+    return result_cache.make_key(
+        image_sha256, PROMPT, SEED, GUIDANCE_SCALE, MODEL,
+        size=SIZE, watermark=WATERMARK, mode=TRANSPARENT_MODE, threshold=TRANSPARENT_THRESHOLD,
+    )
+
+
+def near_scope_of(filepath):
+    """近重复结果只在同一用户内复用"""
+    return f"{JOB_QUEUE}:{group_of_path(os.path.relpath(filepath, UPLOAD_DIR))}"
+
+
+def image_hashes(image_path):
+    """原图的感知哈希，无法解码时返回 None（不影响正常处理）"""
+    try:
+        return phash.compute(image_path)
+    except Exception as e:
+        print(f"[{datetime.datetime.now().isoformat()}] 计算感知哈希失败: {image_path}，错误: {e}")
+        return None
+
+
+def near_duplicate_lookup(filepath, image_hash, cache_key, output_path):
+    """
+    精确缓存未命中时，查找同一用户近期处理过的近重复原图，复用它的线稿（同时以本图的键存入结果缓存）。
+    命中返回 True。
+    """
+    hashes = image_hashes(filepath)
+    if hashes is None:
+        return False
+    scope = near_scope_of(filepath)
+    hit = False
+    with metrics.span("near_dup") as span:
+        for dist, sha256, _ in near_dups.find(scope, hashes, exclude_sha256=image_hash):
+            if result_cache.lookup(cache_key_for(sha256), output_path, count_miss=False):
+                result_cache.store(cache_key, output_path)
+                print(f"[{datetime.datetime.now().isoformat()}] 命中近重复结果（距离 {dist}，原图 {sha256[:12]}）: {output_path}")
+                hit = True
+                break
+        span["hit"] = hit
+    near_dup_lookups.inc(kind="result", outcome="hit" if hit else "miss")
+    if hit:
+        near_dups.add(scope, image_hash, hashes)
+    return hit
+
+
+def process_one_file(filepath, on_progress=None):
     """
     处理单个文件：调用 ARK 生成、背景透明化并保存到 xiangao（保持目录结构），
     成功后把原文件移动到 moved_images（保持目录结构）。
+    on_progress(version, output_path=None, error=None)：输出写好后立即上报（只有一个版本 v1）。
     """
     # 相对于 UPLOAD_DIR 的路径
     rel_path = os.path.relpath(filepath, UPLOAD_DIR)
@@ -150,11 +277,32 @@ def process_one_file(filepath):
 
     print(f"[{datetime.datetime.now().isoformat()}] 开始处理: {rel_path}")
     tmp_generated = None
+    tmp_output = None
     try:
-        # 调用生成接口并下载到临时文件
-        tmp_generated = generate_image_from_local_to_temp(filepath)
-        # 把背景变透明并保存到 xiangao
-        make_background_transparent(tmp_generated, output_path, threshold=200)
+        image_hash = file_sha256(filepath)
+        cache_key = cache_key_for(image_hash)
+        with metrics.span("cache_lookup") as span:
+            span["hit"] = result_cache.lookup(cache_key, output_path)
+        if span["hit"]:
+            print(f"[{datetime.datetime.now().isoformat()}] 命中结果缓存: {output_path}")
+        if not span["hit"] and not near_duplicate_lookup(filepath, image_hash, cache_key, output_path):
+            # 调用生成接口并下载到临时文件
+            tmp_generated = generate_image_from_local_to_temp(filepath)
+            # 把背景变透明，先写同目录临时文件再替换，不会改写与缓存共享 inode 的旧输出
+            tmp_output = os.path.join(output_dir, f".{output_filename}.part")
+            with metrics.span("postprocess", mode=TRANSPARENT_MODE):
+                make_background_transparent(tmp_generated, tmp_output, threshold=TRANSPARENT_THRESHOLD, mode=TRANSPARENT_MODE)
+            os.replace(tmp_output, output_path)
+            result_cache.store(cache_key, output_path)
+            hashes = image_hashes(filepath)
+            if hashes is not None:
+                near_dups.add(near_scope_of(filepath), image_hash, hashes)
+        with metrics.span("publish"):
+            gallery.add_path(output_path)
+            thumbnails.prewarm(output_path)
+            if on_progress:
+                on_progress(1, output_path)
+        print(f"[{datetime.datetime.now().isoformat()}] 结果缓存统计: {result_cache.stats()}")
 
         # 如果 moved_images 中已存在同名文件 → 备份
         if os.path.exists(moved_target):
@@ -162,46 +310,77 @@ def process_one_file(filepath):
             backup_target = f"{moved_target}.{ts}.bak"
             os.rename(moved_target, backup_target)
 
-        shutil.move(filepath, moved_target)
+        with metrics.span("finalize"):
+            shutil.move(filepath, moved_target)
         print(f"[{datetime.datetime.now().isoformat()}] 处理完成: 输出-> {output_path}，原图已移动到 {moved_target}")
     except Exception as e:
         print(f"[{datetime.datetime.now().isoformat()}] 处理失败: {rel_path}，错误: {e}")
+        if on_progress and not os.path.exists(output_path):
+            on_progress(1, error=e)
         # 出错则保留原文件在 uploads
     finally:
-        if tmp_generated and os.path.exists(tmp_generated):
-            try:
-                os.remove(tmp_generated)
-            except Exception:
-                pass
-
-
-def iter_all_images(root_dir):
-    """递归遍历 root_dir 下的所有图片文件，返回文件路径生成器"""
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        for fname in filenames:
-            if fname.startswith("."):
-                continue
-            ext = os.path.splitext(fname)[1].lower()
-            if ext not in ALLOWED_EXTS:
-                continue
-            fpath = os.path.join(dirpath, fname)
-            yield fpath
-            
-            
+        for tmp in (tmp_generated, tmp_output):
+            if tmp and os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except Exception:
+                    pass
+
+
+def handle_job(job):
+    """执行一个队列任务：原图被移走即视为成功，仍在上传目录则按失败退避重试"""
+    fpath = os.path.join(UPLOAD_DIR, job.path)
+    outcome = "error"
+    with metrics.trace(job.id, queue=JOB_QUEUE, path=job.path, attempt=job.attempts), metrics.span("job") as span:
+        try:
+            if not os.path.exists(fpath):
+                job_queue.complete(job.id, WORKER_ID)
+                outcome = "gone"
+                return
+            # 检查文件是否可读（避免部分写入）
+            if not safe_is_image_readable(fpath):
+                job_queue.fail(job.id, WORKER_ID, "图片不可读", retry_after=POLL_INTERVAL)
+                outcome = "unreadable"
+                return
+            with job_queue.keep_alive(job.id, WORKER_ID, JOB_LEASE_SECONDS):
+                process_one_file(fpath, job_queue.reporter(job.id, XIANGAO_DIR))
+            if os.path.exists(fpath):
+                outcome = "failed" if job_queue.fail(job.id, WORKER_ID, "处理失败，原图仍在上传目录") else "lease_lost"
+            else:
+                outcome = "done" if job_queue.complete(job.id, WORKER_ID) else "lease_lost"
+        except Exception as e:
+            job_queue.fail(job.id, WORKER_ID, e)
+            print(f"[{datetime.datetime.now().isoformat()}] 任务执行异常: {job.path}，错误: {e}")
+        finally:
+            span["outcome"] = outcome
+            jobs_total.inc(queue=JOB_QUEUE, flag="", outcome=outcome)
+
 def main_loop():
     ensure_dirs()
-    print(f"监控目录: {UPLOAD_DIR}，输出目录: {XIANGAO_DIR}，已处理原图目录: {MOVED_DIR}")
+    print(f"[{datetime.datetime.now().isoformat()}] 近重复索引清理过期记录: {near_dups.prune()} 条")
+    metrics.configure("ark2", snapshot_dir=METRICS_DIR, span_log=SPAN_LOG)
+    for collector in (result_cache.metric_rows, generator.pool.metric_rows, lambda: job_queue.metric_rows([JOB_QUEUE])):
+        metrics.registry.add_collector(collector)
+    generator.start()
+    # inotify 监听只做兜底：没有对应任务的文件（旧版 app / 手工拷贝）补入队列
+    watcher = UploadWatcher(UPLOAD_DIR, ALLOWED_EXTS, poll_interval=POLL_INTERVAL).start()
+    threading.Thread(
+        target=adopt_orphans, args=(watcher, job_queue, JOB_QUEUE, UPLOAD_DIR), name="orphan-adopter", daemon=True
+    ).start()
+    print(f"任务队列: {JOB_DB}，上传目录: {UPLOAD_DIR}，输出目录: {XIANGAO_DIR}，已处理原图目录: {MOVED_DIR}，"
+          f"兜底监听方式: {watcher.mode}")
     try:
         while True:
-            for fpath in sorted(iter_all_images(UPLOAD_DIR)):
-                # 检查文件是否可读（避免部分写入）
-                if not safe_is_image_readable(fpath):
-                    continue
-                # 处理文件
-                process_one_file(fpath)
-            time.sleep(POLL_INTERVAL)
+            job = job_queue.claim(JOB_QUEUE, WORKER_ID, JOB_LEASE_SECONDS)
+            if job is None:
+                time.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            handle_job(job)
     except KeyboardInterrupt:
         print("退出监控")
+    finally:
+        watcher.close()
+        generator.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+import threading
+import httpx
+from volcenginesdkarkruntime import AsyncArk
+
+from job_scheduler import AsyncKeyLimiter
+from ark_pool import KeyPool, MAX_ATTEMPTS
+import metrics
+
+api_seconds = metrics.registry.histogram("ark_api_seconds", "ARK 生成接口耗时（秒，不含排队与下载）", ("key",))
+download_seconds = metrics.registry.histogram("ark_download_seconds", "生成结果下载耗时（秒）")
+download_bytes = metrics.registry.counter("ark_download_bytes", "生成结果下载字节数")
+
+DOWNLOAD_CHUNK = 256 * 1024
+
+
+class AsyncGenerator:
+    """
+    ARK 图片生成 + 结果下载的 asyncio 管线：
+      - 后台线程中运行一个事件循环，所有生成请求共享它，不再每个请求占用一个线程
+      - 每个 API key 一个 AsyncArk 客户端，按 key 做并发与速率限制
+      - 结果下载共用一个带 keep-alive 连接池的 httpx.AsyncClient，分块流式写入目标路径
+      - 请求经 KeyPool 路由到最健康的 key，失败换 key 重试，可选对冲（hedge_after）；
+        传入 pool 可与其他客户端共享同一份 key 健康状态
+    submit() 返回 concurrent.futures.Future，可直接配合 concurrent.futures.wait 使用。
+    """
+
+    def __init__(self, base_url, api_keys, model, guidance_scale=5.5, size="adaptive", watermark=True,
+                 key_max_concurrency=2, key_requests_per_minute=None,
+                 max_connections=256, download_timeout=30,
+                 max_attempts=MAX_ATTEMPTS, hedge_after=None, pool=None):
+        self.base_url = base_url
+        self.api_keys = list(api_keys)
+        self.params = {
+            "model": model,
+            "guidance_scale": guidance_scale,
+            "size": size,
+            "watermark": watermark,
+        }
+        self.key_max_concurrency = key_max_concurrency
+        self.key_requests_per_minute = key_requests_per_minute
+        self.max_connections = max_connections
+        self.download_timeout = download_timeout
+
+        self._loop = None
+        self._thread = None
+        self._clients = []
+        self._limiters = []
+        self._http = None
+        self.pool = pool or KeyPool(self.api_keys, max_attempts=max_attempts, hedge_after=hedge_after)
+
+    def __len__(self):
+        return len(self.api_keys)
+
+    # ---------- 生命周期 ----------
+    def start(self):
+        if self._loop is not None:
+            return self
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="ark-async-loop", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+        return self
+
+    async def _setup(self):
+        # 重试由 KeyPool 负责（换 key），SDK 自身不再重试同一个 key
+        self._clients = [AsyncArk(base_url=self.base_url, api_key=key, max_retries=0) for key in self.api_keys]
+        self._limiters = [AsyncKeyLimiter(self.key_max_concurrency, self.key_requests_per_minute)
+                          for _ in self.api_keys]
+        self._http = httpx.AsyncClient(
+            timeout=self.download_timeout,
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_connections),
+        )
+
+    def close(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._http.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    # ---------- 对外接口 ----------
+    def submit(self, image_b64, prompt, seed, output_path, key_index=None):
+        """
+        在后台事件循环中生成一张图片并流式下载到 output_path。
+        key_index 为 None 时由 KeyPool 选 key（含重试 / 对冲），否则固定使用该 key、不重试。
+        返回 concurrent.futures.Future，结果为 output_path；cancel() 会取消对应的协程。
+        """
+        if key_index is None:
+            coro = self.pool.acall(lambda index: self.generate(index, image_b64, prompt, seed, output_path))
+        else:
+            coro = self.generate(key_index, image_b64, prompt, seed, output_path)
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def generate(self, key_index, image_b64, prompt, seed, output_path):
+        async with self._limiters[key_index]:
+            start = time.perf_counter()
+            response = await self._clients[key_index].images.generate(
+                prompt=prompt,
+                image="data:image/jpeg;base64," + image_b64,
+                seed=seed,
+                **self.params,
+            )
+            api_seconds.observe(time.perf_counter() - start, key=key_index + 1)
+        start = time.perf_counter()
+        await self.download(response.data[0].url, output_path)
+        download_seconds.observe(time.perf_counter() - start)
+        return output_path
+
+    async def download(self, url, output_path):
+        """
+        分块下载到同目录下的隐藏 .part 文件，完成后 os.replace 原子替换，
+        读方（相册接口）只会看到完整文件。
+        """
+        out_dir, name = os.path.split(output_path)
+        part_path = os.path.join(out_dir, f".{name}.{id(asyncio.current_task()):x}.part")
+        try:
+            async with self._http.stream("GET", url) as resp:
+                resp.raise_for_status()
+                with open(part_path, "wb") as f:
+                    async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK):
+                        f.write(chunk)
+                        download_bytes.inc(len(chunk))
+            os.replace(part_path, output_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+            raise
+
+
+def describe_error(future):
+    """把失败/取消的 future 转为日志文本"""
+    if future.cancelled():
+        return "已取消"
+    exc = future.exception()
+    return f"{type(exc).__name__}: {exc}"
+
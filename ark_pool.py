@@ -0,0 +1,271 @@
+import time
+import random
+import asyncio
+import datetime
+import threading
+import httpx
+import metrics
+
+EWMA_ALPHA = 0.2  # 新样本权重
+INITIAL_LATENCY = 5.0  # 秒，还没有样本的 key 的预估延迟
+THROTTLE_COOLDOWN = 5.0  # 秒，429 后该 key 暂停使用的基础时长，连续 429 翻倍
+THROTTLE_COOLDOWN_MAX = 120.0
+ERROR_COOLDOWN_RATE = 0.5  # 错误率 EWMA 超过该值的 key 视为不健康，排在健康的 key 之后
+MAX_ATTEMPTS = 3  # 每个请求最多尝试次数（含首次），每次重新选择 key
+BACKOFF_BASE = 0.5  # 秒，重试退避基数（full jitter：在 [0, base * 2^n] 内随机）
+BACKOFF_MAX = 8.0
+
+requests_total = metrics.registry.counter("ark_requests", "ARK 请求数（每次尝试）", ("pool", "key", "outcome"))
+request_seconds = metrics.registry.histogram("ark_request_seconds", "ARK 单次尝试耗时（秒，含下载）", ("pool", "key"))
+retries_total = metrics.registry.counter("ark_retries", "换 key 重试次数", ("pool",))
+hedges_total = metrics.registry.counter("ark_hedges", "对冲请求数", ("pool",))
+
+
+def status_of(exc):
+    """异常对应的 HTTP 状态码（ARK SDK 的 ArkAPIStatusError / httpx.HTTPStatusError），没有时返回 None"""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def is_throttled(exc):
+    return status_of(exc) == 429
+
+
+def is_retryable(exc):
+    """429 / 5xx / 408 / 连接与超时错误可以换 key 重试；400 等请求本身的问题不重试"""
+    status = status_of(exc)
+    if status is not None:
+        return status in (408, 429) or status >= 500
+    name = type(exc).__name__
+    return (isinstance(exc, (httpx.TransportError, asyncio.TimeoutError, TimeoutError, ConnectionError))
+            or name in ("ArkAPIConnectionError", "ArkAPITimeoutError"))
+
+
+def retry_after_of(exc):
+    """响应头里的 Retry-After（秒），没有或无法解析时返回 None"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    """第 attempt 次（从 0 开始）失败后的退避时间，full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class KeyStats:
+    __slots__ = ("latency", "error_rate", "inflight", "cooldown_until", "throttle_streak",
+                 "requests", "errors", "throttled", "hedges")
+
+    def __init__(self):
+        self.latency = None  # 成功请求耗时的 EWMA（秒）
+        self.error_rate = 0.0  # 失败率 EWMA
+        self.inflight = 0
+        self.cooldown_until = 0.0
+        self.throttle_streak = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.hedges = 0
+
+
+class KeyPool:
+    """
+    多个 API key 的健康度跟踪与路由：
+      - 每个 key 记录成功耗时 EWMA、错误率 EWMA、429 次数与在途请求数
+      - acquire() 选预估完成时间最短的健康 key：耗时 EWMA × (1 + 在途数)，错误率高的往后排；
+        429 后该 key 冷却一段时间（优先用响应的 Retry-After，连续 429 翻倍），全部冷却时选最早恢复的
+      - call() / acall() 包装一次请求：失败可重试时换一个本请求还没试过的 key、按 full jitter 退避后重试
+        （所有 key 都试过时才会回到用过的 key）；
+        acall() 可选对冲：hedge_after 秒内未完成时在另一个 key 上再发一次，先成功的生效，另一个取消
+    同一个 pool 可以同时给同步客户端（线程中）和 asyncio 客户端使用。
+    """
+
+    def __init__(self, keys, max_attempts=MAX_ATTEMPTS, hedge_after=None, name="ark"):
+        self.keys = list(keys)
+        self.max_attempts = max_attempts
+        self.hedge_after = hedge_after
+        self.name = name
+        self._stats = [KeyStats() for _ in self.keys]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    # ---------- 路由 ----------
+    def _cost(self, s, now):
+        latency = s.latency if s.latency is not None else INITIAL_LATENCY
+        return (
+            s.cooldown_until > now,
+            s.error_rate > ERROR_COOLDOWN_RATE,
+            latency * (1 + s.inflight) / max(0.05, 1 - s.error_rate),
+            s.cooldown_until,
+        )
+
+    def acquire(self, exclude=()):
+        """选一个 key 并计入在途请求，返回 key 下标；exclude 里的 key 只有在没有其他 key 时才会被选中"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [i for i in range(len(self.keys)) if i not in exclude] or list(range(len(self.keys)))
+            # 同分时从随机位置开始，避免所有请求挤到下标最小的 key
+            offset = random.randrange(len(candidates))
+            candidates = candidates[offset:] + candidates[:offset]
+            index = min(candidates, key=lambda i: self._cost(self._stats[i], now))
+            s = self._stats[index]
+            s.inflight += 1
+            s.requests += 1
+            return index
+
+    def release(self, index, latency=None, error=None, cancelled=False):
+        """请求结束：成功时传 latency，失败传 error，被对冲 / 超时取消时传 cancelled 和已耗时"""
+        if cancelled:
+            outcome = "cancelled"
+        elif error is None:
+            outcome = "ok"
+        else:
+            outcome = "throttled" if is_throttled(error) else "error"
+        requests_total.inc(pool=self.name, key=index + 1, outcome=outcome)
+        if error is None and latency is not None:
+            request_seconds.observe(latency, pool=self.name, key=index + 1)
+        with self._lock:
+            s = self._stats[index]
+            s.inflight -= 1
+            if cancelled:
+                # 被取消的请求至少花了这么久，只在它比当前估计更慢时计入
+                if latency is not None and (s.latency is None or latency > s.latency):
+                    s.latency = latency if s.latency is None else s.latency + EWMA_ALPHA * (latency - s.latency)
+                return
+            failed = error is not None and is_retryable(error)
+            s.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - s.error_rate)
+            if error is None:
+                s.throttle_streak = 0
+                s.latency = latency if s.latency is None else s.latency + EWMA_ALPHA * (latency - s.latency)
+                return
+            s.errors += 1
+            if is_throttled(error):
+                s.throttled += 1
+                s.throttle_streak += 1
+                cooldown = retry_after_of(error) or THROTTLE_COOLDOWN * 2 ** (s.throttle_streak - 1)
+                s.cooldown_until = time.monotonic() + min(cooldown, THROTTLE_COOLDOWN_MAX)
+
+    def snapshot(self):
+        """各 key 的当前状态（日志 / 监控用），key 本身不输出"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "key": i + 1,
+                    "latency": round(s.latency, 3) if s.latency is not None else None,
+                    "error_rate": round(s.error_rate, 3),
+                    "inflight": s.inflight,
+                    "cooldown": round(max(0.0, s.cooldown_until - now), 1),
+                    "requests": s.requests,
+                    "errors": s.errors,
+                    "throttled": s.throttled,
+                    "hedges": s.hedges,
+                }
+                for i, s in enumerate(self._stats)
+            ]
+
+    def metric_rows(self):
+        """metrics.Registry 的 collector：各 key 的耗时 EWMA、错误率、在途请求数、是否冷却中"""
+        rows = []
+        for row in self.snapshot():
+            labels = {"pool": self.name, "key": row["key"]}
+            if row["latency"] is not None:
+                rows.append(("ark_key_latency_ewma_seconds", "gauge", "各 key 成功请求耗时 EWMA（秒）", labels, row["latency"]))
+            rows.append(("ark_key_error_rate", "gauge", "各 key 错误率 EWMA", labels, row["error_rate"]))
+            rows.append(("ark_key_inflight", "gauge", "各 key 在途请求数", labels, row["inflight"]))
+            rows.append(("ark_key_cooldown_seconds", "gauge", "各 key 剩余冷却时间（秒）", labels, row["cooldown"]))
+        return rows
+
+    def _log_retry(self, attempt, exc, delay):
+        retries_total.inc(pool=self.name)
+        print(f"[{datetime.datetime.now().isoformat()}] {self.name} 第 {attempt + 1} 次请求失败"
+              f"（{type(exc).__name__}: {exc}），{delay:.1f}s 后换 key 重试")
+
+    # ---------- 同步调用 ----------
+    def call(self, fn):
+        """同步执行 fn(key_index)，失败可重试时换 key 重试，返回 fn 的结果"""
+        attempt = 0
+        tried = []
+        while True:
+            index = self.acquire(exclude=tried)
+            tried.append(index)
+            start = time.monotonic()
+            try:
+                result = fn(index)
+            except Exception as e:
+                self.release(index, error=e)
+                if not is_retryable(e) or attempt + 1 >= self.max_attempts:
+                    raise
+                delay = backoff(attempt)
+                self._log_retry(attempt, e, delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.release(index, latency=time.monotonic() - start)
+            return result
+
+    # ---------- asyncio 调用 ----------
+    async def _attempt(self, fn, exclude=(), chosen=None, hedge=False):
+        # 在协程内部选 key：任务还没开始运行就被取消时不会占着在途计数
+        index = self.acquire(exclude)
+        if chosen is not None:
+            chosen.append(index)
+        if hedge:
+            hedges_total.inc(pool=self.name)
+            with self._lock:
+                self._stats[index].hedges += 1
+        start = time.monotonic()
+        try:
+            result = await fn(index)
+        except asyncio.CancelledError:
+            self.release(index, latency=time.monotonic() - start, cancelled=True)
+            raise
+        except Exception as e:
+            self.release(index, error=e)
+            raise
+        self.release(index, latency=time.monotonic() - start)
+        return result
+
+    async def _hedged(self, fn, chosen):
+        """一次尝试（含可能的对冲）；chosen 为本请求已用过的 key，新选的 key 追加进去"""
+        tasks = {asyncio.ensure_future(self._attempt(fn, exclude=tuple(chosen), chosen=chosen))}
+        try:
+            if self.hedge_after and len(self.keys) > 1:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                if not done:
+                    print(f"[{datetime.datetime.now().isoformat()}] {self.name} key {chosen[-1] + 1} "
+                          f"超过 {self.hedge_after}s 未完成，换 key 对冲")
+                    tasks.add(asyncio.ensure_future(self._attempt(fn, exclude=tuple(chosen), chosen=chosen, hedge=True)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def acall(self, fn):
+        """在事件循环中执行 await fn(key_index)，支持重试与对冲，返回 fn 的结果"""
+        attempt = 0
+        chosen = []
+        while True:
+            try:
+                return await self._hedged(fn, chosen)
+            except Exception as e:
+                if not is_retryable(e) or attempt + 1 >= self.max_attempts:
+                    raise
+                delay = backoff(attempt)
+                self._log_retry(attempt, e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
@@ -0,0 +1,82 @@
+"""
+asyncio 生成管线的并发基准：在单进程内同时发起大量生成 + 下载，对接本地 ARK 替身服务。
+
+用法：
+  python benchmarks/bench_async_generate.py --requests 400 --keys 4 --latency 1.0
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ark_async import AsyncGenerator  # noqa: E402
+from stub_ark_server import StubConfig, start_stub_server  # noqa: E402
+
+
+def client_thread_count():
+    """当前进程中除替身服务请求线程外的线程数"""
+    return sum(1 for t in threading.enumerate() if "process_request" not in t.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--keys", type=int, default=4)
+    parser.add_argument("--key-concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--image-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    config = StubConfig(latency=args.latency, jitter=args.jitter, image_size=args.image_size)
+    server, base_url = start_stub_server(config)
+    generator = AsyncGenerator(base_url, [f"stub-key-{i}" for i in range(args.keys)], "stub-model",
+                               key_max_concurrency=args.key_concurrency).start()
+
+    out_dir = tempfile.mkdtemp(prefix="bench_async_")
+    b64 = "AAAA"
+    threads_before = client_thread_count()
+    start = time.perf_counter()
+    submitted = {}
+    for i in range(args.requests):
+        future = generator.submit(b64, "bench", 123, os.path.join(out_dir, f"{i}.png"), key_index=i % args.keys)
+        submitted[future] = time.perf_counter()
+
+    latencies = []
+    peak_threads = client_thread_count()
+    failures = collections.Counter()
+    for future in concurrent.futures.as_completed(submitted):
+        peak_threads = max(peak_threads, client_thread_count())
+        if future.exception() is not None:
+            failures[repr(future.exception())] += 1
+            continue
+        latencies.append(time.perf_counter() - submitted[future])
+    elapsed = time.perf_counter() - start
+
+    generator.close()
+    server.shutdown()
+
+    lat = np.array(latencies) if latencies else np.zeros(1)
+    print(f"请求数: {args.requests}, key 数: {args.keys}, 替身延迟: {args.latency}s ± {args.jitter}s")
+    failed = sum(failures.values())
+    print(f"完成: {len(latencies)}, 失败: {failed}, 总耗时: {elapsed:.2f}s, 吞吐: {len(latencies) / elapsed:.1f} 张/s")
+    print(f"延迟 p50: {np.percentile(lat, 50):.3f}s, p99: {np.percentile(lat, 99):.3f}s")
+    print(f"客户端线程数（不含替身服务）: 启动前 {threads_before}, 运行中峰值 {peak_threads}")
+    print(f"替身服务统计: {config.stats}")
+    for error, count in failures.most_common():
+        print(f"  失败 {count} 次: {error}")
+    # 替身服务没有注入故障，任何失败都说明管线（或替身服务本身）有问题
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
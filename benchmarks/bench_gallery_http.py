@@ -0,0 +1,95 @@
+"""
+图库重复加载基准：在临时目录里启动 app.py，模拟客户端反复打开同一个图库页面
+（列表接口 + 每张图片），比较不带缓存校验与带 If-None-Match 两种客户端的耗时和下载字节数。
+
+用法：
+  python benchmarks/bench_gallery_http.py --images 200 --reloads 5
+  python benchmarks/bench_gallery_http.py --images 200 --width 256   # 请求缩略图
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+from werkzeug.serving import make_server, WSGIRequestHandler  # noqa: E402
+
+
+def make_images(folder, count, size):
+    rng = np.random.default_rng(0)
+    os.makedirs(folder, exist_ok=True)
+    base = int(time.time() * 1000)
+    for i in range(count):
+        arr = rng.integers(0, 255, (size // 8, size // 8, 3), dtype=np.uint8)
+        Image.fromarray(arr).resize((size, size), Image.BILINEAR).save(
+            os.path.join(folder, f"{base + i}.jpg"), quality=85)
+
+
+def load_gallery(session, base_url, user_id, width, etags):
+    """打开一次图库页面；etags 为 None 时不做缓存校验。返回 (耗时, 下载字节数, 304 数)"""
+    start = time.perf_counter()
+    received = 0
+    not_modified = 0
+    urls = session.get(f"{base_url}/xiangao", params={"user_id": user_id}).json()
+    for url in urls:
+        full = f"{base_url}{url}" + (f"?w={width}" if width else "")
+        headers = {}
+        if etags is not None and full in etags:
+            headers["If-None-Match"] = etags[full]
+        resp = session.get(full, headers=headers)
+        received += len(resp.content)
+        if resp.status_code == 304:
+            not_modified += 1
+        elif etags is not None:
+            etags[full] = resp.headers.get("ETag")
+    return time.perf_counter() - start, received, not_modified
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--reloads", type=int, default=5)
+    parser.add_argument("--width", type=int, default=None, help="请求 ?w= 缩略图")
+    parser.add_argument("--port", type=int, default=18001)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_gallery_")
+    os.chdir(work_dir)  # app.py 的目录都是相对路径
+    user_id = "bench"
+    make_images(os.path.join(work_dir, "xiangao", f"user_{user_id}"), args.images, args.image_size)
+
+    import app  # noqa: E402
+
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"  # keep-alive
+    server = make_server("127.0.0.1", args.port, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    print(f"图片: {args.images} 张 {args.image_size}px, 重复加载 {args.reloads} 次" +
+          (f", 缩略图 w={args.width}" if args.width else ""))
+    for label, etags in (("无缓存校验", None), ("If-None-Match", {})):
+        session = requests.Session()
+        for i in range(args.reloads + 1):
+            elapsed, received, not_modified = load_gallery(session, base_url, user_id, args.width, etags)
+            tag = "首次" if i == 0 else f"重载{i}"
+            print(f"{label:>14} {tag:>4}: {elapsed * 1000:8.1f} ms, 下载 {received / 1024:9.1f} KiB, 304: {not_modified}")
+
+    # Range 请求
+    url = f"{base_url}{requests.get(f'{base_url}/xiangao', params={'user_id': user_id}).json()[0]}"
+    resp = requests.get(url, headers={"Range": "bytes=0-1023"})
+    print(f"Range bytes=0-1023: {resp.status_code}, {len(resp.content)} 字节, Content-Range: {resp.headers.get('Content-Range')}")
+    print(f"Cache-Control: {resp.headers.get('Cache-Control')}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+KeyPool 路由基准：对接本地 ARK 替身服务，四个 key 分别设置为
+  key 0 变慢、key 1 频繁 429、key 2 偶发 500、key 3 正常，
+比较“按下标固定 key、不重试”（原来 ark1 的做法）与“KeyPool 选 key + 换 key 重试 + 对冲”的成功率与延迟。
+
+用法：
+  python benchmarks/bench_key_pool.py --requests 200 --rate 20
+  python benchmarks/bench_key_pool.py --hedge-after 0   # 不对冲
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import concurrent.futures
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ark_pool  # noqa: E402
+from ark_async import AsyncGenerator  # noqa: E402
+from stub_ark_server import StubConfig, start_stub_server  # noqa: E402
+
+KEYS = ["slow-key", "throttled-key", "flaky-key", "healthy-key"]
+
+
+def run(base_url, pinned, args):
+    generator = AsyncGenerator(
+        base_url, KEYS, "stub-model", key_max_concurrency=args.key_concurrency,
+        hedge_after=args.hedge_after or None,
+    ).start()
+    out_dir = tempfile.mkdtemp(prefix="bench_pool_")
+    submitted = {}
+    finished = {}
+    start = time.perf_counter()
+    for i in range(args.requests):
+        path = os.path.join(out_dir, f"{i}.png")
+        future = generator.submit("AAAA", "bench", 123, path, key_index=i % len(KEYS) if pinned else None)
+        submitted[future] = time.perf_counter()
+        future.add_done_callback(lambda f: finished.setdefault(f, time.perf_counter()))
+        time.sleep(1 / args.rate)  # 按固定速率到达，pool 能从前面的请求里学到各 key 的状况
+
+    latencies = []
+    failed = 0
+    for future in concurrent.futures.as_completed(submitted):
+        if future.exception() is not None:
+            failed += 1
+        else:
+            latencies.append(finished[future] - submitted[future])
+    elapsed = time.perf_counter() - start
+    snapshot = generator.pool.snapshot()
+    generator.close()
+
+    lat = np.array(latencies) if latencies else np.zeros(1)
+    label = "固定 key、不重试" if pinned else "KeyPool"
+    print(f"{label:>10}: 成功 {len(latencies)}/{args.requests}, 总耗时 {elapsed:.1f}s, "
+          f"延迟 p50 {np.percentile(lat, 50):.2f}s / p90 {np.percentile(lat, 90):.2f}s / p99 {np.percentile(lat, 99):.2f}s")
+    if not pinned:
+        for row in snapshot:
+            print(f"{'':>12}key {row['key']} ({KEYS[row['key'] - 1]}): 请求 {row['requests']}, 错误 {row['errors']}, "
+                  f"429 {row['throttled']}, 对冲 {row['hedges']}, 耗时 EWMA {row['latency']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20, help="每秒提交的请求数")
+    parser.add_argument("--latency", type=float, default=0.5, help="正常 key 的延迟（秒）")
+    parser.add_argument("--slow-latency", type=float, default=4.0, help="慢 key 的延迟（秒）")
+    parser.add_argument("--throttle-rate", type=float, default=0.5, help="限流 key 返回 429 的比例")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="不稳定 key 返回 500 的比例")
+    parser.add_argument("--hedge-after", type=float, default=2.0, help="对冲等待（秒），0 表示不对冲")
+    parser.add_argument("--key-concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    ark_pool.THROTTLE_COOLDOWN = 1.0  # 替身服务不返回 Retry-After，缩短冷却以便短时间内看到效果
+    config = StubConfig(
+        latency=args.latency, jitter=args.latency / 4,
+        key_latency={"slow-key": args.slow_latency},
+        key_throttle_rate={"throttled-key": args.throttle_rate},
+        key_error_rate={"flaky-key": args.error_rate},
+    )
+    server, base_url = start_stub_server(config)
+    print(f"请求数: {args.requests}, 到达速率: {args.rate}/s, 正常延迟 {args.latency}s, 慢 key {args.slow_latency}s, "
+          f"429 比例 {args.throttle_rate}, 500 比例 {args.error_rate}")
+    for pinned in (True, False):
+        run(base_url, pinned, args)
+    print(f"替身服务统计: {config.stats}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+worker 热点函数的微基准（单进程、不发起任何请求）：
+  - ark1.prepare_image_base64：未命中（解码 + 缩放 + JPEG + base64）与命中预处理缓存两种情况
+  - ark2.make_background_transparent：当前 TRANSPARENT_MODE 下的线稿透明化
+  - tuijian 相似度检索：ark1 使用的常驻 embedding 索引（精确检索；--synthetic 时可对比 IVF）
+  - 近重复检测：phash.compute 与 NearDupIndex.find（--near-dup-rows 条合成记录）
+
+用法：
+  python benchmarks/bench_micro.py
+  python benchmarks/bench_micro.py --images 50 --repeat 5 --output micro.json
+  python benchmarks/bench_micro.py --synthetic 100000   # 检索换成合成大库
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# worker 在导入时检查 API key；基准不会发起任何请求
+for name in ("ARK_API_KEY", "ARK_API_KEY_1", "ARK_API_KEY_2", "ARK_API_KEY_3", "ARK_API_KEY_4", "ARK_API_KEY_V"):
+    os.environ.setdefault(name, "benchmark")
+
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+import ark1  # noqa: E402
+import ark2  # noqa: E402
+import phash  # noqa: E402
+from image_cache import PreparedImageCache  # noqa: E402
+from embedding_index import EmbeddingIndex  # noqa: E402
+from ann_index import IvfIndex  # noqa: E402
+from bench_ann import synthetic_index, make_queries  # noqa: E402
+from bench_transparent import synthetic_sketch  # noqa: E402
+
+
+def per_call_ms(fn, items, repeat=1):
+    """对 items 逐个调用 fn，重复 repeat 轮，返回每次调用耗时（毫秒）的列表"""
+    samples = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            fn(item)
+            samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summary(samples):
+    arr = np.array(samples)
+    return {"n": len(samples), "mean": round(float(arr.mean()), 3),
+            "p50": round(float(np.percentile(arr, 50)), 3), "p99": round(float(np.percentile(arr, 99)), 3)}
+
+
+def bench_prepare(images, repeat):
+    def cold(path):
+        ark1.preprocess_cache = PreparedImageCache(ark1.PREPROCESS_CACHE_BYTES)
+        ark1.prepare_image_base64(path)
+
+    miss = summary(per_call_ms(cold, images, repeat))
+    ark1.preprocess_cache = PreparedImageCache(ark1.PREPROCESS_CACHE_BYTES)
+    for path in images:
+        ark1.prepare_image_base64(path)  # 填充缓存
+    hit = summary(per_call_ms(ark1.prepare_image_base64, images, repeat))
+    return {"prepare_image_base64 (miss)": miss, "prepare_image_base64 (hit)": hit}
+
+
+def bench_transparent(work_dir, args):
+    input_path = os.path.join(work_dir, "sketch.jpg")
+    synthetic_sketch(input_path, args.width, args.height)
+    output_path = os.path.join(work_dir, "sketch.png")
+
+    def run(_):
+        ark2.make_background_transparent(input_path, output_path, ark2.TRANSPARENT_THRESHOLD, mode=ark2.TRANSPARENT_MODE)
+
+    run(None)  # 预热（缓冲区分配）
+    label = f"make_background_transparent ({ark2.TRANSPARENT_MODE} {args.width}x{args.height})"
+    return {label: summary(per_call_ms(run, [None], args.repeat * 4))}
+
+
+def bench_near_dup(images, work_dir, args):
+    results = {"phash.compute": summary(per_call_ms(phash.compute, images, args.repeat))}
+    index = phash.NearDupIndex(os.path.join(work_dir, "phash.sqlite"))
+    rng = np.random.default_rng(0)
+    rows = rng.integers(-(1 << 63), (1 << 63) - 1, size=(args.near_dup_rows, 2), dtype=np.int64)
+    scope = phash.embedding_scope(1024)
+    conn = index._conn()
+    with conn:
+        conn.executemany("INSERT INTO hashes (scope, sha256, dhash, phash, created_at) VALUES (?, ?, ?, ?, ?)",
+                         [(scope, f"{i:064x}", int(d), int(p), time.time()) for i, (d, p) in enumerate(rows)])
+    queries = [phash.compute(p) for p in images]
+    index.find(scope, queries[0])  # 首次查询加载全部记录
+    label = f"NearDupIndex.find ({args.near_dup_rows})"
+    results[label] = summary(per_call_ms(lambda h: index.find(scope, h), queries, args.repeat))
+    return results
+
+
+def bench_search(args):
+    if args.synthetic:
+        base = synthetic_index(args.synthetic, args.dim, args.clusters)
+    else:
+        base = EmbeddingIndex.load(ark1.EMBED_STORE_DIR, ark1.EMBED_DIR)
+    if len(base) == 0:
+        return {}
+    queries = make_queries(base, args.queries, noise=0.02)
+    results = {f"search exact ({len(base)})": summary(per_call_ms(lambda q: base.search(q, k=4), queries))}
+    if len(base) >= ark1.ANN_MIN_SIZE:
+        ivf = IvfIndex.build(base)
+        label = f"search ivf nprobe={ark1.ANN_NPROBE} ({len(base)})"
+        results[label] = summary(per_call_ms(lambda q: ivf.search(q, k=4, nprobe=ark1.ANN_NPROBE), queries))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=30, help="prepare_image_base64 使用的 assets 图片数")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--width", type=int, default=1024, help="透明化输入尺寸（与生成结果一致）")
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--synthetic", type=int, default=0, help="合成向量条数，0 表示使用 database/ 下的真实库")
+    parser.add_argument("--dim", type=int, default=2048)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--near-dup-rows", type=int, default=100000, help="近重复索引的合成记录条数")
+    parser.add_argument("--output", help="结果另存为 JSON，便于前后对比")
+    args = parser.parse_args()
+
+    images = sorted(p for p in glob.glob(os.path.join(ROOT, "assets", "**", "*.jpg"), recursive=True))
+    images = images[:: max(1, len(images) // args.images)][:args.images]
+    sizes = [Image.open(p).size for p in images]
+    print(f"assets 图片 {len(images)} 张，平均 {np.mean([w for w, _ in sizes]):.0f}x{np.mean([h for _, h in sizes]):.0f}")
+
+    results = {}
+    results.update(bench_prepare(images, args.repeat))
+    work_dir = tempfile.mkdtemp(prefix="bench_micro_")
+    results.update(bench_transparent(work_dir, args))
+    results.update(bench_near_dup(images, work_dir, args))
+    results.update(bench_search(args))
+
+    print(f"{'benchmark':<48} {'n':>6} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, row in results.items():
+        print(f"{name:<48} {row['n']:>6} {row['mean']:>9.3f} {row['p50']:>9.3f} {row['p99']:>9.3f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+端到端管线基准：上传 → 队列 → ark1 / ark2 生成 → 结果可访问。
+
+在临时目录里复制一份代码（assets / database 以软链接接入），启动 app.py、ark1.py、ark2.py 三个进程，
+worker 对接本进程内的 ARK 替身服务（可配置延迟与故障率）；按固定速率回放上传混合：
+  zhidao / tuijian / weitiao 走 /background（ark1），upload 走 /upload（ark2），图片取自 assets/。
+每个上传通过 /jobs/<id> 长轮询等待完成，报告吞吐、首个结果与全部完成的 p50 / p99 延迟，
+以及各进程的 CPU 时间与峰值 RSS（读取 /proc，仅 Linux）。
+
+用法：
+  python benchmarks/bench_pipeline.py --uploads 100 --rate 2
+  python benchmarks/bench_pipeline.py --mix zhidao=1,tuijian=1 --latency 2 --error-rate 0.05
+  python benchmarks/bench_pipeline.py --uploads 50 --repeat-rate 0.5 --output before.json   # 一半重复图片，命中结果缓存
+"""
+import os
+import sys
+import json
+import glob
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np  # noqa: E402
+from stub_ark_server import StubConfig, start_stub_server  # noqa: E402
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+FLAGS = ("zhidao", "tuijian", "weitiao", "upload")
+APP_SERVER = (
+    "import sys, app; from werkzeug.serving import run_simple; "
+    "run_simple('127.0.0.1', int(sys.argv[1]), app.app, threaded=True)"
+)
+TERMINAL_STATES = ("done", "failed")
+
+
+def parse_mix(text):
+    """zhidao=3,tuijian=2 -> {"zhidao": 3.0, "tuijian": 2.0}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in FLAGS:
+            raise SystemExit(f"未知类型: {name}，可选 {', '.join(FLAGS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def prepare_workdir(path):
+    """复制顶层模块到 path，assets / database 用软链接（tuijian 按相对路径读取）"""
+    os.makedirs(os.path.join(path, "logs"), exist_ok=True)
+    for src in glob.glob(os.path.join(ROOT, "*.py")):
+        shutil.copy(src, path)
+    for name in ("assets", "database"):
+        os.symlink(os.path.join(ROOT, name), os.path.join(path, name))
+
+
+def asset_images(min_side):
+    paths = []
+    for path in glob.glob(os.path.join(ROOT, "assets", "**", "*"), recursive=True):
+        if path.lower().endswith(IMAGE_EXTS) and os.path.getsize(path) > 0:
+            paths.append(path)
+    if min_side:
+        from PIL import Image
+        paths = [p for p in paths if min(Image.open(p).size) >= min_side]
+    if not paths:
+        raise SystemExit("assets/ 下没有可用的图片")
+    return sorted(paths)
+
+
+# ---------- 进程与资源 ----------
+class ProcessStats:
+    """按 /proc 采样子进程的 CPU 时间与 RSS（非 Linux 时不采样）"""
+
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def __init__(self, procs, interval=0.5):
+        self.procs = procs  # name -> Popen
+        self.interval = interval
+        self.enabled = os.path.exists("/proc/self/stat")
+        self.peak_rss = {name: 0 for name in procs}
+        self.cpu_start = {}
+        self.cpu_end = {}
+        self._stop = threading.Event()
+
+    def cpu_seconds(self, pid):
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS  # utime + stime
+
+    def rss_bytes(self, pid):
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def _sample(self, target):
+        for name, proc in self.procs.items():
+            try:
+                if target is not None:
+                    target[name] = self.cpu_seconds(proc.pid)
+                self.peak_rss[name] = max(self.peak_rss[name], self.rss_bytes(proc.pid))
+            except (OSError, ValueError, IndexError):
+                pass
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._sample(None)
+
+    def start(self):
+        if self.enabled:
+            self._sample(self.cpu_start)
+            threading.Thread(target=self._loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.enabled:
+            self._sample(self.cpu_end)
+
+    def report(self, elapsed):
+        if not self.enabled:
+            return {}
+        return {
+            name: {
+                "cpu_seconds": round(self.cpu_end.get(name, 0) - self.cpu_start.get(name, 0), 2),
+                "cpu_percent": round((self.cpu_end.get(name, 0) - self.cpu_start.get(name, 0)) / elapsed * 100, 1),
+                "peak_rss_mb": round(self.peak_rss[name] / 1024 / 1024, 1),
+            }
+            for name in self.procs
+        }
+
+
+def start_processes(work_dir, port, base_url):
+    env = dict(
+        os.environ, PYTHONUNBUFFERED="1", ARK_BASE_URL=base_url,
+        ARK_API_KEY="bench-0", ARK_API_KEY_1="bench-1", ARK_API_KEY_2="bench-2",
+        ARK_API_KEY_3="bench-3", ARK_API_KEY_4="bench-4", ARK_API_KEY_V="bench-v",
+    )
+    commands = {
+        "app": [sys.executable, "-c", APP_SERVER, str(port)],
+        "ark1": [sys.executable, "ark1.py"],
+        "ark2": [sys.executable, "ark2.py"],
+    }
+    procs = {}
+    for name, cmd in commands.items():
+        log = open(os.path.join(work_dir, "logs", f"{name}.out"), "w")
+        procs[name] = subprocess.Popen(cmd, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return procs
+
+
+def stop_processes(procs):
+    for proc in procs.values():
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+    for proc in procs.values():
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def wait_ready(base, procs, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for name, proc in procs.items():
+            if proc.poll() is not None:
+                raise SystemExit(f"{name} 启动失败（退出码 {proc.returncode}），见 logs/{name}.out")
+        try:
+            if requests.get(f"{base}/jobs", params={"user_id": "bench_ready"}, timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("app 启动超时")
+
+
+# ---------- 上传回放 ----------
+class Replay:
+    def __init__(self, base, work_dir, images, args):
+        self.base = base
+        self.work_dir = work_dir
+        self.images = images
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.uploaded = []  # 已上传过的 (文件名, 字节)，repeat_rate 按比例重复上传
+        self.local = threading.local()
+
+    def session(self):
+        s = getattr(self.local, "session", None)
+        if s is None:
+            s = self.local.session = requests.Session()
+        return s
+
+    def pick_image(self):
+        """按 repeat_rate 重复上传已有图片（命中结果缓存），否则取一张 assets 图片并在末尾追加随机字节使内容唯一"""
+        if self.uploaded and self.rng.random() < self.args.repeat_rate:
+            return self.rng.choice(self.uploaded)
+        path = self.rng.choice(self.images)
+        with open(path, "rb") as f:
+            data = f.read() + os.urandom(16)  # JPEG / PNG 解码时忽略结束标记之后的数据
+        item = (os.path.basename(path), data)
+        self.uploaded.append(item)
+        return item
+
+    def seed_weitiao(self, user_id, n):
+        """weitiao 对 background_person 里已有的图片微调，预先放入一张"""
+        name, data = self.pick_image()
+        fname = f"seed_{n}{os.path.splitext(name)[1].lower()}"
+        folder = os.path.join(self.work_dir, "background_person", f"user_{user_id}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, fname), "wb") as f:
+            f.write(data)
+        return fname
+
+    def post(self, kind, user_id, n):
+        s = self.session()
+        if kind == "upload":
+            name, data = self.pick_image()
+            return s.post(f"{self.base}/upload", data={"user_id": user_id}, files={"file": (name, data)})
+        metadata = {"user_id": user_id, "flag": kind, "style": "清新"}
+        if kind == "zhidao":
+            metadata.update(gender="女", age="25", height="165", weight="50", peopleCount="1")
+        if kind == "weitiao":
+            fname = self.seed_weitiao(user_id, n)
+            return s.post(f"{self.base}/background",
+                          data={"metadata": json.dumps(metadata, ensure_ascii=False), "filenames": fname})
+        name, data = self.pick_image()
+        return s.post(f"{self.base}/background",
+                      data={"metadata": json.dumps(metadata, ensure_ascii=False)}, files={"files": (name, data)})
+
+    def wait_job(self, job_id, deadline):
+        """长轮询直到任务结束，返回 (最终状态, 首个版本完成时间)"""
+        s = self.session()
+        first = None
+        job = s.get(f"{self.base}/jobs/{job_id}").json()
+        while True:
+            if first is None and any(p["state"] == "done" for p in job["progress"]):
+                first = time.perf_counter()
+            if job["state"] in TERMINAL_STATES or time.time() >= deadline:
+                return job["state"], first
+            wait = max(1, min(25, int(deadline - time.time())))
+            job = s.get(f"{self.base}/jobs/{job_id}", params={"wait": wait, "since": job["seq"]},
+                        timeout=wait + 10).json()
+
+    def run_one(self, kind, user_id, n):
+        start = time.perf_counter()
+        result = {"kind": kind, "ok": False}
+        try:
+            resp = self.post(kind, user_id, n)
+            result["upload"] = time.perf_counter() - start
+            if resp.status_code != 200 or not resp.json().get("jobs"):
+                result["error"] = f"HTTP {resp.status_code}: {resp.text[:200]}"
+                return result
+            deadline = time.time() + self.args.timeout
+            first = None
+            states = []
+            for job_id in resp.json()["jobs"]:
+                state, job_first = self.wait_job(job_id, deadline)
+                states.append(state)
+                if job_first is not None and (first is None or job_first < first):
+                    first = job_first
+            result["ok"] = all(s == "done" for s in states)
+            if not result["ok"]:
+                result["error"] = f"job states {states}"
+            result["first"] = first - start if first is not None else None
+            result["total"] = time.perf_counter() - start
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+
+def percentiles(values):
+    if not values:
+        return {"n": 0}
+    arr = np.array(values)
+    return {"n": len(values), "p50": round(float(np.percentile(arr, 50)), 3),
+            "p99": round(float(np.percentile(arr, 99)), 3), "max": round(float(arr.max()), 3)}
+
+
+def summarize(results):
+    by_kind = {}
+    for kind in sorted({r["kind"] for r in results}):
+        rows = [r for r in results if r["kind"] == kind]
+        ok = [r for r in rows if r["ok"]]
+        by_kind[kind] = {
+            "uploads": len(rows),
+            "ok": len(ok),
+            "upload": percentiles([r["upload"] for r in rows if "upload" in r]),
+            "first": percentiles([r["first"] for r in ok if r.get("first") is not None]),
+            "total": percentiles([r["total"] for r in ok]),
+        }
+    return by_kind
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=60)
+    parser.add_argument("--rate", type=float, default=2.0, help="每秒上传数（固定速率到达）")
+    parser.add_argument("--mix", default="zhidao=3,tuijian=2,weitiao=1,upload=3", help="各类上传的权重")
+    parser.add_argument("--users", type=int, default=20, help="上传分散到多少个用户")
+    parser.add_argument("--repeat-rate", type=float, default=0.0, help="重复上传已传过图片的比例")
+    parser.add_argument("--min-side", type=int, default=0, help="只使用短边不小于该值的 assets 图片")
+    parser.add_argument("--latency", type=float, default=1.0, help="替身服务生成 / embedding 延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=300, help="单个上传等待完成的上限（秒）")
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--output", help="结果另存为 JSON，便于前后对比")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录（日志、span、输出图片）")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    images = asset_images(args.min_side)
+    config = StubConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        throttle_rate=args.throttle_rate)
+    server, base_url = start_stub_server(config)
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    prepare_workdir(work_dir)
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    procs = start_processes(work_dir, port, base_url)
+    try:
+        wait_ready(base, procs)
+        time.sleep(1)  # worker 加载 embedding 索引、启动事件循环
+        print(f"工作目录: {work_dir}，上传 {args.uploads} 个，速率 {args.rate}/s，混合 {mix}，"
+              f"assets 图片 {len(images)} 张，替身延迟 {args.latency}s")
+
+        replay = Replay(base, work_dir, images, args)
+        kinds = list(mix)
+        plan = replay.rng.choices(kinds, weights=[mix[k] for k in kinds], k=args.uploads)
+        stats = ProcessStats(procs).start()
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(args.uploads, 256)) as pool:
+            futures = []
+            for n, kind in enumerate(plan):
+                futures.append(pool.submit(replay.run_one, kind, f"bench{n % args.users}", n))
+                time.sleep(1 / args.rate)
+            results = [f.result() for f in futures]
+        elapsed = time.perf_counter() - start
+        stats.stop()
+    finally:
+        stop_processes(procs)
+        server.shutdown()
+
+    ok = sum(r["ok"] for r in results)
+    report = {
+        "args": vars(args),
+        "elapsed": round(elapsed, 2),
+        "uploads": len(results),
+        "ok": ok,
+        "throughput": round(ok / elapsed, 3),
+        "kinds": summarize(results),
+        "processes": stats.report(elapsed),
+        "stub": dict(config.stats),
+        "errors": [r["error"] for r in results if r.get("error")][:20],
+    }
+
+    print(f"完成 {ok}/{len(results)}，耗时 {elapsed:.1f}s，吞吐 {report['throughput']:.2f} 个/s")
+    print(f"{'类型':>8} {'成功':>7} {'上传 p50':>9} {'首个 p50':>9} {'首个 p99':>9} {'完成 p50':>9} {'完成 p99':>9}")
+    for kind, row in report["kinds"].items():
+        cells = [row["upload"].get("p50"), row["first"].get("p50"), row["first"].get("p99"),
+                 row["total"].get("p50"), row["total"].get("p99")]
+        print(f"{kind:>8} {row['ok']:>3}/{row['uploads']:<3} "
+              + " ".join(f"{c:>9.2f}" if c is not None else f"{'-':>9}" for c in cells))
+    for name, row in report["processes"].items():
+        print(f"{name:>8}: CPU {row['cpu_seconds']:.1f}s（{row['cpu_percent']:.0f}%），峰值 RSS {row['peak_rss_mb']:.0f}MB")
+    print(f"替身服务统计: {report['stub']}")
+    for error in report["errors"]:
+        print(f"  失败: {error}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.keep:
+        print(f"临时目录已保留: {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
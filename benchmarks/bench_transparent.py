@@ -0,0 +1,66 @@
+"""
+ark2.make_background_transparent 各输出模式的耗时与文件大小对比。
+
+默认合成一张 1536x2048 的白底线稿（带 JPEG 噪点），也可以指定真实线稿：
+  python benchmarks/bench_transparent.py
+  python benchmarks/bench_transparent.py --input some_sketch.jpg --repeat 10
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+# ark2 在导入时检查 API key；基准不会发起任何请求
+os.environ.setdefault("ARK_API_KEY", "benchmark")
+
+import numpy as np  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+import ark2  # noqa: E402
+
+MODES = ["palette", "bilevel", "la"]
+
+
+def synthetic_sketch(path, width, height, strokes=20, seed=123):
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for _ in range(strokes):
+        pts = [tuple(int(v) for v in rng.integers(0, [width, height])) for _ in range(4)]
+        draw.line(pts, fill=(25, 25, 25), width=int(rng.integers(3, 8)), joint="curve")
+    img.save(path, "JPEG", quality=90)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="输入线稿图片，默认使用合成图")
+    parser.add_argument("--width", type=int, default=1536)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threshold", type=int, default=200)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_transparent_")
+    input_path = args.input
+    if not input_path:
+        input_path = os.path.join(work_dir, "sketch.jpg")
+        synthetic_sketch(input_path, args.width, args.height)
+    size = Image.open(input_path).size
+    print(f"输入: {input_path} {size[0]}x{size[1]}, 重复 {args.repeat} 次")
+    print(f"{'mode':>8} {'ms/张':>9} {'输出字节':>10} {'不透明像素':>10}")
+
+    for mode in MODES:
+        output_path = os.path.join(work_dir, f"out_{mode}.png")
+        ark2.make_background_transparent(input_path, output_path, args.threshold, mode=mode)  # 预热
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            ark2.make_background_transparent(input_path, output_path, args.threshold, mode=mode)
+        ms = (time.perf_counter() - start) / args.repeat * 1000
+        opaque = int((np.asarray(Image.open(output_path).convert("RGBA"))[..., 3] > 0).sum())
+        print(f"{mode:>8} {ms:>9.1f} {os.path.getsize(output_path):>10} {opaque:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+本地 ARK 替身服务，用于基准测试和联调（不消耗真实配额）。
+
+实现的接口：
+  POST /api/v3/images/generations          返回一张可下载图片的 URL
+  POST /api/v3/embeddings/multimodal       返回固定维度的随机 embedding
+  GET  /files/<name>                       下载生成结果（预先编码好的 PNG）
+
+可配置延迟与故障注入：
+  python benchmarks/stub_ark_server.py --port 18080 --latency 2.0 --jitter 0.5 --error-rate 0.05 --throttle-rate 0.05
+  --download-error-rate：下载时只发一半数据就断开连接（模拟下载中途失败）
+
+worker 指向替身服务：
+  ARK_BASE_URL=http://127.0.0.1:18080/api/v3 python ark1.py
+"""
+import io
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+
+def _sample_png(size):
+    """生成一张白底黑线的图片，近似线稿/生成结果"""
+    img = np.full((size, size, 3), 255, dtype=np.uint8)
+    img[size // 4:size // 4 + 4, :] = 0
+    img[:, size // 2:size // 2 + 4] = 0
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, "PNG")
+    return buf.getvalue()
+
+
+class StubConfig:
+    def __init__(self, latency=1.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 image_size=1024, embedding_dim=2048, download_latency=0.0, key_latency=None,
+                 key_error_rate=None, key_throttle_rate=None, download_error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.download_latency = download_latency
+        self.download_error_rate = download_error_rate
+        self.embedding_dim = embedding_dim
+        self.image_bytes = _sample_png(image_size)
+        # 按 API key 单独设置延迟（模拟某个 key 变慢），{"key": 秒}
+        self.key_latency = key_latency or {}
+        # 按 API key 单独设置故障率（模拟某个 key 被限流 / 不稳定），{"key": 比例}
+        self.key_error_rate = key_error_rate or {}
+        self.key_throttle_rate = key_throttle_rate or {}
+        self.counter = itertools.count(1)
+        self.stats = {"generate": 0, "embed": 0, "download": 0, "errors": 0, "throttled": 0, "truncated": 0}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive
+    config = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _api_key(self):
+        auth = self.headers.get("Authorization", "")
+        return auth[len("Bearer "):] if auth.startswith("Bearer ") else auth
+
+    def _inject(self):
+        """模拟延迟与故障；返回 True 表示已经回写了错误响应"""
+        cfg = self.config
+        key = self._api_key()
+        delay = cfg.key_latency.get(key, cfg.latency)
+        if cfg.jitter:
+            delay = max(0.0, delay + random.uniform(-cfg.jitter, cfg.jitter))
+        time.sleep(delay)
+        roll = random.random()
+        throttle_rate = cfg.key_throttle_rate.get(key, cfg.throttle_rate)
+        error_rate = cfg.key_error_rate.get(key, cfg.error_rate)
+        if roll < throttle_rate:
+            cfg.count("throttled")
+            self._send_json(429, {"error": {"code": "RateLimitExceeded", "message": "stub throttled"}})
+            return True
+        if roll < throttle_rate + error_rate:
+            cfg.count("errors")
+            self._send_json(500, {"error": {"code": "InternalServiceError", "message": "stub error"}})
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        cfg = self.config
+        if self.path.endswith("/images/generations"):
+            if self._inject():
+                return
+            cfg.count("generate")
+            host = self.headers.get("Host")
+            name = f"{next(cfg.counter)}.png"
+            self._send_json(200, {
+                "model": "stub",
+                "created": int(time.time()),
+                "data": [{"url": f"http://{host}/files/{name}"}],
+                "usage": {"generated_images": 1, "output_tokens": 0, "total_tokens": 0},
+            })
+        elif self.path.endswith("/embeddings/multimodal"):
+            if self._inject():
+                return
+            cfg.count("embed")
+            vec = np.random.default_rng().standard_normal(cfg.embedding_dim).astype(np.float32)
+            self._send_json(200, {
+                "id": f"stub-{next(cfg.counter)}",
+                "model": "stub",
+                "object": "list",
+                "created": int(time.time()),
+                "data": {"embedding": vec.tolist(), "object": "embedding"},
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            })
+        else:
+            self._send_json(404, {"error": {"code": "NotFound", "message": self.path}})
+
+    def do_GET(self):
+        cfg = self.config
+        if not self.path.startswith("/files/"):
+            self._send_json(404, {"error": {"code": "NotFound", "message": self.path}})
+            return
+        if cfg.download_latency:
+            time.sleep(cfg.download_latency)
+        truncate = random.random() < cfg.download_error_rate
+        cfg.count("truncated" if truncate else "download")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(cfg.image_bytes)))
+        self.end_headers()
+        if truncate:
+            # 声明了完整长度却只发一半就断开，客户端读到一半时出错
+            self.wfile.write(cfg.image_bytes[:len(cfg.image_bytes) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(cfg.image_bytes)
+
+
+class StubServer(ThreadingHTTPServer):
+    # listen() 的 backlog 在构造时（server_activate）就已确定，必须作为类属性设置；
+    # 默认的 5 在数百个并发连接下会直接拒绝连接
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_stub_server(config, host="127.0.0.1", port=0):
+    """在后台线程启动替身服务，返回 (server, base_url)；server.shutdown() 停止"""
+    handler = type("BoundStubHandler", (StubHandler,), {"config": config})
+    server = StubServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/api/v3"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=1.0, help="生成/embedding 接口延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 429 的比例")
+    parser.add_argument("--download-latency", type=float, default=0.0)
+    parser.add_argument("--download-error-rate", type=float, default=0.0, help="下载中途断开的比例")
+    parser.add_argument("--image-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    config = StubConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        throttle_rate=args.throttle_rate, image_size=args.image_size,
+                        download_latency=args.download_latency, download_error_rate=args.download_error_rate)
+    server, base_url = start_stub_server(config, args.host, args.port)
+    print(f"ARK 替身服务已启动: {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""
+已处理原图的归档层：moved / moved_images / moved_background 只增不减、一图一个小文件，
+超过一定天数的冷文件被追加进大的段文件（segment），按偏移读取，释放 inode、加快备份。
+
+布局（ARCHIVE_DIR，默认 archive/）：
+  - {id:06d}.seg：只追加的段文件，达到 SEGMENT_MAX_BYTES 后封存，新数据写入下一个段
+  - index.sqlite（WAL）：(root, user, name) -> (segment, offset, size, sha256, mtime)
+    同一内容（sha256）只存一份：moved 与 moved_images 里是同一次上传的硬链接，.bak 也常与新文件相同
+  - lock：归档 / 过期 / 压缩三个写操作之间的互斥锁（flock），app 只读索引和删除索引行
+
+约定：
+  - 先把数据追加到段文件并 fsync，再写索引，最后删除原文件；任何一步崩溃，下次运行都能继续（多余的字节只是垃圾）
+  - 删除只删索引行，空间由 compact 回收：已封存段中的垃圾比例超过 COMPACT_GARBAGE_RATIO 时，
+    把仍被引用的数据复制到当前段、更新索引后删除旧段；读取方拿到旧位置时重新查一次索引
+  - 每个目录的保留策略见 POLICIES
+
+用法（cron / systemd timer，或 --interval 常驻）：
+  python blob_pack.py --dry-run
+  python blob_pack.py                    # 归档 + 过期 + 压缩
+  python blob_pack.py compact
+  python blob_pack.py --interval 3600
+"""
+import io
+import os
+import sys
+import time
+import errno
+import sqlite3
+import argparse
+import datetime
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import storage
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+ARCHIVE_DIR = os.path.join(BASE_DIR, "archive")
+INDEX_FILE = "index.sqlite"
+LOCK_FILE = "lock"
+SEGMENT_SUFFIX = ".seg"
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+COMPACT_GARBAGE_RATIO = 0.3  # 已封存段中垃圾（已删除 / 已过期的数据）超过这个比例时压缩
+COPY_CHUNK = 1024 * 1024
+BACKUP_SUFFIX = ".bak"  # worker 遇到同名文件时留下的备份：{name}.{时间戳}.bak
+DAY = 24 * 3600
+
+# 各归档目录的策略（天）：archive_after 天未修改的文件打包；keep 天后删除（None 为永久保留）；
+# .bak 备份 bak_keep 天后删除。indexed 表示该目录有 GalleryIndex（列表接口），删除时同步更新
+POLICIES = {
+    "moved": {"archive_after": 30, "keep": None, "bak_keep": None, "indexed": True},
+    "moved_images": {"archive_after": 7, "keep": 365, "bak_keep": 30, "indexed": False},
+    "moved_background": {"archive_after": 7, "keep": 365, "bak_keep": 30, "indexed": False},
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    root TEXT NOT NULL,
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    archived_at REAL NOT NULL,
+    PRIMARY KEY (root, user, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS blobs_sha256 ON blobs (sha256);
+CREATE INDEX IF NOT EXISTS blobs_location ON blobs (segment, offset);
+"""
+
+
+def log(message):
+    print(f"[{datetime.datetime.now().isoformat()}] {message}")
+
+
+class BlobReader(io.RawIOBase):
+    """段文件中 [offset, offset + size) 的只读视图（pread，不共享文件位置），可 seek，交给 Response 分块发送"""
+
+    def __init__(self, fd, offset, size):
+        super().__init__()
+        self._fd = fd
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = min(max(base + pos, 0), self._size)
+        return self._pos
+
+    def readinto(self, buf):
+        n = min(len(buf), self._size - self._pos)
+        if n <= 0:
+            return 0
+        data = os.pread(self._fd, n, self._offset + self._pos)
+        buf[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+class BlobArchive:
+    """
+    归档目录的读写接口：
+      - app：names / locate / open / delete（删除只删索引行）
+      - 归档任务：archive_file / expired / compact，需在 writer() 锁内调用
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        self.db_path = os.path.join(directory, INDEX_FILE)
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:06d}{SEGMENT_SUFFIX}")
+
+    def segments(self):
+        """现有段文件编号（升序）"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(n[:-len(SEGMENT_SUFFIX)]) for n in names
+                      if n.endswith(SEGMENT_SUFFIX) and n[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    @contextlib.contextmanager
+    def writer(self):
+        """写操作互斥（跨进程 flock）：同一时间只有一个归档 / 压缩任务追加段文件"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    # ---------- 读取（app） ----------
+    def names(self, root, user):
+        return [r[0] for r in self._conn().execute(
+            "SELECT name FROM blobs WHERE root = ? AND user = ?", (root, user))]
+
+    def locate(self, root, user, name):
+        """(segment, offset, size, sha256, mtime)，不存在时返回 None"""
+        return self._conn().execute(
+            "SELECT segment, offset, size, sha256, mtime FROM blobs WHERE root = ? AND user = ? AND name = ?",
+            (root, user, name)).fetchone()
+
+    def open(self, root, user, name):
+        """
+        返回 (BlobReader, size, sha256, mtime)，不存在时返回 None。
+        压缩可能刚好删掉了查到的旧段：此时索引已指向新位置，重新查一次即可。
+        """
+        for _ in range(3):
+            row = self.locate(root, user, name)
+            if row is None:
+                return None
+            segment, offset, size, sha256, mtime = row
+            try:
+                fd = os.open(self.segment_path(segment), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            return BlobReader(fd, offset, size), size, sha256, mtime
+        return None
+
+    def read_bytes(self, root, user, name):
+        opened = self.open(root, user, name)
+        if opened is None:
+            return None
+        with opened[0] as reader:
+            return reader.read()
+
+    def delete(self, root, user, name):
+        """删除一条记录（不动段文件，空间由 compact 回收），返回是否存在"""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM blobs WHERE root = ? AND user = ? AND name = ?", (root, user, name))
+        return cur.rowcount > 0
+
+    def usage(self):
+        """{segment: (段文件大小, 仍被引用的字节数)}；同一位置被多条记录共享时只算一次"""
+        live = dict(self._conn().execute(
+            "SELECT segment, SUM(size) FROM (SELECT DISTINCT segment, offset, size FROM blobs) GROUP BY segment"))
+        out = {}
+        for segment in self.segments():
+            try:
+                total = os.path.getsize(self.segment_path(segment))
+            except FileNotFoundError:
+                continue
+            out[segment] = (total, live.get(segment, 0))
+        return out
+
+    # ---------- 写入（归档任务，需持有 writer 锁） ----------
+    def _append(self, src_file, size):
+        """把 src_file 的 size 字节追加到当前段（放不下时开新段），fsync 后返回 (segment, offset)"""
+        segments = self.segments()
+        segment = segments[-1] if segments else 1
+        path = self.segment_path(segment)
+        current = os.path.getsize(path) if os.path.exists(path) else 0
+        if current and current + size > SEGMENT_MAX_BYTES:
+            segment += 1
+            path = self.segment_path(segment)
+        with open(path, "ab") as dst:
+            offset = dst.tell()
+            remaining = size
+            while remaining > 0:
+                chunk = src_file.read(min(COPY_CHUNK, remaining))
+                if not chunk:
+                    raise IOError(errno.EIO, f"源数据提前结束（缺 {remaining} 字节）")
+                dst.write(chunk)
+                remaining -= len(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        return segment, offset
+
+    def archive_file(self, root, user, name, path):
+        """
+        把 path 归档为 (root, user, name) 并删除原文件，返回新追加的字节数（内容已存在时为 0）。
+        已归档过（上次删除原文件前中断）时只删除原文件。
+        """
+        st = os.stat(path)
+        digest = storage.file_sha256(path)
+        conn = self._conn()
+        existing = conn.execute("SELECT sha256 FROM blobs WHERE root = ? AND user = ? AND name = ?",
+                                (root, user, name)).fetchone()
+        added = 0
+        if existing is None or existing[0] != digest:
+            same = conn.execute("SELECT segment, offset, size FROM blobs WHERE sha256 = ? LIMIT 1", (digest,)).fetchone()
+            if same is not None:
+                segment, offset, size = same
+            else:
+                with open(path, "rb") as f:
+                    segment, offset = self._append(f, st.st_size)
+                size = added = st.st_size
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO blobs (root, user, name, sha256, segment, offset, size, mtime, archived_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (root, user, name, digest, segment, offset, size, st.st_mtime, time.time()))
+        os.remove(path)
+        return added
+
+    def expired(self, root, before, bak_before=None):
+        """root 下 mtime 早于 before（.bak 早于 bak_before）的记录 [(user, name)]"""
+        conn = self._conn()
+        rows = []
+        if before is not None:
+            rows += conn.execute("SELECT user, name FROM blobs WHERE root = ? AND mtime < ?", (root, before)).fetchall()
+        if bak_before is not None:
+            rows += conn.execute("SELECT user, name FROM blobs WHERE root = ? AND mtime < ? AND name LIKE ?",
+                                 (root, bak_before, f"%{BACKUP_SUFFIX}")).fetchall()
+        return sorted(set(rows))
+
+    def compact(self, ratio=COMPACT_GARBAGE_RATIO, dry_run=False):
+        """
+        压缩垃圾比例超过 ratio 的已封存段（当前写入段除外），返回 [(segment, 回收字节数)]。
+        逐条复制仍被引用的数据：索引更新带上旧位置作为条件，期间被 app 删除的记录不会被“复活”。
+        """
+        usage = self.usage()
+        if not usage:
+            return []
+        active = max(usage)
+        reclaimed = []
+        for segment, (total, live) in sorted(usage.items()):
+            if segment == active or total == 0 or (total - live) / total < ratio:
+                continue
+            if dry_run:
+                reclaimed.append((segment, total - live))
+                continue
+            conn = self._conn()
+            locations = conn.execute(
+                "SELECT DISTINCT offset, size FROM blobs WHERE segment = ? ORDER BY offset", (segment,)).fetchall()
+            with open(self.segment_path(segment), "rb") as src:
+                for offset, size in locations:
+                    src.seek(offset)
+                    new_segment, new_offset = self._append(src, size)
+                    with conn:
+                        conn.execute("UPDATE blobs SET segment = ?, offset = ? WHERE segment = ? AND offset = ?",
+                                     (new_segment, new_offset, segment, offset))
+            # 复制期间的并发删除只影响新段的垃圾比例；旧段此时已没有任何引用
+            if conn.execute("SELECT 1 FROM blobs WHERE segment = ? LIMIT 1", (segment,)).fetchone() is None:
+                os.remove(self.segment_path(segment))
+                reclaimed.append((segment, total - live))
+        return reclaimed
+
+
+# ---------- 归档任务 ----------
+def cold_files(root, before):
+    """root 下 mtime 早于 before 的用户文件 [(user, name, path, mtime)]（分片目录与平铺位置，隐藏文件除外）"""
+    out = []
+    try:
+        users = sorted(os.listdir(root))
+    except FileNotFoundError:
+        return out
+    for user in users:
+        user_dir = os.path.join(root, user)
+        if not user.startswith("user_") or not os.path.isdir(user_dir):
+            continue
+        for name, path in storage.scan_user_dir(user_dir):
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime < before:
+                out.append((user, name, path, mtime))
+    return out
+
+
+def expiry_cutoffs(policy, now):
+    """(普通文件, .bak) 的过期时间点，永久保留时为 None"""
+    keep, bak_keep = policy["keep"], policy["bak_keep"]
+    before = now - keep * DAY if keep is not None else None
+    bak_before = now - bak_keep * DAY if bak_keep is not None else None
+    return before, bak_before
+
+
+def is_expired(name, mtime, before, bak_before):
+    if before is not None and mtime < before:
+        return True
+    return bak_before is not None and name.endswith(BACKUP_SUFFIX) and mtime < bak_before
+
+
+def run_once(archive, base_dir, command="all", dry_run=False):
+    import thumbnails
+    from gallery_index import GalleryIndex
+
+    now = time.time()
+    with archive.writer():
+        for root_name, policy in POLICIES.items():
+            root = os.path.join(base_dir, root_name)
+            index = GalleryIndex(root) if policy["indexed"] and os.path.isdir(root) else None
+            before, bak_before = expiry_cutoffs(policy, now)
+            removed = []  # (user, name, 原图位置)
+
+            if command in ("all", "archive"):
+                archived = added = 0
+                for user, name, path, mtime in cold_files(root, now - policy["archive_after"] * DAY):
+                    if is_expired(name, mtime, before, bak_before):
+                        removed.append((user, name, path))  # 已过保留期：不必归档，直接删除
+                        continue
+                    archived += 1
+                    if dry_run:
+                        continue
+                    try:
+                        added += archive.archive_file(root_name, user, name, path)
+                    except FileNotFoundError:
+                        continue  # 期间被 /delete 删除
+                    # 缩略图按原图 inode 缓存，归档后按内容哈希重新生成
+                    thumbnails.remove_derivatives(path)
+                verb = "待归档" if dry_run else "已归档"
+                log(f"{root_name}: {verb} {archived} 个文件，新增段数据 {added} 字节")
+
+            if command in ("all", "expire"):
+                for user, name in archive.expired(root_name, before, bak_before):
+                    removed.append((user, name, os.path.join(root, user, storage.shard_of(name), name)))
+                if not dry_run:
+                    for user, name, path in removed:
+                        if os.path.isfile(path):
+                            os.remove(path)
+                        else:
+                            archive.delete(root_name, user, name)
+                        if index is not None:
+                            index.remove(user, name)
+                        thumbnails.remove_derivatives(path)
+                if removed:
+                    verb = "待过期删除" if dry_run else "过期删除"
+                    log(f"{root_name}: {verb} {len(removed)} 个文件")
+
+        if command in ("all", "compact"):
+            reclaimed = archive.compact(dry_run=dry_run)
+            verb = "可回收" if dry_run else "已回收"
+            log(f"压缩: {verb} {sum(r[1] for r in reclaimed)} 字节（段 {[r[0] for r in reclaimed]}）")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="all", choices=("all", "archive", "expire", "compact"))
+    parser.add_argument("--base-dir", default=BASE_DIR, help="各归档目录所在目录")
+    parser.add_argument("--dry-run", action="store_true", help="只统计，不修改任何文件")
+    parser.add_argument("--interval", type=float, default=0, help="大于 0 时常驻，每隔这么多秒运行一次")
+    args = parser.parse_args(argv)
+
+    archive = BlobArchive(os.path.join(args.base_dir, os.path.basename(ARCHIVE_DIR)))
+    while True:
+        run_once(archive, args.base_dir, args.command, args.dry_run)
+        if args.interval <= 0:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,37 +1,480 @@
+"""
+景点图库（assets/数据库/<景点>/NNN.jpg）入库工具：
+  - 各景点目录下的新图片（任意格式）转成 RGB JPEG，按 001.jpg、002.jpg… 编号；已编号的图片保持编号不变
+  - 多进程并行转换；清单（<root>/.convert/manifest.json）记录每个文件的大小 / mtime / sha256，
+    再次运行时未变化的文件直接跳过
+  - 两阶段改名：先转换到暂存目录，再把原文件移入回收目录、暂存文件改名到位，每一步都记入清单中的日志；
+    中途崩溃后重新运行会从日志继续，不会出现半改名的目录或 NNN.jpg 与未处理原图撞名
+  - 同一遍生成缩略图（thumbnails 模块，与原图同目录的 .thumbs），
+    --embed 时为新增 / 变化的图片计算 embedding 并重新打包 database/（存在 IVF 索引时一并重建）
+
+用法：
+  python convert.py                     # 转换 + 缩略图
+  python convert.py --embed             # 同时更新 embedding 库（需要 ARK_API_KEY_V）
+  python convert.py --dry-run           # 只打印计划
+"""
 import os
-from PIL import Image
+import re
+import sys
+import json
+import time
+import base64
+import shutil
+import argparse
+import datetime
+import concurrent.futures
+
+from PIL import Image, ImageOps
+
+import storage
+import thumbnails
+from image_cache import encode_jpeg
+from embedding_index import atomic_write, pack_json_dir, LEGACY_EMBED_SIZE
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+ASSETS_DIR = os.path.join(BASE_DIR, "assets")
+DEFAULT_ROOT = os.path.join(ASSETS_DIR, "数据库")
+STORE_DIR = os.path.join(BASE_DIR, "database")  # embedding 打包目录（ark1 的 EMBED_STORE_DIR）
+EMBED_DIR = os.path.join(STORE_DIR, "embeddings_output")
+IVF_DIR = os.path.join(STORE_DIR, "ivf")
+WORK_DIR_NAME = ".convert"  # 清单与暂存 / 回收目录，与图库同一文件系统，改名是原子的（已在 .gitignore 中）
+MANIFEST_NAME = "manifest.json"  # 位于 WORK_DIR_NAME 下
+LEGACY_MANIFEST_NAME = ".convert_manifest.json"  # 旧版放在图库根目录，首次运行时移入 WORK_DIR_NAME
+QUALITY = 95
+NAME_DIGITS = 3
+CANONICAL_NAME = re.compile(r"^\d+\.jpg$")
+MANIFEST_SAVE_EVERY = 50  # embedding 阶段每完成这么多张保存一次清单
+
+# 与 ark1.generate_embedding 保持一致，库内向量与查询向量才可比
+EMBED_MODEL = "doubao-embedding-vision-250615"
+EMBED_MAX_SIZE = 1024
+EMBED_QUALITY = 85
+EMBED_LEGACY_SIZE = LEGACY_EMBED_SIZE  # 清单里不带尺寸的 embedded 记录都是按这个尺寸算的
+ARK_BASE_URL = os.environ.get("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
+
+
+def log(message):
+    print(f"[{datetime.datetime.now().isoformat()}] {message}")
+
+
+# ---------- 进程池任务（顶层函数，可被 pickle） ----------
+def convert_file(source, staged, quality):
+    """把 source 转成 RGB JPEG 写到 staged（按 EXIF 方向摆正），返回输出的 sha256"""
+    os.makedirs(os.path.dirname(staged), exist_ok=True)
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")  # 转成 RGB，避免 PNG 透明层报错
+        tmp = storage.temp_path_for(staged)
+        try:
+            img.save(tmp, "JPEG", quality=quality)
+            os.replace(tmp, staged)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return storage.file_sha256(staged)
+
+
+def inspect_file(path):
+    """已是编号名、但清单里没有的文件：是 RGB JPEG 就直接收录（返回 sha256），否则返回 None 需要转换"""
+    with Image.open(path) as img:
+        if img.format != "JPEG" or img.mode != "RGB":
+            return None
+    return storage.file_sha256(path)
+
+
+def make_thumbnails(path, widths):
+    for width in widths:
+        thumbnails.get_derivative(path, width)
+
+
+# ---------- 清单 ----------
+class Manifest:
+    """
+    {"folders": {景点: {"files": {NNN.jpg: 记录}, "journal": 日志或 null}}}
+    记录：size / mtime_ns / sha256 / source（原文件名）/ embedding（JSON 文件名）/ embedded（计算时的 sha256，
+    EMBED_MAX_SIZE 不是 EMBED_LEGACY_SIZE 时带上 @尺寸，改尺寸后会重新计算）
+    日志：{"state": "converting" | "committing" | "renaming", "entries": [{"source", "target"}]}
+    """
+
+    def __init__(self, root):
+        work_dir = os.path.join(root, WORK_DIR_NAME)
+        self.path = os.path.join(work_dir, MANIFEST_NAME)
+        legacy = os.path.join(root, LEGACY_MANIFEST_NAME)
+        if os.path.exists(legacy) and not os.path.exists(self.path):
+            os.makedirs(work_dir, exist_ok=True)
+            os.replace(legacy, self.path)
+        self.data = {"folders": {}}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def folder(self, name):
+        return self.data["folders"].setdefault(name, {"files": {}, "journal": None})
+
+    def save(self):
+        body = json.dumps(self.data, ensure_ascii=False, indent=1).encode("utf-8")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write(self.path, lambda f: f.write(body))
+
+
+def stat_matches(record, st):
+    return record.get("size") == st.st_size and record.get("mtime_ns") == st.st_mtime_ns
+
+
+def embed_marker(sha256):
+    """清单里 embedded 字段的取值：内容哈希 + 计算时的输入尺寸（旧尺寸不带后缀，兼容已有清单）"""
+    return sha256 if EMBED_MAX_SIZE == EMBED_LEGACY_SIZE else f"{sha256}@{EMBED_MAX_SIZE}"
+
+
+def file_record(path, sha256, source, previous=None):
+    st = os.stat(path)
+    record = dict(previous or {})
+    record.update(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=sha256, source=source)
+    return record
+
 
-# 根目录
-base_dir = "/Users/sixteendog/Downloads/数据库"
+class Converter:
+    def __init__(self, root, args):
+        self.root = os.path.abspath(root)
+        self.args = args
+        self.manifest = Manifest(self.root)
+        self.work_dir = os.path.join(self.root, WORK_DIR_NAME)
+        self.embeddings_changed = False
 
-# 遍历子文件夹
-for folder in os.listdir(base_dir):
-    folder_path = os.path.join(base_dir, folder)
-    if os.path.isdir(folder_path):  # 确保是文件夹
-        files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
+    def staged_path(self, folder, target):
+        return os.path.join(self.work_dir, "staged", folder, target)
 
-        # 排序，保证顺序稳定
-        files.sort()
+    def trash_path(self, folder, source):
+        return os.path.join(self.work_dir, "trash", folder, source)
 
-        for i, filename in enumerate(files, start=1):
-            old_path = os.path.join(folder_path, filename)
+    def folders(self):
+        return sorted(
+            name for name in os.listdir(self.root)
+            if not name.startswith(".") and os.path.isdir(os.path.join(self.root, name))
+        )
 
+    # ---------- 崩溃恢复 ----------
+    def recover(self):
+        for folder, state in self.manifest.data["folders"].items():
+            journal = state.get("journal")
+            if not journal:
+                continue
+            if journal["state"] == "converting":
+                # 原文件都还在原处，丢弃暂存结果，本次重新规划
+                log(f"{folder}: 上次转换未完成，丢弃暂存文件")
+                shutil.rmtree(os.path.join(self.work_dir, "staged", folder), ignore_errors=True)
+                state["journal"] = None
+            else:
+                log(f"{folder}: 上次改名未完成（{journal['state']}），继续")
+                self.commit(folder)
+        self.manifest.save()
+
+    # ---------- 规划 ----------
+    def scan(self, folder):
+        """返回 (待确认的编号名文件, 待转换 [(source, target 或 None)], 清单中有但已删除的文件)"""
+        folder_dir = os.path.join(self.root, folder)
+        records = self.manifest.folder(folder)["files"]
+        names = sorted(
+            name for name in os.listdir(folder_dir)
+            if not name.startswith(".") and os.path.isfile(os.path.join(folder_dir, name))
+        )
+        unknown, pending = [], []
+        for name in names:
+            record = records.get(name)
+            if record is not None:
+                if not stat_matches(record, os.stat(os.path.join(folder_dir, name))):
+                    pending.append((name, name))  # 原编号的图片被替换，原地重新转换
+            elif CANONICAL_NAME.match(name):
+                unknown.append(name)
+            else:
+                pending.append((name, None))
+        return unknown, pending, [n for n in records if n not in names]
+
+    def forget(self, folder, name):
+        record = self.manifest.folder(folder)["files"].pop(name)
+        log(f"{folder}/{name}: 文件已删除，移出清单")
+        thumbnails.remove_derivatives(os.path.join(self.root, folder, name))
+        if record.get("embedding"):
             try:
-                # 打开图片
-                img = Image.open(old_path).convert("RGB")  # 转成 RGB，避免 PNG 透明层报错
-                new_name = f"{i:03d}.jpg"
-                new_path = os.path.join(folder_path, new_name)
+                os.remove(os.path.join(EMBED_DIR, record["embedding"]))
+                self.embeddings_changed = True
+            except FileNotFoundError:
+                pass
 
-                # 保存为 JPG
-                img.save(new_path, "JPEG", quality=95)
+    def plan(self, pool):
+        """规划每个目录的转换：收录已是 RGB JPEG 的编号图，其余分配编号；返回 {folder: [entry]}"""
+        unknown_by_folder, pending_by_folder = {}, {}
+        for folder in self.folders():
+            unknown_by_folder[folder], pending_by_folder[folder], removed = self.scan(folder)
+            for name in removed:
+                if self.args.dry_run:
+                    log(f"计划: {folder}/{name} 已删除，移出清单")
+                else:
+                    self.forget(folder, name)
 
-                # 删除原文件（避免堆积不同格式）
-                if old_path != new_path:
-                    os.remove(old_path)
+        for folder in [f for f in self.manifest.data["folders"] if f not in unknown_by_folder]:
+            for name in list(self.manifest.folder(folder)["files"]):
+                if self.args.dry_run:
+                    log(f"计划: {folder}/{name} 已删除，移出清单")
+                else:
+                    self.forget(folder, name)
 
-                print(f"{folder} : {filename} -> {new_name}")
+        inspections = {
+            pool.submit(inspect_file, os.path.join(self.root, folder, name)): (folder, name)
+            for folder, names in unknown_by_folder.items() for name in names
+        }
+        for future in concurrent.futures.as_completed(inspections):
+            folder, name = inspections[future]
+            try:
+                sha256 = future.result()
+            except Exception as e:
+                log(f"{folder}/{name}: 无法读取，跳过（{e}）")
+                continue
+            if sha256 is None:
+                pending_by_folder[folder].append((name, name))
+                continue
+            if not self.args.dry_run:
+                path = os.path.join(self.root, folder, name)
+                self.manifest.folder(folder)["files"][name] = file_record(path, sha256, name)
 
+        plans = {}
+        for folder, pending in pending_by_folder.items():
+            if not pending:
+                continue
+            records = self.manifest.folder(folder)["files"]
+            # 所有已存在的编号名都算占用，包括无法读取（损坏、以 .jpg 命名的 HEIC 等）而未收录的文件
+            used = {int(n.split(".")[0]) for n in set(records) | set(unknown_by_folder[folder])}
+            used.update(int(t.split(".")[0]) for _, t in pending if t)
+            next_number = max(used, default=0) + 1
+            entries = []
+            for source, target in sorted(pending, key=lambda p: p[0]):
+                if target is None:
+                    target = f"{next_number:0{NAME_DIGITS}d}.jpg"
+                    next_number += 1
+                entries.append({"source": source, "target": target})
+            plans[folder] = entries
+        return plans
+
+    # ---------- 转换与提交 ----------
+    def convert(self, pool, plans):
+        """并行转换到暂存目录；失败的条目从计划中去掉（原文件保持不动）"""
+        for folder, entries in plans.items():
+            self.manifest.folder(folder)["journal"] = {"state": "converting", "entries": entries}
+        self.manifest.save()
+
+        futures = {}
+        for folder, entries in plans.items():
+            for entry in entries:
+                source = os.path.join(self.root, folder, entry["source"])
+                staged = self.staged_path(folder, entry["target"])
+                futures[pool.submit(convert_file, source, staged, self.args.quality)] = (folder, entry)
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            folder, entry = futures[future]
+            done += 1
+            try:
+                entry["sha256"] = future.result()
+                log(f"[{done}/{len(futures)}] {folder} : {entry['source']} -> {entry['target']}")
+            except Exception as e:
+                entry["error"] = str(e)
+                log(f"[{done}/{len(futures)}] 转换失败: {folder}/{entry['source']}，错误: {e}")
+
+        for folder, entries in plans.items():
+            journal = self.manifest.folder(folder)["journal"]
+            journal["entries"] = [e for e in entries if "error" not in e]
+            journal["state"] = "committing"
+            self.manifest.save()
+            self.commit(folder)
+        self.manifest.save()
+
+    def commit(self, folder):
+        """
+        日志驱动的改名，可重复执行：
+          committing：原文件全部移入回收目录（此时还没有任何目标名被占用，原处的文件一定是原文件）
+          renaming：暂存文件逐个改名到目标编号
+        完成后更新清单记录、清空回收目录与日志。
+        """
+        state = self.manifest.folder(folder)
+        journal = state["journal"]
+        folder_dir = os.path.join(self.root, folder)
+        if journal["state"] == "committing":
+            kept = []
+            for entry in journal["entries"]:
+                if entry["source"] != entry["target"] and os.path.exists(os.path.join(folder_dir, entry["target"])):
+                    log(f"{folder}/{entry['target']}: 目标已存在且不是 {entry['source']} 本身，拒绝覆盖，跳过")
+                    continue
+                kept.append(entry)
+            journal["entries"] = kept
+            for entry in journal["entries"]:
+                source = os.path.join(folder_dir, entry["source"])
+                trash = self.trash_path(folder, entry["source"])
+                if os.path.exists(source) and not os.path.exists(trash):
+                    os.makedirs(os.path.dirname(trash), exist_ok=True)
+                    os.replace(source, trash)
+            journal["state"] = "renaming"
+            self.manifest.save()
+
+        records = state["files"]
+        for entry in journal["entries"]:
+            staged = self.staged_path(folder, entry["target"])
+            target = os.path.join(folder_dir, entry["target"])
+            if os.path.exists(staged):
+                if entry["source"] != entry["target"] and os.path.exists(target):
+                    # 不应发生（committing 阶段已检查）：把原文件从回收目录放回原处，不覆盖目标
+                    trash = self.trash_path(folder, entry["source"])
+                    if os.path.exists(trash):
+                        os.replace(trash, os.path.join(folder_dir, entry["source"]))
+                    log(f"{folder}/{entry['target']}: 目标已存在，拒绝覆盖，{entry['source']} 保持不动")
+                    continue
+                os.replace(staged, target)
+            if os.path.exists(target):
+                sha256 = entry.get("sha256") or storage.file_sha256(target)
+                records[entry["target"]] = file_record(target, sha256, entry["source"], records.get(entry["target"]))
+        state["journal"] = None
+        self.manifest.save()
+        shutil.rmtree(os.path.join(self.work_dir, "trash", folder), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.work_dir, "staged", folder), ignore_errors=True)
+
+    # ---------- 缩略图 ----------
+    def thumbnails(self, pool):
+        widths = self.args.thumb_widths
+        futures = {
+            pool.submit(make_thumbnails, os.path.join(self.root, folder, name), widths): f"{folder}/{name}"
+            for folder, state in self.manifest.data["folders"].items() for name in state["files"]
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
             except Exception as e:
-                print(f"❌ 转换失败: {old_path}, 错误: {e}")
+                log(f"缩略图生成失败: {futures[future]}，错误: {e}")
+        log(f"缩略图已就绪: {len(futures)} 张，宽度 {widths}")
+
+    # ---------- embedding ----------
+    def catalogue_path(self, folder, name):
+        """embedding 里记录的 path：database/<相对 assets 的路径>，ark1 据此映射回 assets 中的原图"""
+        rel = os.path.relpath(os.path.join(self.root, folder, name), ASSETS_DIR)
+        if rel.startswith(".."):
+            raise SystemExit(f"--embed 要求图库位于 {ASSETS_DIR} 之下")
+        return "/".join(["database"] + rel.split(os.sep))
+
+    def adopt_legacy_embeddings(self):
+        """清单里还没有 embedding 记录时，收录 embeddings_output 里已有的同 path 文件（视为对应当前内容）"""
+        missing = {
+            self.catalogue_path(folder, name): record
+            for folder, state in self.manifest.data["folders"].items()
+            for name, record in state["files"].items() if "embedding" not in record
+        }
+        if not missing or not os.path.isdir(EMBED_DIR):
+            return
+        for filename in os.listdir(EMBED_DIR):
+            if not filename.endswith(".json"):
+                continue
+            with open(os.path.join(EMBED_DIR, filename), encoding="utf-8") as f:
+                record = missing.get(json.load(f).get("path"))
+            if record is not None:
+                record["embedding"] = filename
+                record["embedded"] = record["sha256"]  # 旧文件按 EMBED_LEGACY_SIZE 计算
+
+    def embed(self):
+        from volcenginesdkarkruntime import Ark
+        from ark_pool import KeyPool
+
+        api_key = os.environ.get("ARK_API_KEY_V")
+        if not api_key:
+            raise SystemExit("请先在环境变量 ARK_API_KEY_V 中设置 API key for embedding")
+        client = Ark(base_url=os.environ.get("ARK_BASE_URL_V", ARK_BASE_URL), api_key=api_key, max_retries=0)
+        pool = KeyPool([api_key], name="embedding")
+        os.makedirs(EMBED_DIR, exist_ok=True)
+        self.adopt_legacy_embeddings()
+
+        todo = [
+            (folder, name, record)
+            for folder, state in self.manifest.data["folders"].items()
+            for name, record in state["files"].items() if record.get("embedded") != embed_marker(record["sha256"])
+        ]
+
+        def run(item):
+            folder, name, record = item
+            with open(os.path.join(self.root, folder, name), "rb") as f:
+                image = base64.b64encode(encode_jpeg(f.read(), EMBED_MAX_SIZE, EMBED_QUALITY)).decode("utf-8")
+            resp = pool.call(lambda _: client.multimodal_embeddings.create(
+                model=EMBED_MODEL,
+                encoding_format="float",
+                input=[
+                    {"text": "Image embedding", "type": "text"},
+                    {"image_url": {"url": "data:image/jpeg;base64," + image}, "type": "image_url"},
+                ],
+            ))
+            filename = record.get("embedding") or f"{folder}_{os.path.splitext(name)[0]}_embedding.json"
+            body = json.dumps({"path": self.catalogue_path(folder, name), "embedding": resp.data.embedding,
+                               "embed_size": EMBED_MAX_SIZE}, ensure_ascii=False).encode("utf-8")
+            atomic_write(os.path.join(EMBED_DIR, filename), lambda f: f.write(body))
+            return filename
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.embed_workers) as executor:
+            futures = {executor.submit(run, item): item for item in todo}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                folder, name, record = futures[future]
+                try:
+                    record["embedding"] = future.result()
+                    record["embedded"] = embed_marker(record["sha256"])
+                    self.embeddings_changed = True
+                except Exception as e:
+                    log(f"embedding 失败: {folder}/{name}，错误: {e}")
+                if done % MANIFEST_SAVE_EVERY == 0:
+                    self.manifest.save()
+        self.manifest.save()
+        log(f"embedding 已更新: {len(todo)} 张")
+
+    def repack(self):
+        count, shape = pack_json_dir(EMBED_DIR, STORE_DIR)
+        log(f"已重新打包 {count} 条 embedding，矩阵 {shape} -> {STORE_DIR}")
+        import descriptors
+        descriptors.main(["--store-dir", STORE_DIR, "--embed-dir", EMBED_DIR])
+        if os.path.exists(IVF_DIR):
+            import ann_index
+            ann_index.main(["--ivf-dir", IVF_DIR])
+
+    # ---------- 主流程 ----------
+    def run(self):
+        start = time.time()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.args.workers) as pool:
+            if not self.args.dry_run:
+                self.recover()
+            plans = self.plan(pool)
+            total = sum(len(entries) for entries in plans.values())
+            for folder, entries in plans.items():
+                for entry in entries:
+                    log(f"计划: {folder} : {entry['source']} -> {entry['target']}")
+            if self.args.dry_run:
+                log(f"共 {total} 个文件待转换（dry run，未做任何修改）")
+                return
+            if plans:
+                self.convert(pool, plans)
+            self.manifest.save()
+            if self.args.thumb_widths:
+                self.thumbnails(pool)
+        if self.args.embed:
+            self.embed()
+        if self.embeddings_changed or self.args.repack:
+            self.repack()
+        log(f"全部完成：转换 {total} 个文件，耗时 {time.time() - start:.1f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="图库根目录（其下每个子目录一个景点）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="转换进程数")
+    parser.add_argument("--quality", type=int, default=QUALITY)
+    parser.add_argument("--thumb-widths", type=int, nargs="*", default=list(thumbnails.PREWARM_WIDTHS),
+                        help="预生成的缩略图宽度，不带值表示不生成")
+    parser.add_argument("--embed", action="store_true", help="为新增 / 变化的图片计算 embedding")
+    parser.add_argument("--embed-workers", type=int, default=4, help="并发 embedding 请求数")
+    parser.add_argument("--repack", action="store_true", help="即使没有变化也重新打包 embedding 库")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+    Converter(args.root, args).run()
+    return 0
+
 
-print("✅ 全部转换并重命名完成！")
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+图库（assets）图片的本地廉价描述子，tuijian 在调用远端 embedding 之前 / 远端太慢时使用：
+  - 8x8 缩略图（RGB，减去均值后 L2 归一化）：构图与明暗分布
+  - HSV 颜色直方图（8x4x4，开方后 L2 归一化）：整体色调
+两部分等权拼接后再归一化，余弦相似度即两部分相似度的平均。一张图只需几毫秒，检索是一次矩阵-向量乘法。
+
+打包格式与 embedding 库放在一起（database/），行顺序与 embeddings_paths.json 一致：
+  descriptors.npy + descriptors_meta.json（条数与 path 列表指纹，与向量库不一致时重建）
+
+用法：
+  python descriptors.py            # 为 database/ 下的向量库（重新）生成描述子
+"""
+import os
+import sys
+import json
+import argparse
+import datetime
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from embedding_index import EmbeddingIndex, atomic_write, paths_fingerprint
+
+TINY_SIZE = 8
+HIST_BINS = (8, 4, 4)  # H / S / V
+WORK_SIZE = 64  # 先缩到这么大再算缩略图与直方图
+PACKED_DESCRIPTORS = "descriptors.npy"
+DESCRIPTORS_META = "descriptors_meta.json"
+DIM = TINY_SIZE * TINY_SIZE * 3 + int(np.prod(HIST_BINS))
+
+
+def log(message):
+    print(f"[{datetime.datetime.now().isoformat()}] {message}")
+
+
+def describe(path):
+    """图片的描述子（float32，L2 归一化，长度 DIM）"""
+    with Image.open(path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (WORK_SIZE * 2, WORK_SIZE * 2))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    work = img.resize((WORK_SIZE, WORK_SIZE), Image.BILINEAR, reducing_gap=2.0)
+
+    tiny = np.asarray(work.resize((TINY_SIZE, TINY_SIZE), Image.BOX), dtype=np.float32).ravel() / 255.0
+    tiny -= tiny.mean()
+
+    hsv = np.asarray(work.convert("HSV"), dtype=np.int32).reshape(-1, 3)
+    bins = np.array(HIST_BINS)
+    cells = (hsv * bins // 256) @ np.array([HIST_BINS[1] * HIST_BINS[2], HIST_BINS[2], 1])
+    hist = np.sqrt(np.bincount(cells, minlength=int(np.prod(bins))).astype(np.float32) / len(cells))
+
+    parts = [EmbeddingIndex.normalize(tiny), EmbeddingIndex.normalize(hist)]
+    return (np.concatenate(parts) / np.sqrt(len(parts))).astype(np.float32)
+
+
+def asset_path(catalogue_path):
+    """向量库里记录的 path（database/...）对应的 assets 原图"""
+    return catalogue_path.replace("database", "assets", 1)
+
+
+class DescriptorIndex:
+    """与 EmbeddingIndex 按行对齐的描述子矩阵：search 返回 [(行号, 相似度)]，按相似度降序"""
+
+    def __init__(self, matrix):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def search(self, descriptor, k=4):
+        if len(self) == 0:
+            return []
+        scores = self.matrix @ descriptor
+        k = min(k, len(self))
+        top = np.argpartition(scores, -k)[-k:] if k < len(self) else np.arange(len(self))
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(i), float(scores[i])) for i in top]
+
+    @classmethod
+    def build(cls, paths, resolve=asset_path):
+        """逐张计算描述子；原图缺失或无法解码的行为零向量（相似度恒为 0）"""
+        matrix = np.zeros((len(paths), DIM), dtype=np.float32)
+        missing = 0
+        for i, path in enumerate(paths):
+            try:
+                matrix[i] = describe(resolve(path))
+            except (OSError, ValueError):
+                missing += 1
+        if missing:
+            log(f"描述子: {missing} 张原图缺失或无法解码")
+        return cls(matrix)
+
+    def save(self, store_dir, paths):
+        atomic_write(os.path.join(store_dir, PACKED_DESCRIPTORS), lambda f: np.save(f, self.matrix))
+        meta = {"n": len(paths), "paths": paths_fingerprint(paths)}
+        atomic_write(os.path.join(store_dir, DESCRIPTORS_META), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    @classmethod
+    def load(cls, store_dir, paths):
+        """加载打包的描述子；不存在或与向量库不一致时返回 None"""
+        try:
+            with open(os.path.join(store_dir, DESCRIPTORS_META), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["n"] != len(paths) or meta["paths"] != paths_fingerprint(paths):
+                return None
+            matrix = np.load(os.path.join(store_dir, PACKED_DESCRIPTORS), mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+        return cls(matrix) if matrix.shape == (len(paths), DIM) else None
+
+    @classmethod
+    def load_or_build(cls, store_dir, paths, save=True):
+        index = cls.load(store_dir, paths)
+        if index is None:
+            log(f"描述子缺失或已过期，重新生成 {len(paths)} 条")
+            index = cls.build(paths)
+            if save and paths:
+                index.save(store_dir, paths)
+        return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store-dir", default="database", help="打包后的向量库目录")
+    parser.add_argument("--embed-dir", default=os.path.join("database", "embeddings_output"))
+    args = parser.parse_args(argv)
+
+    base = EmbeddingIndex.load(args.store_dir, args.embed_dir)
+    index = DescriptorIndex.build(base.paths)
+    index.save(args.store_dir, base.paths)
+    log(f"描述子已写入 {args.store_dir}: {len(index)} 条 x {DIM} 维")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
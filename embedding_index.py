@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+
+# 打包格式：一个行归一化后的矩阵（.npy，可 memmap）+ 一个 path 列表 + 元数据（计算 embedding 时的输入尺寸）
+PACKED_MATRIX = "embeddings.npy"
+PACKED_PATHS = "embeddings_paths.json"
+PACKED_META = "embeddings_meta.json"
+LEGACY_EMBED_SIZE = 1024  # 没有记录尺寸的 embedding（旧 JSON 文件 / 旧打包文件）都是按这个尺寸算的
+SCORE_CHUNK_ROWS = 65536  # float16 矩阵分块升精度计算，避免整块拷贝
+
+
+class EmbeddingIndex:
+    """
+    常驻内存的 embedding 索引：
+      - 启动时一次性加载全部向量，存为连续的 float32 矩阵
+      - 加载时即做 L2 归一化，查询只需一次矩阵-向量乘法
+      - top-k 用 argpartition 选取，无需对全部相似度排序
+    embed_size 为计算这些向量时图片的最长边（各条不一致时为 None），只有同一尺寸的查询向量才可比。
+    """
+
+    def __init__(self, paths, matrix, embed_size=LEGACY_EMBED_SIZE):
+        self.paths = list(paths)
+        self.embed_size = embed_size
+        matrix = np.asarray(matrix)
+        if matrix.dtype not in (np.float32, np.float16):
+            matrix = matrix.astype(np.float32)
+        # memmap 且已连续时不做拷贝（零拷贝加载）
+        self.matrix = matrix if matrix.flags.c_contiguous else np.ascontiguousarray(matrix)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def normalize(matrix):
+        """按行 L2 归一化，零向量保持为零（相似度恒为 0）"""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    @classmethod
+    def from_json_dir(cls, embed_dir):
+        """从 embeddings_output 目录下的 JSON 文件构建索引"""
+        paths = []
+        vectors = []
+        sizes = set()
+        for filename in sorted(os.listdir(embed_dir)):
+            if not filename.endswith(".json"):
+                continue
+            with open(os.path.join(embed_dir, filename), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            paths.append(data["path"])
+            vectors.append(data["embedding"])
+            sizes.add(data.get("embed_size", LEGACY_EMBED_SIZE))
+        embed_size = sizes.pop() if len(sizes) == 1 else (LEGACY_EMBED_SIZE if not sizes else None)
+        if not vectors:
+            return cls([], np.zeros((0, 0), dtype=np.float32), embed_size)
+        return cls(paths, cls.normalize(np.array(vectors, dtype=np.float32)), embed_size)
+
+    @classmethod
+    def from_packed(cls, store_dir):
+        """以 memmap 方式零拷贝加载打包好的矩阵"""
+        matrix = np.load(os.path.join(store_dir, PACKED_MATRIX), mmap_mode="r")
+        with open(os.path.join(store_dir, PACKED_PATHS), "r", encoding="utf-8") as f:
+            paths = json.load(f)
+        if len(paths) != matrix.shape[0]:
+            raise ValueError(f"打包文件不一致: {len(paths)} 个 path, {matrix.shape[0]} 行向量")
+        embed_size = LEGACY_EMBED_SIZE
+        meta_path = os.path.join(store_dir, PACKED_META)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                embed_size = json.load(f).get("embed_size")
+        return cls(paths, matrix, embed_size)
+
+    @classmethod
+    def load(cls, store_dir, embed_dir):
+        """优先加载打包格式，不存在时回退到逐个解析 JSON"""
+        if has_packed(store_dir):
+            return cls.from_packed(store_dir)
+        return cls.from_json_dir(embed_dir)
+
+    def scores(self, query):
+        """返回 query 与所有向量的余弦相似度"""
+        q = self.normalize(np.asarray(query, dtype=np.float32).ravel())
+        if self.matrix.dtype == np.float32:
+            return self.matrix @ q
+        out = np.empty(len(self.paths), dtype=np.float32)
+        for start in range(0, len(self.paths), SCORE_CHUNK_ROWS):
+            block = self.matrix[start:start + SCORE_CHUNK_ROWS]
+            np.dot(block.astype(np.float32), q, out=out[start:start + len(block)])
+        return out
+
+    def search(self, query, k=4):
+        """
+        返回与 query 余弦相似度最高的 k 个结果：[(path, sim), ...]，按相似度降序。
+        """
+        n = len(self.paths)
+        if n == 0:
+            return []
+        scores = self.scores(query)
+
+        k = min(k, n)
+        if k < n:
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(n)
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(self.paths[i], float(scores[i])) for i in top]
+
+
+def paths_fingerprint(paths):
+    """path 列表（含顺序）的指纹，与向量库按行对齐的派生文件（描述子、IVF 索引）据此判断是否过期"""
+    return hashlib.sha1("\n".join(paths).encode("utf-8")).hexdigest()
+
+
+def has_packed(store_dir):
+    return (os.path.exists(os.path.join(store_dir, PACKED_MATRIX))
+            and os.path.exists(os.path.join(store_dir, PACKED_PATHS)))
+
+
+def atomic_write(path, write):
+    """写临时文件后 rename，避免 worker 读到写了一半的文件"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def pack_json_dir(embed_dir, store_dir, dtype="float32"):
+    """
+    把 embeddings_output 下的 JSON 文件转换为打包格式：
+      - {store_dir}/embeddings.npy: 行归一化后的 float32/float16 矩阵
+      - {store_dir}/embeddings_paths.json: 与矩阵行一一对应的 path 列表
+      - {store_dir}/embeddings_meta.json: {"embed_size": 输入尺寸}，JSON 里的尺寸不一致时为 null
+    """
+    index = EmbeddingIndex.from_json_dir(embed_dir)
+    matrix = index.matrix.astype(dtype)
+    os.makedirs(store_dir, exist_ok=True)
+    atomic_write(os.path.join(store_dir, PACKED_MATRIX), lambda f: np.save(f, matrix))
+    atomic_write(
+        os.path.join(store_dir, PACKED_PATHS),
+        lambda f: f.write(json.dumps(index.paths, ensure_ascii=False).encode("utf-8")),
+    )
+    atomic_write(
+        os.path.join(store_dir, PACKED_META),
+        lambda f: f.write(json.dumps({"embed_size": index.embed_size}).encode("utf-8")),
+    )
+    if index.embed_size is None:
+        print(f"警告: {embed_dir} 中的 embedding 输入尺寸不一致，查询向量将无法与库比较，请用同一尺寸重新计算")
+    return len(index.paths), matrix.shape
+
+
+def main(argv=None):
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description="把 JSON embedding 文件打包为 .npy 矩阵 + path 列表")
+    parser.add_argument("--embed-dir", default=os.path.join(base_dir, "database", "embeddings_output"))
+    parser.add_argument("--store-dir", default=os.path.join(base_dir, "database"))
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    args = parser.parse_args(argv)
+
+    count, shape = pack_json_dir(args.embed_dir, args.store_dir, dtype=args.dtype)
+    print(f"已打包 {count} 条 embedding，矩阵 {shape} {args.dtype} -> {args.store_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import os
+import time
+import sqlite3
+import threading
+import storage
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif')
+INDEX_FILE = ".index.sqlite"
+FULL_SCAN_INTERVAL = 600  # 秒，即使目录 mtime 未变，也每隔这么久重新扫描一次用户目录兜底
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (user, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (
+    user TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    dir_mtime_ns INTEGER NOT NULL,
+    scanned_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def listed(name, exts=IMAGE_EXTS):
+    """是否出现在列表里：隐藏文件（写入中的临时文件）不列出"""
+    return not name.startswith('.') and name.lower().endswith(exts)
+
+
+class GalleryIndex:
+    """
+    某个图库根目录（moved / xiangao / background_person）下按用户的文件索引，存于 {root}/.index.sqlite（WAL）：
+      - app 与 worker 写入 / 删除文件后调用 add / remove，索引即时更新
+      - 列表请求只 stat 用户目录及其分片目录：最大 mtime 与索引记录不一致（有未经通知的改动）时重新扫描
+      - 文件按文件名索引，不论位于分片目录（{user}/{分片}/{name}）还是迁移前的平铺位置；
+        传入 archive（blob_pack.BlobArchive）时，已归档进段文件的文件也算在内
+      - 每次内容变化分配新的 generation（纳秒时间戳，索引重建后也不会与旧值重复），用作 ETag
+      - page() 按文件名倒序，基于 (user, name) 主键做游标分页，代价与页大小成正比
+    """
+
+    def __init__(self, root, exts=IMAGE_EXTS, archive=None):
+        self.root = root
+        self.exts = exts
+        self.archive = archive
+        self.db_path = os.path.join(root, INDEX_FILE)
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _new_generation(old=None):
+        gen = time.time_ns()
+        return max(gen, old + 1) if old is not None else gen
+
+    def _dir_mtime_ns(self, user):
+        return storage.user_dir_signature(os.path.join(self.root, user))
+
+    def _touch(self, conn, user, changed):
+        """记录当前目录 mtime；changed 时换新的 generation"""
+        row = conn.execute("SELECT generation FROM users WHERE user = ?", (user,)).fetchone()
+        if row is None:
+            # 该用户还没扫描过：目录里可能已有未入索引的文件，mtime 记为 -1 让下次 sync 全量扫描
+            gen, mtime_ns = self._new_generation(), -1
+        else:
+            gen = self._new_generation(row[0]) if changed else row[0]
+            mtime_ns = self._dir_mtime_ns(user)
+        conn.execute(
+            "INSERT INTO users (user, generation, dir_mtime_ns, scanned_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user) DO UPDATE SET generation = excluded.generation, dir_mtime_ns = excluded.dir_mtime_ns",
+            (user, gen, mtime_ns, time.time()),
+        )
+        return gen
+
+    def add(self, user, name):
+        if not listed(name, self.exts):
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute("INSERT OR IGNORE INTO files (user, name) VALUES (?, ?)", (user, name))
+            self._touch(conn, user, cur.rowcount > 0)
+
+    def remove(self, user, name):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute("DELETE FROM files WHERE user = ? AND name = ?", (user, name))
+            self._touch(conn, user, cur.rowcount > 0)
+
+    def _split(self, path):
+        """{root}/{user}/{分片}/{name} 或 {root}/{user}/{name} -> (user, name)，不是用户文件时返回 None"""
+        parts = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root)).split(os.sep)
+        if parts[0] == os.pardir:
+            return None
+        if len(parts) == 3 and storage.is_shard_dir(parts[1]):
+            return parts[0], parts[2]
+        return (parts[0], parts[1]) if len(parts) == 2 else None
+
+    def add_path(self, path):
+        key = self._split(path)
+        if key:
+            self.add(*key)
+
+    def remove_path(self, path):
+        key = self._split(path)
+        if key:
+            self.remove(*key)
+
+    def sync(self, user):
+        """目录有未经通知的改动（或距上次全量扫描过久）时重新扫描，返回当前 generation"""
+        conn = self._conn()
+        mtime_ns = self._dir_mtime_ns(user)
+        row = conn.execute("SELECT generation, dir_mtime_ns, scanned_at FROM users WHERE user = ?", (user,)).fetchone()
+        if row and row[1] == mtime_ns and time.time() - row[2] < FULL_SCAN_INTERVAL:
+            return row[0]
+
+        names = {name for name, _ in storage.scan_user_dir(os.path.join(self.root, user)) if listed(name, self.exts)}
+        if self.archive is not None:
+            names.update(n for n in self.archive.names(os.path.basename(os.path.normpath(self.root)), user)
+                         if listed(n, self.exts))
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            indexed = {r[0] for r in conn.execute("SELECT name FROM files WHERE user = ?", (user,))}
+            added, removed = names - indexed, indexed - names
+            conn.executemany("INSERT INTO files (user, name) VALUES (?, ?)", [(user, n) for n in added])
+            conn.executemany("DELETE FROM files WHERE user = ? AND name = ?", [(user, n) for n in removed])
+            if row is None:
+                gen = self._new_generation()
+            else:
+                gen = self._new_generation(row[0]) if (added or removed) else row[0]
+            conn.execute(
+                "INSERT INTO users (user, generation, dir_mtime_ns, scanned_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user) DO UPDATE SET generation = excluded.generation, "
+                "dir_mtime_ns = excluded.dir_mtime_ns, scanned_at = excluded.scanned_at",
+                (user, gen, mtime_ns, time.time()),
+            )
+        return gen
+
+    def page(self, user, limit=None, after=None):
+        """
+        按文件名倒序返回一页文件名：after 为上一页最后一个文件名（游标）。
+        返回 (names, next_cursor)，没有更多时 next_cursor 为 None；limit 为 None 时返回全部。
+        """
+        sql = "SELECT name FROM files WHERE user = ?"
+        args = [user]
+        if after is not None:
+            sql += " AND name < ?"
+            args.append(after)
+        sql += " ORDER BY name DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit + 1)
+        names = [r[0] for r in self._conn().execute(sql, args)]
+        if limit is not None and len(names) > limit:
+            names = names[:limit]
+            return names, names[-1]
+        return names, None
@@ -0,0 +1,131 @@
+import io
+import base64
+import hashlib
+import threading
+import collections
+from PIL import Image
+
+EXIF_ORIENTATION = 0x0112
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+JPEG_SOS = 0xDA  # 扫描数据开始，之后是压缩数据
+# 发往远端前去掉的 JPEG 段：APP1（EXIF / XMP，可能含 GPS）、APP13（IPTC）、COM（注释）；
+# APP0（JFIF）、APP2（ICC 色彩配置）、APP14（Adobe 色彩变换）影响解码，保留
+METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+
+
+def strip_jpeg_metadata(data):
+    """
+    去掉 JPEG 中的元数据段（METADATA_MARKERS），其余字节（含压缩数据）原样保留；
+    段结构异常时返回 None，由调用方改为重新编码
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    out = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # 填充字节
+            pos += 1
+            continue
+        if marker == JPEG_SOS:
+            out.append(data[pos:])
+            return b"".join(out)
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # 不带长度的标记
+            out.append(data[pos:pos + 2])
+            pos += 2
+            continue
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+        if end <= pos + 3 or end > len(data):
+            return None
+        if marker not in METADATA_MARKERS:
+            out.append(data[pos:end])
+        pos = end
+    return None
+
+
+def encode_jpeg(data, max_size=1024, quality=85):
+    """
+    把原始图片字节压缩为 JPEG 字节：
+      - 最长边限制为 max_size（只缩小，不放大）
+      - 已经是 max_size 以内、无需旋转的 RGB/灰度 JPEG 不重新编码，只去掉 EXIF（可能含 GPS）等元数据段
+    """
+    img = Image.open(io.BytesIO(data))
+    w, h = img.size
+    orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    if img.format == "JPEG" and max(w, h) <= max_size and img.mode in ("RGB", "L") and orientation == 1:
+        stripped = strip_jpeg_metadata(data)
+        if stripped is not None:
+            return stripped
+
+    img = img.convert("RGB")
+    # 等比缩放
+    scale = min(max_size / max(w, h), 1.0)
+    if scale < 1.0:
+        new_w, new_h = int(w * scale), int(h * scale)
+        img = img.resize((new_w, new_h), Image.LANCZOS)
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+class PreparedImageCache:
+    """
+    上传图片预处理结果（缩放 + JPEG + base64）的缓存：
+      - 以文件内容的 sha256 为键，同一张图只解码、缩放、编码一次，多个生成版本 / embedding 共用
+      - LRU 淘汰，总大小不超过 max_bytes
+      - 线程安全；同一张图并发未命中时只有一个线程做预处理，其余等待结果
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> base64 str
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> threading.Event
+        self.hits = 0
+        self.misses = 0
+
+    def get_base64(self, image_path, max_size=1024, quality=85):
+        with open(image_path, "rb") as f:
+            data = f.read()
+        key = (hashlib.sha256(data).hexdigest(), max_size, quality)
+
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key]
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    self.misses += 1
+                    break
+            event.wait()
+
+        try:
+            b64 = base64.b64encode(encode_jpeg(data, max_size, quality)).decode("utf-8")
+            with self._lock:
+                self._put(key, b64)
+            return b64
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _put(self, key, b64):
+        size = len(b64)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = b64
+        self._size += size
+        while self._size > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._size -= len(old)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,388 @@
+import os
+import json
+import time
+import sqlite3
+import datetime
+import threading
+import contextlib
+import collections
+import metrics
+
+MAX_ATTEMPTS = 5  # 超过后任务标记为 failed，不再重试
+RETRY_BASE = 3  # 秒，失败重试的基础间隔，按次数指数增长
+RETRY_MAX = 300
+HEARTBEATS_PER_LEASE = 3  # 执行中的任务每个租约期续约这么多次
+ORPHAN_GRACE = 10  # 秒，上传目录里出现但没有对应任务的文件，等这么久仍无任务才由 worker 自行入队
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    path TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    metadata TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (queue, state, not_before);
+CREATE INDEX IF NOT EXISTS jobs_group ON jobs (queue, grp, state);
+CREATE INDEX IF NOT EXISTS jobs_path ON jobs (queue, path);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (grp, updated_at);
+CREATE TABLE IF NOT EXISTS progress (
+    job_id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    output TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, version)
+) WITHOUT ROWID;
+"""
+
+# seq 索引单独创建：旧库要先补上 seq 列
+SEQ_INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_seq ON jobs (seq);
+CREATE INDEX IF NOT EXISTS jobs_group_seq ON jobs (grp, seq);
+"""
+
+Job = collections.namedtuple("Job", "id queue path metadata attempts created_at")
+
+queue_wait_seconds = metrics.registry.histogram(
+    "job_queue_wait_seconds", "任务从入队（或重新排队）到被领取的等待时间（秒）", ("queue",))
+
+
+def group_of_path(path):
+    """任务分组：相对路径的第一级目录（user_*）"""
+    return path.split(os.sep, 1)[0]
+
+
+class JobQueue:
+    """
+    app 与 ark worker 之间的持久化任务队列（SQLite WAL，多进程共享）：
+      - app 每保存一个上传文件就入队一个任务，任务带上当时的 metadata 快照，不再依赖目录里的 metadata.json
+      - worker 用 claim() 领取任务并获得租约；进程崩溃时租约到期，任务自动回到队列重试
+      - 同一用户（grp）同时持有租约的任务数受 per_group_limit 限制，一个用户的大量任务不会占满 worker
+      - 失败按次数指数退避重试，超过 MAX_ATTEMPTS 标记为 failed
+    path 为相对 worker 上传目录的路径（如 user_7/1700000000000.jpg），app 与 worker 的根目录写法不同也能对上。
+    每次可见的变化（入队、领取、进度、完成 / 失败）都在写事务内给任务分配新的 seq（全库递增），
+    seq 的顺序就是提交顺序，状态接口用它做游标；updated_at 来自各进程的时钟，只用于展示和按时间窗口筛选。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+            conn.executescript(SEQ_INDEXES)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        """旧库补上 seq 列，已有任务按 id 编号"""
+        if any(r[1] == "seq" for r in conn.execute("PRAGMA table_info(jobs)")):
+            return
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if not any(r[1] == "seq" for r in conn.execute("PRAGMA table_info(jobs)")):
+                conn.execute("ALTER TABLE jobs ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+                conn.execute("UPDATE jobs SET seq = id")
+
+    @staticmethod
+    def _next_seq(conn):
+        """下一个变化序号；必须在写事务（BEGIN IMMEDIATE）内调用，这样序号顺序与提交顺序一致"""
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM jobs").fetchone()[0]
+
+    def current_seq(self):
+        """目前为止最后一次变化的序号"""
+        return self._conn().execute("SELECT COALESCE(MAX(seq), 0) FROM jobs").fetchone()[0]
+
+    def enqueue(self, queue, path, metadata=None):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute(
+                "INSERT INTO jobs (queue, path, grp, metadata, not_before, created_at, updated_at, seq) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (queue, path, group_of_path(path),
+                 json.dumps(metadata, ensure_ascii=False) if metadata is not None else None, now, now, now,
+                 self._next_seq(conn)),
+            )
+        return cur.lastrowid
+
+    def has_job(self, queue, path):
+        """该文件是否已有未完成（queued / running / failed）的任务"""
+        row = self._conn().execute(
+            "SELECT 1 FROM jobs WHERE queue = ? AND path = ? AND state != 'done' LIMIT 1", (queue, path)
+        ).fetchone()
+        return row is not None
+
+    def claim(self, queue, worker, lease_seconds, per_group_limit=None):
+        """领取一个可执行的任务（按入队顺序，跳过已达并发上限的用户），没有则返回 None"""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # 租约过期（worker 崩溃 / 被杀）的任务放回队列
+            expired = conn.execute("SELECT id FROM jobs WHERE queue = ? AND state = 'running' AND lease_until < ?",
+                                   (queue, now)).fetchall()
+            for (expired_id,) in expired:
+                conn.execute(
+                    "UPDATE jobs SET state = 'queued', worker = NULL, error = 'lease expired', not_before = ?, "
+                    "updated_at = ?, seq = ? WHERE id = ?",
+                    (now, now, self._next_seq(conn), expired_id),
+                )
+            sql = ("SELECT id, path, metadata, attempts, created_at, not_before FROM jobs j "
+                   "WHERE queue = ? AND state = 'queued' AND not_before <= ?")
+            args = [queue, now]
+            if per_group_limit:
+                sql += (" AND (SELECT COUNT(*) FROM jobs r WHERE r.queue = j.queue AND r.grp = j.grp"
+                        " AND r.state = 'running') < ?")
+                args.append(per_group_limit)
+            row = conn.execute(sql + " ORDER BY id LIMIT 1", args).fetchone()
+            if row is None:
+                return None
+            job_id, path, metadata, attempts, created_at, not_before = row
+            conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_until = ?, worker = ?, updated_at = ?, "
+                "seq = ? WHERE id = ?",
+                (now + lease_seconds, worker, now, self._next_seq(conn), job_id),
+            )
+        # 重试的任务从退避结束时算起，只统计真正在排队的时间
+        queue_wait_seconds.observe(now - max(created_at, not_before), queue=queue)
+        return Job(job_id, queue, path, json.loads(metadata) if metadata else None, attempts + 1, created_at)
+
+    def complete(self, job_id, worker):
+        """任务完成；只有仍持有租约的 worker 才能完成，返回 False 表示租约已丢失（任务已被重新领取）"""
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute(
+                "UPDATE jobs SET state = 'done', lease_until = NULL, error = NULL, updated_at = ?, seq = ? "
+                "WHERE id = ? AND worker = ? AND state = 'running'",
+                (time.time(), self._next_seq(conn), job_id, worker),
+            )
+        if cur.rowcount == 0:
+            log_lost_lease(job_id, worker, "完成")
+        return cur.rowcount > 0
+
+    def fail(self, job_id, worker, error, retry_after=None):
+        """
+        任务失败：未超过重试次数时退避后重新排队，否则标记为 failed。
+        与 complete 一样只对仍持有租约的 worker 生效，返回 False 表示租约已丢失。
+        """
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND worker = ? AND state = 'running'",
+                               (job_id, worker)).fetchone()
+            if row is None:
+                log_lost_lease(job_id, worker, "失败")
+                return False
+            attempts = row[0]
+            if attempts >= MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE jobs SET state = 'failed', lease_until = NULL, error = ?, updated_at = ?, seq = ? WHERE id = ?",
+                    (str(error), now, self._next_seq(conn), job_id),
+                )
+                return True
+            delay = retry_after if retry_after is not None else min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', lease_until = NULL, worker = NULL, error = ?, not_before = ?, "
+                "updated_at = ?, seq = ? WHERE id = ?",
+                (str(error), now + delay, now, self._next_seq(conn), job_id),
+            )
+        return True
+
+    def heartbeat(self, job_id, worker, lease_seconds):
+        """续约：把仍由 worker 执行的任务的租约延长到 lease_seconds 之后，返回 False 表示租约已丢失"""
+        cur = self._conn().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (time.time() + lease_seconds, job_id, worker),
+        )
+        return cur.rowcount > 0
+
+    @contextlib.contextmanager
+    def keep_alive(self, job_id, worker, lease_seconds):
+        """
+        在 with 块内定期续约（生成 + 重试可能超过一个租约期）。后台线程每 lease_seconds / HEARTBEATS_PER_LEASE
+        秒调用一次 heartbeat，租约丢失后停止续约；之后的 complete / fail 会返回 False。
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(lease_seconds / HEARTBEATS_PER_LEASE):
+                try:
+                    if not self.heartbeat(job_id, worker, lease_seconds):
+                        log_lost_lease(job_id, worker, "续约")
+                        return
+                except Exception as e:
+                    print(f"[{datetime.datetime.now().isoformat()}] 续约失败: job {job_id}，错误: {e}")
+
+        thread = threading.Thread(target=beat, name=f"lease-{job_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def rename_path(self, queue, old_path, new_path):
+        """文件被挪到新位置（目录布局迁移）时，更新其未完成任务的 path，返回更新的任务数"""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            ids = conn.execute("SELECT id FROM jobs WHERE queue = ? AND path = ? AND state != 'done'",
+                               (queue, old_path)).fetchall()
+            for (job_id,) in ids:
+                conn.execute("UPDATE jobs SET path = ?, updated_at = ?, seq = ? WHERE id = ?",
+                             (new_path, now, self._next_seq(conn), job_id))
+        return len(ids)
+
+    def report_progress(self, job_id, version, state, output=None, error=None):
+        """
+        worker 上报单个版本（v1–v4）的进度：state 为 done / failed，output 为相对输出目录的路径。
+        同时刷新任务的 seq / updated_at，状态接口据此推送变化。
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO progress (job_id, version, state, output, error, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(job_id, version) DO UPDATE SET state = excluded.state, output = excluded.output, "
+                "error = excluded.error, updated_at = excluded.updated_at",
+                (job_id, version, state, output, str(error) if error is not None else None, now),
+            )
+            conn.execute("UPDATE jobs SET updated_at = ?, seq = ? WHERE id = ?", (now, self._next_seq(conn), job_id))
+
+    def reporter(self, job_id, output_root):
+        """
+        给 worker 用的进度回调 report(version, output_path=None, error=None)：
+        output_path 记为相对 output_root 的路径；上报失败只打印日志，不影响生成本身。
+        """
+        def report(version, output_path=None, error=None):
+            try:
+                self.report_progress(
+                    job_id, version, "failed" if error is not None else "done",
+                    output=os.path.relpath(output_path, output_root) if output_path else None, error=error,
+                )
+            except Exception as e:
+                print(f"[{datetime.datetime.now().isoformat()}] 上报进度失败: job {job_id} v{version}，错误: {e}")
+        return report
+
+    def data_version(self):
+        """其他连接（其他进程 / 线程）每提交一次写入，该值就会变化，用来廉价地判断是否需要重新查询"""
+        return self._conn().execute("PRAGMA data_version").fetchone()[0]
+
+    def _with_progress(self, rows):
+        jobs = [
+            {"id": r[0], "queue": r[1], "path": r[2], "state": r[3], "attempts": r[4], "error": r[5],
+             "created_at": r[6], "updated_at": r[7], "seq": r[8], "progress": []}
+            for r in rows
+        ]
+        if jobs:
+            by_id = {job["id"]: job for job in jobs}
+            marks = ",".join("?" * len(by_id))
+            for job_id, version, state, output, error in self._conn().execute(
+                f"SELECT job_id, version, state, output, error FROM progress WHERE job_id IN ({marks}) "
+                "ORDER BY job_id, version", list(by_id),
+            ):
+                by_id[job_id]["progress"].append({"version": version, "state": state, "output": output, "error": error})
+        return jobs
+
+    _JOB_COLUMNS = "id, queue, path, state, attempts, error, created_at, updated_at, seq"
+
+    def get(self, job_id):
+        """任务状态（含各版本进度），不存在返回 None"""
+        rows = self._conn().execute(f"SELECT {self._JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchall()
+        jobs = self._with_progress(rows)
+        return jobs[0] if jobs else None
+
+    def group_jobs(self, grp, after=0, updated_since=None, limit=100):
+        """
+        某个用户 seq 大于 after 的任务（即 after 之后有变化的），按变化先后排列；
+        updated_since 另外按 updated_at 限定时间窗口（只用于列表，不作游标）
+        """
+        sql = f"SELECT {self._JOB_COLUMNS} FROM jobs WHERE grp = ? AND seq > ?"
+        args = [grp, after]
+        if updated_since is not None:
+            sql += " AND updated_at > ?"
+            args.append(updated_since)
+        rows = self._conn().execute(sql + " ORDER BY seq LIMIT ?", args + [limit]).fetchall()
+        return self._with_progress(rows)
+
+    def counts(self, queue):
+        rows = self._conn().execute("SELECT state, COUNT(*) FROM jobs WHERE queue = ? GROUP BY state", (queue,))
+        return dict(rows.fetchall())
+
+    def metric_rows(self, queues):
+        """metrics.Registry 的 collector：各队列 queued / running 任务数（队列深度）"""
+        rows = []
+        for queue in queues:
+            # 只数未完成的任务，走 (queue, state) 索引，不扫描历史 done 记录
+            counts = dict(self._conn().execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE queue = ? AND state IN ('queued', 'running') GROUP BY state",
+                (queue,),
+            ).fetchall())
+            for state in ("queued", "running"):
+                rows.append(("job_queue_depth", "gauge", "队列中各状态的任务数", {"queue": queue, "state": state},
+                             counts.get(state, 0)))
+        return rows
+
+
+def log_lost_lease(job_id, worker, action):
+    print(f"[{datetime.datetime.now().isoformat()}] 任务租约已丢失（已被重新领取或不在执行中），忽略{action}: "
+          f"job {job_id}，worker {worker}")
+
+
+def adopt_orphans(watcher, job_queue, queue, root_dir):
+    """
+    兜底：监听上传目录，发现没有对应任务的文件（旧版 app、手工拷贝）时替它入队（metadata 为空）。
+    文件第一次被看到后先等 ORPHAN_GRACE 秒，避免与 app “先落盘、后入队” 之间的窗口冲突。
+    等待从 watcher 第一次报告该文件算起，而不是文件的 mtime：多文件上传请求里较早写完的文件
+    rename 到位时 mtime 已经很旧，按 mtime 算会在 app 入队之前抢先入队（没有 metadata，且会处理两次）。
+    在独立线程中运行。
+    """
+    first_seen = {}  # 路径 -> 第一次看到的时间（monotonic），入队 / 已有任务 / 文件消失后删除
+    while True:
+        fpath = watcher.get()
+        retry_after = None
+        try:
+            if not os.path.exists(fpath):
+                first_seen.pop(fpath, None)
+                continue
+            rel_path = os.path.relpath(fpath, root_dir)
+            if job_queue.has_job(queue, rel_path):
+                first_seen.pop(fpath, None)
+                continue
+            now = time.monotonic()
+            age = now - first_seen.setdefault(fpath, now)
+            if age < ORPHAN_GRACE:
+                retry_after = ORPHAN_GRACE - age
+                continue
+            job_id = job_queue.enqueue(queue, rel_path)
+            first_seen.pop(fpath, None)
+            print(f"[{datetime.datetime.now().isoformat()}] 上传目录中发现无任务文件，已入队: {rel_path} (job {job_id})")
+        except Exception as e:
+            retry_after = ORPHAN_GRACE
+            print(f"[{datetime.datetime.now().isoformat()}] 兜底入队失败: {fpath}，错误: {e}")
+        finally:
+            watcher.task_done(fpath, retry_after=retry_after)
@@ -0,0 +1,170 @@
+import time
+import asyncio
+import datetime
+import threading
+import collections
+
+
+class TokenBucket:
+    """令牌桶：reserve() 取到令牌返回 0，否则返回还需等待的秒数"""
+
+    def __init__(self, requests_per_minute, capacity=1):
+        self._rate = requests_per_minute / 60.0
+        self._capacity = float(max(1, capacity))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self._rate
+
+
+class KeyLimiter:
+    """
+    单个 API key 的并发与速率限制：
+      - max_concurrency: 同时在途的请求数上限
+      - requests_per_minute: 令牌桶限速，None 表示不限速
+    用法：with limiter: client.images.generate(...)
+    """
+
+    def __init__(self, max_concurrency=2, requests_per_minute=None):
+        self._sem = threading.BoundedSemaphore(max_concurrency)
+        self._bucket = TokenBucket(requests_per_minute, max_concurrency) if requests_per_minute else None
+
+    def acquire(self):
+        self._sem.acquire()
+        while self._bucket:
+            wait = self._bucket.reserve()
+            if not wait:
+                break
+            time.sleep(wait)
+
+    def release(self):
+        self._sem.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class AsyncKeyLimiter:
+    """KeyLimiter 的 asyncio 版本，用于事件循环内的请求：async with limiter: ..."""
+
+    def __init__(self, max_concurrency=2, requests_per_minute=None):
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._bucket = TokenBucket(requests_per_minute, max_concurrency) if requests_per_minute else None
+
+    async def __aenter__(self):
+        await self._sem.acquire()
+        try:
+            while self._bucket:
+                wait = self._bucket.reserve()
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+        except BaseException:
+            self._sem.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._sem.release()
+        return False
+
+
+class FairScheduler:
+    """
+    有界并发的任务调度器：
+      - workers 个线程同时执行 handler(item)
+      - 任务按 group_of(item)（如 user_* 目录）分组，组间轮转取任务，
+        一个用户提交大量文件不会阻塞其他用户
+      - per_group_limit: 同一组同时执行的任务数上限，None 表示不限制
+    """
+
+    def __init__(self, handler, group_of, workers=4, per_group_limit=None):
+        self.handler = handler
+        self.group_of = group_of
+        self.workers = workers
+        self.per_group_limit = per_group_limit
+
+        self._cond = threading.Condition()
+        self._queues = collections.OrderedDict()  # group -> deque，顺序即轮转顺序
+        self._running = collections.Counter()
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, wait=True):
+        """停止调度：已在执行的任务跑完，队列中剩余任务丢弃"""
+        with self._cond:
+            self._stopping = True
+            self._queues.clear()
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def submit(self, item):
+        group = self.group_of(item)
+        with self._cond:
+            self._queues.setdefault(group, collections.deque()).append(item)
+            self._cond.notify()
+
+    def pending_count(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def running_count(self):
+        with self._cond:
+            return sum(self._running.values())
+
+    def _next_item(self):
+        """轮转取下一个任务；取出后该组移到队尾（调用方需持有锁）"""
+        for group in list(self._queues):
+            if self.per_group_limit and self._running[group] >= self.per_group_limit:
+                continue
+            queue = self._queues.pop(group)
+            item = queue.popleft()
+            if queue:
+                self._queues[group] = queue
+            self._running[group] += 1
+            return group, item
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                picked = self._next_item()
+                while picked is None and not self._stopping:
+                    self._cond.wait()
+                    picked = self._next_item()
+                if picked is None:
+                    return
+            group, item = picked
+            try:
+                self.handler(item)
+            except Exception as e:
+                print(f"[{datetime.datetime.now().isoformat()}] 任务执行异常: {item}，错误: {e}")
+            finally:
+                with self._cond:
+                    self._running[group] -= 1
+                    if self._running[group] <= 0:
+                        del self._running[group]
+                    self._cond.notify_all()
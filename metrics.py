@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import glob
+import bisect
+import threading
+import contextlib
+import datetime
+
+# 秒；覆盖从缩略图编码（毫秒级）到 ARK 生成（数十秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+SNAPSHOT_INTERVAL = 15  # 秒，worker 把指标快照写到 metrics 目录的间隔，app 的 /metrics 合并输出
+SNAPSHOT_MAX_AGE = 300  # 秒，超过这么久没更新的快照（worker 已退出）不再输出
+SPAN_LOG_MAX_BYTES = 100 * 1024 * 1024  # span 日志超过该大小轮转为 .1
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + "_total", self._labels(k), v) for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(k), v) for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = self._labels(key)
+                cumulative = 0
+                for le, n in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    out.append((self.name + "_bucket", dict(labels, le=_format_value(le)), cumulative))
+                out.append((self.name + "_sum", labels, total))
+                out.append((self.name + "_count", labels, count))
+        return out
+
+
+class Registry:
+    """
+    进程内的指标集合。指标按名字注册一次，重复注册返回同一个对象；
+    collector 为抓取时才计算的指标（队列深度、缓存统计等），返回 (name, type, help, labels, value) 列表。
+    const_labels 会加到所有样本上（如 process="ark1"）。
+    """
+
+    def __init__(self, const_labels=None):
+        self.const_labels = dict(const_labels or {})
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def add_collector(self, fn):
+        self._collectors.append(fn)
+
+    def collect(self):
+        """所有指标族：[{"name", "type", "help", "samples": [[样本名, labels, 值], ...]}]"""
+        families = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            families[metric.name] = {"name": metric.name, "type": metric.type, "help": metric.help,
+                                     "samples": [[n, dict(self.const_labels, **l), v] for n, l, v in metric.samples()]}
+        for fn in self._collectors:
+            try:
+                rows = fn()
+            except Exception as e:
+                print(f"[{datetime.datetime.now().isoformat()}] 指标采集失败: {fn.__name__}，错误: {e}")
+                continue
+            for name, mtype, help, labels, value in rows:
+                family = families.setdefault(name, {"name": name, "type": mtype, "help": help, "samples": []})
+                sample_name = name + "_total" if mtype == "counter" else name
+                family["samples"].append([sample_name, dict(self.const_labels, **labels), value])
+        return list(families.values())
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(*collections):
+    """把一个或多个 collect() 结果合并成 Prometheus 文本格式（同名指标族只输出一次 HELP / TYPE）"""
+    merged = {}
+    for families in collections:
+        for family in families:
+            target = merged.setdefault(family["name"], {**family, "samples": []})
+            target["samples"].extend(family["samples"])
+    lines = []
+    for name in sorted(merged):
+        family = merged[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample_name, labels, value in family["samples"]:
+            label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{sample_name}{{{label_str}}} {_format_value(value)}" if label_str
+                         else f"{sample_name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ---------- 默认 registry 与 worker 快照 ----------
+registry = Registry()
+
+stage_seconds = registry.histogram("stage_seconds", "各处理阶段耗时（秒）", ("stage",))
+
+
+def write_snapshot(path, reg=None):
+    """把 registry 的当前值原子写入 path（JSON），供 app 的 /metrics 合并"""
+    data = json.dumps({"time": time.time(), "families": (reg or registry).collect()}, ensure_ascii=False)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def read_snapshots(directory, max_age=SNAPSHOT_MAX_AGE):
+    """读取 directory 下各 worker 的快照，返回 collect() 结果的列表（跳过过期 / 损坏的）"""
+    out = []
+    now = time.time()
+    for path in glob.glob(os.path.join(glob.escape(directory), "*.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if now - data.get("time", 0) <= max_age:
+            out.append(data["families"])
+    return out
+
+
+def _snapshot_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot(path)
+        except Exception as e:
+            print(f"[{datetime.datetime.now().isoformat()}] 写指标快照失败: {path}，错误: {e}")
+
+
+# ---------- span（JSON lines） ----------
+class SpanLog:
+    """按行追加 JSON 的 span 日志，超过 SPAN_LOG_MAX_BYTES 轮转一次"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self._file.tell() > SPAN_LOG_MAX_BYTES:
+                self._file.close()
+                os.replace(self.path, self.path + ".1")
+                self._file = open(self.path, "a", encoding="utf-8")
+
+
+_span_log = None
+_process = None
+_context = threading.local()
+
+
+def configure(process, snapshot_dir=None, span_log=None, snapshot_interval=SNAPSHOT_INTERVAL):
+    """
+    worker 启动时调用：所有样本加上 process 标签；snapshot_dir 不为空时定期写指标快照；
+    span_log 不为空时把 span 追加写入该文件（JSON lines）。
+    """
+    global _span_log, _process
+    _process = process
+    registry.const_labels["process"] = process
+    if span_log:
+        _span_log = SpanLog(span_log)
+    if snapshot_dir:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        path = os.path.join(snapshot_dir, f"{process}-{os.getpid()}.json")
+        threading.Thread(target=_snapshot_loop, args=(path, snapshot_interval),
+                         name="metrics-snapshot", daemon=True).start()
+
+
+@contextlib.contextmanager
+def trace(trace_id, **attrs):
+    """标记当前线程正在处理的任务，之后的 span 都带上 trace（如 job id）与 attrs"""
+    previous = getattr(_context, "trace", None)
+    _context.trace = dict(attrs, trace=trace_id)
+    try:
+        yield
+    finally:
+        _context.trace = previous
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    计时一个处理阶段：耗时计入 stage_seconds{stage=name}，并写一行 span 日志。
+    yield 出的 dict 可以在阶段内补充属性（如缓存是否命中）。
+    """
+    start = time.perf_counter()
+    started_at = time.time()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_seconds.observe(duration, stage=name)
+        if _span_log is not None:
+            record = {"ts": round(started_at, 6), "span": name, "dur": round(duration, 6), "process": _process}
+            record.update(getattr(_context, "trace", None) or {})
+            record.update(attrs)
+            if error:
+                record["error"] = error
+            try:
+                _span_log.write(record)
+            except Exception:
+                pass
@@ -0,0 +1,110 @@
+"""
+把旧的平铺目录（{根目录}/user_<id>/<文件>）迁移为哈希分片布局（{根目录}/user_<id>/<分片>/<文件>）：
+  - 文件名不变，只 rename 到 storage.shard_of(文件名) 对应的分片目录，接口返回的 URL 不受影响
+  - 已生成的缩略图（.thumbs/）随原图一起移动（rename 不改变 inode / mtime，缓存仍然有效）
+  - uploads / background 中尚未处理的文件，同步更新任务队列里的 path
+  - metadata.json 等非图片文件保留在用户目录下
+app 在迁移期间可以继续运行（读取时两种位置都会查找）；建议先停掉 ark1 / ark2，迁移完成后再启动。
+可以重复执行，已迁移的文件会被跳过。
+
+用法：
+  python migrate_layout.py --dry-run
+  python migrate_layout.py
+"""
+import os
+import sys
+import argparse
+import datetime
+
+import storage
+import thumbnails
+from gallery_index import listed
+from job_queue import JobQueue
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# 根目录 -> 其中文件对应的任务队列（需要同步任务 path 的目录）
+ROOTS = {
+    "uploads": "ark2",
+    "background": "ark1",
+    "moved": None,
+    "xiangao": None,
+    "background_person": None,
+    "moved_images": None,
+    "moved_background": None,
+}
+JOB_DB = os.path.join(BASE_DIR, "jobs.sqlite")
+MIGRATED_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tiff")
+
+
+def log(message):
+    print(f"[{datetime.datetime.now().isoformat()}] {message}")
+
+
+def move_thumbnails(user_dir, name, target_dir):
+    thumb_dir = os.path.join(user_dir, thumbnails.THUMB_DIR)
+    if not os.path.isdir(thumb_dir):
+        return
+    for thumb in os.listdir(thumb_dir):
+        if not thumb.startswith(name + "."):
+            continue
+        dst_dir = os.path.join(target_dir, thumbnails.THUMB_DIR)
+        os.makedirs(dst_dir, exist_ok=True)
+        os.replace(os.path.join(thumb_dir, thumb), os.path.join(dst_dir, thumb))
+
+
+def migrate_user_dir(root, user, queue, job_queue, args, totals):
+    user_dir = os.path.join(root, user)
+    for entry in sorted(os.scandir(user_dir), key=lambda e: e.name):
+        name = entry.name
+        if not entry.is_file() or not listed(name, MIGRATED_EXTS):
+            continue
+        target = os.path.join(user_dir, storage.shard_of(name), name)
+        if os.path.exists(target):
+            if os.path.samefile(entry.path, target):
+                if not args.dry_run:
+                    os.remove(entry.path)
+                continue
+            log(f"冲突，保留原位置: {entry.path}（{target} 已存在且内容不同）")
+            totals["conflicts"] += 1
+            continue
+        totals["moved"] += 1
+        if args.dry_run:
+            continue
+        storage.placed_path(user_dir, name)  # 创建分片目录
+        os.replace(entry.path, target)
+        move_thumbnails(user_dir, name, os.path.dirname(target))
+        if queue and job_queue is not None:
+            totals["jobs"] += job_queue.rename_path(
+                queue, os.path.relpath(entry.path, root), os.path.relpath(target, root))
+
+    thumb_dir = os.path.join(user_dir, thumbnails.THUMB_DIR)
+    if not args.dry_run and os.path.isdir(thumb_dir):
+        # 剩下的是已不存在原图（或冲突未迁移）的缩略图，需要时会重新生成
+        for thumb in os.listdir(thumb_dir):
+            os.remove(os.path.join(thumb_dir, thumb))
+        os.rmdir(thumb_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-dir", default=BASE_DIR, help="各图库根目录所在目录")
+    parser.add_argument("--dry-run", action="store_true", help="只统计，不移动文件")
+    args = parser.parse_args(argv)
+
+    job_db = os.path.join(args.base_dir, os.path.basename(JOB_DB))
+    job_queue = JobQueue(job_db) if os.path.exists(job_db) else None
+    for name, queue in ROOTS.items():
+        root = os.path.join(args.base_dir, name)
+        if not os.path.isdir(root):
+            continue
+        totals = {"moved": 0, "conflicts": 0, "jobs": 0}
+        for user in sorted(os.listdir(root)):
+            if user.startswith("user_") and os.path.isdir(os.path.join(root, user)):
+                migrate_user_dir(root, user, queue, job_queue, args, totals)
+        verb = "待迁移" if args.dry_run else "已迁移"
+        log(f"{name}: {verb} {totals['moved']} 个文件，冲突 {totals['conflicts']} 个，更新任务 {totals['jobs']} 个")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+感知哈希（dHash + pHash，NumPy 实现）与近重复索引。
+
+连拍、同一景点反复上传的图片字节不同（结果缓存按 sha256 命中不了），但感知哈希几乎一致：
+  - dHash：9x8 灰度图相邻像素的明暗梯度，64 位
+  - pHash：32x32 灰度图做二维 DCT，取左上 8x8 低频系数与中位数比较，64 位
+两种哈希的汉明距离都不超过 MAX_DISTANCE 时视为近重复。
+
+NearDupIndex 存于 SQLite（WAL，ark1 / ark2 共用），按 scope 区分：
+  - 按用户的 scope（如 "ark1:user_5"）：记录处理过的原图 sha256，近重复的新图可复用它的生成结果（结果缓存）
+  - 全局 scope（embedding_scope(输入尺寸)，如 "embedding@1024"）：同时存 embedding 向量，近乎相同的图不再调用远端 embedding；
+    按计算 embedding 时的输入尺寸分开，不同尺寸的向量不可比，不会互相复用
+每个进程在内存里保留一份哈希数组（按 rowid 增量同步其他进程写入的记录），查询是一次向量化的 XOR + popcount。
+"""
+import os
+import time
+import sqlite3
+import threading
+
+import numpy as np
+from PIL import Image, ImageOps
+
+HASH_SIZE = 8  # 每边 8 位，共 64 位
+PHASH_SIZE = 32  # pHash 做 DCT 的灰度图边长
+MAX_DISTANCE = 6  # 汉明距离阈值（64 位中），两种哈希都不超过才算近重复
+RECENT_WINDOW = 7 * 24 * 3600  # 秒，按用户的 scope 只与这么久内处理过的图比较
+MAX_CANDIDATES = 3  # 一次查询最多返回的近重复数（按距离排序）
+EMBEDDING_SCOPE_PREFIX = "embedding@"  # 全局 scope 前缀：带 embedding 向量，不按时间过滤
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    id INTEGER PRIMARY KEY,
+    scope TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    dhash INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    embedding BLOB
+);
+CREATE INDEX IF NOT EXISTS hashes_scope ON hashes (scope, created_at);
+CREATE INDEX IF NOT EXISTS hashes_sha256 ON hashes (sha256, scope);
+"""
+
+
+def embedding_scope(embed_size):
+    return f"{EMBEDDING_SCOPE_PREFIX}{embed_size}"
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    m = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+def _to_int64(bits):
+    """64 个布尔位 -> 有符号 int64（SQLite INTEGER 可直接存）"""
+    value = int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def dhash(gray):
+    px = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    return _to_int64(px[:, 1:] > px[:, :-1])
+
+
+def phash(gray):
+    px = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ px @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    return _to_int64(low > np.median(low.ravel()[1:]))  # 中位数不含直流分量
+
+
+def compute(path):
+    """图片的 (dhash, phash)；JPEG 按 1/8 缩小解码，只需几毫秒"""
+    with Image.open(path) as img:
+        if img.format == "JPEG":
+            img.draft("L", (PHASH_SIZE * 2, PHASH_SIZE * 2))
+        gray = ImageOps.exif_transpose(img).convert("L")
+    return dhash(gray), phash(gray)
+
+
+def distance(a, b):
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+class NearDupIndex:
+    """
+    近重复索引：
+        hashes = phash.compute(path)
+        index.find(scope, hashes)  -> [(距离, sha256, rowid)]，按距离升序
+        index.add(scope, sha256, hashes, embedding=None)
+        index.embedding(rowid)     -> np.float32 向量（add 时存了的话）
+        index.cached_embedding(scope, sha256) -> 内容完全相同的图存过的向量（不需要解码图片）
+    """
+
+    def __init__(self, db_path, max_distance=MAX_DISTANCE, window=RECENT_WINDOW):
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.window = window
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._scope_codes = {}
+        self._rows = {"id": [], "scope": [], "sha256": [], "dhash": [], "phash": [], "created_at": []}
+        self._arrays = None  # _rows 的 numpy 版本，有新记录时重建
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _sync(self):
+        """拉取其他进程（或本进程其他线程）新写入的记录"""
+        rows = self._conn().execute(
+            "SELECT id, scope, sha256, dhash, phash, created_at FROM hashes WHERE id > ? ORDER BY id",
+            (self._last_id,)).fetchall()
+        if not rows:
+            return
+        for rowid, scope, sha256, d, p, created_at in rows:
+            code = self._scope_codes.setdefault(scope, len(self._scope_codes))
+            for key, value in zip(self._rows, (rowid, code, sha256, d, p, created_at)):
+                self._rows[key].append(value)
+        self._last_id = rows[-1][0]
+        self._arrays = None
+
+    def _snapshot(self):
+        if self._arrays is None:
+            self._arrays = {
+                "scope": np.array(self._rows["scope"], dtype=np.int32),
+                "dhash": np.array(self._rows["dhash"], dtype=np.int64).view(np.uint64),
+                "phash": np.array(self._rows["phash"], dtype=np.int64).view(np.uint64),
+                "created_at": np.array(self._rows["created_at"], dtype=np.float64),
+            }
+        return self._arrays
+
+    def find(self, scope, hashes, exclude_sha256=None, limit=MAX_CANDIDATES):
+        """scope 内与 hashes 近重复的记录 [(距离, sha256, rowid)]，距离为两种哈希距离之和"""
+        with self._lock:
+            self._sync()
+            code = self._scope_codes.get(scope)
+            if code is None:
+                return []
+            arrays = self._snapshot()
+            mask = arrays["scope"] == code
+            if not scope.startswith(EMBEDDING_SCOPE_PREFIX):
+                mask &= arrays["created_at"] >= time.time() - self.window
+            idx = np.flatnonzero(mask)
+            if idx.size == 0:
+                return []
+            d = np.bitwise_count(arrays["dhash"][idx] ^ np.int64(hashes[0]).astype(np.uint64))
+            p = np.bitwise_count(arrays["phash"][idx] ^ np.int64(hashes[1]).astype(np.uint64))
+            ok = (d <= self.max_distance) & (p <= self.max_distance)
+            idx, total = idx[ok], (d[ok].astype(np.int32) + p[ok])
+            out = []
+            for j in np.argsort(total, kind="stable"):
+                sha256 = self._rows["sha256"][idx[j]]
+                if sha256 != exclude_sha256 and all(sha256 != o[1] for o in out):
+                    out.append((int(total[j]), sha256, self._rows["id"][idx[j]]))
+                if len(out) >= limit:
+                    break
+            return out
+
+    def add(self, scope, sha256, hashes, embedding=None):
+        """记录一张处理过的图；embedding 以 float32 存储"""
+        blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT INTO hashes (scope, sha256, dhash, phash, created_at, embedding) VALUES (?, ?, ?, ?, ?, ?)",
+                         (scope, sha256, hashes[0], hashes[1], time.time(), blob))
+
+    def embedding(self, rowid):
+        row = self._conn().execute("SELECT embedding FROM hashes WHERE id = ?", (rowid,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def cached_embedding(self, scope, sha256):
+        row = self._conn().execute(
+            "SELECT embedding FROM hashes WHERE sha256 = ? AND scope = ? AND embedding IS NOT NULL ORDER BY id DESC LIMIT 1",
+            (sha256, scope)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def prune(self):
+        """删除按用户的 scope 中超出时间窗口的记录（全局 embedding 记录保留；旧版不带尺寸的 "embedding" 按过期处理），启动时调用"""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM hashes WHERE scope NOT LIKE ? AND created_at < ?",
+                               (EMBEDDING_SCOPE_PREFIX + "%", time.time() - self.window))
+        return cur.rowcount
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import datetime
+import threading
+from storage import link_or_copy, temp_path_for
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+EVICT_TARGET_RATIO = 0.9  # 超限后淘汰到上限的 90%，避免每次写入都触发淘汰
+
+
+class ResultCache:
+    """
+    以内容寻址的生成结果缓存：
+      - 键 = sha256(上传图片哈希, 完整 prompt, seed, guidance_scale, model, 其他影响输出的参数)
+      - 命中时把缓存对象硬链接到输出目录，不发起任何网络请求
+      - 缓存目录总大小超过 max_bytes 时按最近使用时间（mtime，命中时刷新）淘汰
+    目录结构：{root}/objects/<key[:2]>/<key>
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._size = sum(size for _, _, size in self._iter_objects())
+
+    @staticmethod
+    def make_key(image_sha256, prompt, seed, guidance_scale, model, **extra):
+        payload = json.dumps(
+            {"image": image_sha256, "prompt": prompt, "seed": seed,
+             "guidance_scale": guidance_scale, "model": model, "extra": extra},
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def lookup(self, key, dest, count_miss=True):
+        """命中则把结果放到 dest 并返回 True；count_miss=False 用于试探性查找（如近重复候选），未命中不计入统计"""
+        obj = self._object_path(key)
+        try:
+            link_or_copy(obj, dest)
+            os.utime(obj)  # 刷新最近使用时间
+        except FileNotFoundError:
+            if count_miss:
+                with self._lock:
+                    self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, src):
+        """
+        把生成好的结果加入缓存（硬链接，不复制数据）。键已存在时（内容寻址，结果等价）只刷新最近使用时间；
+        新对象先放到临时名再 os.link 到位（不覆盖），并发写入同一个键时只有一个计入总大小
+        """
+        obj = self._object_path(key)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        tmp = temp_path_for(obj)
+        try:
+            if os.path.exists(obj):
+                os.utime(obj)
+                return
+            link_or_copy(src, tmp)
+            size = os.path.getsize(tmp)
+            os.link(tmp, obj)
+        except FileExistsError:
+            return
+        except OSError as e:
+            print(f"[{datetime.datetime.now().isoformat()}] 写入结果缓存失败: {e}")
+            return
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        with self._lock:
+            self.stores += 1
+            self._size += size
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _iter_objects(self):
+        for dirpath, _, filenames in os.walk(self.objects_dir):
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def evict(self):
+        """按最近使用时间从旧到新删除，直到总大小降到上限的 EVICT_TARGET_RATIO"""
+        with self._lock:
+            objects = sorted(self._iter_objects(), key=lambda item: item[1])
+            total = sum(size for _, _, size in objects)
+            target = self.max_bytes * EVICT_TARGET_RATIO
+            for path, _, size in objects:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+            self._size = total
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "stores": self.stores,
+                    "evictions": self.evictions, "bytes": self._size}
+
+    def metric_rows(self):
+        """metrics.Registry 的 collector：命中 / 未命中 / 写入 / 淘汰次数与占用字节"""
+        stats = self.stats()
+        cache = os.path.basename(os.path.normpath(self.root))
+        rows = [("result_cache_bytes", "gauge", "结果缓存占用字节", {"cache": cache}, stats.pop("bytes"))]
+        for event, value in stats.items():
+            rows.append(("result_cache_events", "counter", "结果缓存事件数", {"cache": cache, "event": event}, value))
+        return rows
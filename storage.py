@@ -0,0 +1,250 @@
+import os
+import time
+import uuid
+import errno
+import shutil
+import hashlib
+import threading
+import collections
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)，btrfs / xfs / overlayfs 等支持 reflink
+HASH_CHUNK = 1024 * 1024
+COPY_CHUNK = 64 * 1024 * 1024
+XATTR_SHA256 = "user.sha256"
+
+_sha_memo = collections.OrderedDict()  # (dev, ino, size, mtime_ns) -> sha256
+_sha_memo_lock = threading.Lock()
+SHA_MEMO_SIZE = 8192
+
+SHARD_CHARS = 2  # 分片目录名长度（十六进制），每个用户目录下最多 256 个分片
+_id_lock = threading.Lock()
+_id_state = {"ms": 0, "seq": 0}
+_ID_NODE = uuid.uuid4().hex[:4]  # 进程级随机后缀：多个 app 进程同一毫秒同一序号也不会重名
+
+# 各种落盘方式的次数：link / reflink / copy_file_range / copy / rename
+stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(method):
+    with _stats_lock:
+        stats[method] += 1
+
+
+def _stat_tag(st):
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def record_sha256(path, digest):
+    """
+    把内容哈希记到文件的扩展属性（xattr）里，硬链接共享同一份；
+    同时记下 size 与 mtime，文件被改写后旧哈希自动失效。不支持 xattr 的文件系统上静默跳过。
+    """
+    try:
+        os.setxattr(path, XATTR_SHA256, f"{digest} {_stat_tag(os.stat(path))}".encode("ascii"))
+    except (AttributeError, OSError):
+        pass
+
+
+def recorded_sha256(path):
+    """读取 record_sha256 记下的哈希，没有或已失效时返回 None"""
+    try:
+        digest, tag = os.getxattr(path, XATTR_SHA256).decode("ascii").split(" ", 1)
+        if tag == _stat_tag(os.stat(path)):
+            return digest
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+
+def file_sha256(path):
+    """文件内容的 sha256：优先读 xattr；不支持 xattr 的文件系统上用进程内缓存，避免重复读文件"""
+    digest = recorded_sha256(path)
+    if digest:
+        return digest
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _sha_memo_lock:
+        digest = _sha_memo.get(key)
+        if digest:
+            _sha_memo.move_to_end(key)
+            return digest
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    record_sha256(path, digest)
+    with _sha_memo_lock:
+        _sha_memo[key] = digest
+        while len(_sha_memo) > SHA_MEMO_SIZE:
+            _sha_memo.popitem(last=False)
+    return digest
+
+
+def temp_path_for(dst):
+    """与 dst 同目录的隐藏临时文件名（保证 os.replace 在同一文件系统内原子完成）"""
+    return os.path.join(os.path.dirname(dst) or ".", f".{os.path.basename(dst)}.{uuid.uuid4().hex[:8]}.tmp")
+
+
+def _clone_or_copy(src, tmp):
+    """数据复制：reflink（共享数据块）→ copy_file_range（内核态复制）→ 普通复制"""
+    with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                _count("reflink")
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK):
+                    pass
+                _count("copy_file_range")
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                fdst.seek(0)
+                fdst.truncate()
+                fsrc.seek(0)
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+        _count("copy")
+
+
+def link_or_copy(src, dst):
+    """
+    把 src 原子地放到 dst：优先硬链接（不复制数据），不能硬链接时（跨文件系统等）回退为
+    reflink / copy_file_range / 普通复制。
+    先写同目录临时名再 os.replace，dst 原有文件被替换而不是被截断改写。
+    """
+    try:
+        if os.path.samefile(src, dst):
+            return
+    except FileNotFoundError:
+        if not os.path.exists(src):
+            raise
+    tmp = temp_path_for(dst)
+    try:
+        try:
+            os.link(src, tmp)
+            _count("link")
+        except OSError:
+            _clone_or_copy(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # 异常时清理；另外 tmp 与 dst 恰为同一 inode 时 rename 什么也不做，tmp 会残留
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+def fan_out(src, dests):
+    """把 src 放到多个目标路径，每个目标一次 link_or_copy，同一文件系统内不产生数据 IO"""
+    for dst in dests:
+        link_or_copy(src, dst)
+
+
+def move(src, dst):
+    """原子移动 src 到 dst；跨文件系统时先放好 dst 再删除 src"""
+    try:
+        os.replace(src, dst)
+        _count("rename")
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        link_or_copy(src, dst)
+        os.remove(src)
+
+
+
+# ---------- 用户目录布局：唯一文件名 + 哈希分片 ----------
+def new_file_id():
+    """
+    单调递增的唯一 ID：毫秒时间戳（13 位）-毫秒内序号-进程随机后缀，如 1700000000000-0003-9f2c。
+    字符串顺序即时间顺序（与旧的纯时间戳文件名也可比较）；时钟回拨时沿用上一个毫秒继续递增。
+    """
+    with _id_lock:
+        ms = max(int(time.time() * 1000), _id_state["ms"])
+        if ms == _id_state["ms"]:
+            _id_state["seq"] += 1
+            if _id_state["seq"] > 9999:  # 一毫秒内超过一万个：借用下一毫秒
+                ms += 1
+                _id_state["seq"] = 0
+        else:
+            _id_state["seq"] = 0
+        _id_state["ms"] = ms
+        return f"{ms:013d}-{_id_state['seq']:04d}-{_ID_NODE}"
+
+
+def new_filename(ext):
+    return f"{new_file_id()}{ext}"
+
+
+def file_key(name):
+    """分片依据：文件名中第一个 "_" / "." 之前的部分，派生文件（<id>_1.jpg、<id>.png）与原图落在同一分片"""
+    return name.split(".", 1)[0].split("_", 1)[0]
+
+
+def shard_of(name):
+    return hashlib.sha1(file_key(name).encode("utf-8")).hexdigest()[:SHARD_CHARS]
+
+
+def is_shard_dir(name):
+    return len(name) == SHARD_CHARS and all(c in "0123456789abcdef" for c in name)
+
+
+def placed_path(user_dir, name):
+    """新文件在用户目录下的位置 {user_dir}/{分片}/{name}（分片目录不存在时创建）"""
+    directory = os.path.join(user_dir, shard_of(name))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def find_path(user_dir, name):
+    """
+    按文件名找到用户目录下的文件：先找分片位置，再找迁移前的平铺位置；都不存在时返回 None。
+    name 必须是单纯的文件名（不含路径分隔符、不以 . 开头）。
+    """
+    if not name or name.startswith(".") or os.path.basename(name) != name:
+        return None
+    for path in (os.path.join(user_dir, shard_of(name), name), os.path.join(user_dir, name)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def scan_user_dir(user_dir):
+    """用户目录下的所有文件 [(文件名, 路径)]：各分片目录 + 尚未迁移的平铺文件，隐藏文件（临时文件）除外"""
+    out = []
+    try:
+        top = list(os.scandir(user_dir))
+    except FileNotFoundError:
+        return out
+    for entry in top:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir() and is_shard_dir(entry.name):
+            with os.scandir(entry.path) as it:
+                out.extend((e.name, e.path) for e in it if not e.name.startswith(".") and e.is_file())
+        elif entry.is_file():
+            out.append((entry.name, entry.path))
+    return out
+
+
+def user_dir_signature(user_dir):
+    """用户目录及其分片目录的最大 mtime（ns）：任意分片里增删文件都会改变；目录不存在时返回 0"""
+    try:
+        signature = os.stat(user_dir).st_mtime_ns
+        with os.scandir(user_dir) as it:
+            for entry in it:
+                if is_shard_dir(entry.name) and entry.is_dir():
+                    signature = max(signature, entry.stat().st_mtime_ns)
+        return signature
+    except FileNotFoundError:
+        return 0
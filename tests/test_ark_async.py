@@ -0,0 +1,93 @@
+"""AsyncGenerator 对接本地 ARK 替身服务：并发生成 + 流式下载，结果文件完整、不残留 .part"""
+import os
+import concurrent.futures
+
+import pytest
+
+from ark_async import AsyncGenerator
+from stub_ark_server import StubConfig, start_stub_server
+
+KEYS = ["stub-key-0", "stub-key-1"]
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**kwargs):
+        config = StubConfig(image_size=64, **kwargs)
+        server, base_url = start_stub_server(config)
+        servers.append(server)
+        return config, base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def generators():
+    started = []
+
+    def start(base_url, **kwargs):
+        generator = AsyncGenerator(base_url, KEYS, "stub-model", key_max_concurrency=50, **kwargs).start()
+        started.append(generator)
+        return generator
+
+    yield start
+    for generator in started:
+        generator.close()
+
+
+def part_files(directory):
+    return [name for name in os.listdir(directory) if name.endswith(".part")]
+
+
+def test_concurrent_generations_all_resolve_with_complete_files(stub, generators, tmp_path):
+    config, base_url = stub(latency=0.05, jitter=0.02)
+    generator = generators(base_url)
+    futures = {
+        generator.submit("AAAA", "prompt", i, str(tmp_path / f"{i}.png"), key_index=i % len(KEYS)): i
+        for i in range(100)
+    }
+
+    done, not_done = concurrent.futures.wait(futures, timeout=60)
+    assert not not_done
+    for future in done:
+        path = str(tmp_path / f"{futures[future]}.png")
+        assert future.result() == path
+        with open(path, "rb") as f:
+            assert f.read() == config.image_bytes
+    assert part_files(tmp_path) == []
+    assert config.stats["generate"] == config.stats["download"] == 100
+
+
+def test_download_errors_leave_no_part_files(stub, generators, tmp_path):
+    config, base_url = stub(latency=0.01, download_error_rate=1.0)
+    generator = generators(base_url)
+    futures = [generator.submit("AAAA", "prompt", i, str(tmp_path / f"{i}.png"), key_index=i % len(KEYS))
+               for i in range(20)]
+
+    done, not_done = concurrent.futures.wait(futures, timeout=60)
+    assert not not_done
+    assert all(future.exception() is not None for future in done)
+    assert config.stats["truncated"] == 20
+    assert os.listdir(tmp_path) == []
+
+
+def test_partial_download_failures_keep_outputs_all_or_nothing(stub, generators, tmp_path):
+    config, base_url = stub(latency=0.01, download_error_rate=0.5)
+    generator = generators(base_url)
+    futures = {generator.submit("AAAA", "prompt", i, str(tmp_path / f"{i}.png"), key_index=i % len(KEYS)): i
+               for i in range(40)}
+
+    done, not_done = concurrent.futures.wait(futures, timeout=60)
+    assert not not_done
+    for future in done:
+        path = tmp_path / f"{futures[future]}.png"
+        if future.exception() is None:
+            assert path.read_bytes() == config.image_bytes
+        else:
+            assert not path.exists()
+    assert part_files(tmp_path) == []
@@ -0,0 +1,113 @@
+"""KeyPool 对接本地 ARK 替身服务（按 key 注入延迟 / 429 / 500）：冷却、换 key 重试、对冲、整体成功率"""
+import time
+import threading
+import concurrent.futures
+
+import pytest
+
+import ark_pool
+from ark_async import AsyncGenerator
+from stub_ark_server import StubConfig, start_stub_server
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(ark_pool, "BACKOFF_BASE", 0.01)
+
+
+@pytest.fixture
+def pool_env(tmp_path):
+    """启动替身服务 + AsyncGenerator（由 KeyPool 选 key），记录每个请求各次尝试所用的 key 与开始时间"""
+    started = []
+
+    def start(keys, hedge_after=None, **config):
+        config = StubConfig(image_size=64, **config)
+        server, base_url = start_stub_server(config)
+        generator = AsyncGenerator(base_url, keys, "stub-model", key_max_concurrency=50,
+                                   hedge_after=hedge_after).start()
+        started.append((server, generator))
+        attempts = {}
+        lock = threading.Lock()
+        generate = generator.generate
+
+        async def recording_generate(key_index, image_b64, prompt, seed, output_path):
+            with lock:
+                attempts.setdefault(seed, []).append((keys[key_index], time.monotonic()))
+            return await generate(key_index, image_b64, prompt, seed, output_path)
+
+        generator.generate = recording_generate
+
+        def submit_all(n):
+            submitted = {}
+            for i in range(n):
+                submitted[generator.submit("AAAA", "prompt", i, str(tmp_path / f"{i}.png"))] = (i, time.monotonic())
+            done, not_done = concurrent.futures.wait(submitted, timeout=60)
+            assert not not_done
+            return submitted
+
+        return generator, config, attempts, submit_all
+
+    yield start
+    for server, generator in started:
+        generator.close()
+        server.shutdown()
+        server.server_close()
+
+
+def stats_of(generator, key):
+    return generator.pool.snapshot()[generator.pool.keys.index(key)]
+
+
+def test_throttled_key_goes_into_cooldown(pool_env):
+    generator, config, attempts, submit_all = pool_env(
+        ["throttled-key", "healthy-key"], latency=0.05, key_throttle_rate={"throttled-key": 1.0})
+    submitted = submit_all(8)
+
+    assert all(future.exception() is None for future in submitted)
+    throttled = stats_of(generator, "throttled-key")
+    assert throttled["throttled"] >= 1
+    assert throttled["cooldown"] > 0
+    assert config.stats["throttled"] == throttled["throttled"]
+
+
+def test_failed_request_is_retried_on_a_different_key(pool_env):
+    generator, config, attempts, submit_all = pool_env(
+        ["flaky-key", "healthy-key"], latency=0.05, key_error_rate={"flaky-key": 1.0})
+    submitted = submit_all(8)
+
+    assert all(future.exception() is None for future in submitted)
+    retried = [keys for keys in attempts.values() if len(keys) > 1]
+    assert retried, "flaky-key 应至少被选中一次"
+    for tries in retried:
+        assert tries[0][0] == "flaky-key"
+        assert tries[1][0] == "healthy-key"
+    assert config.stats["errors"] == len(retried)
+
+
+def test_hedge_fires_after_hedge_after(pool_env):
+    hedge_after, slow = 0.3, 1.5
+    generator, config, attempts, submit_all = pool_env(
+        ["slow-key", "healthy-key"], hedge_after=hedge_after, latency=0.05, key_latency={"slow-key": slow})
+    submitted = submit_all(6)
+
+    finished = time.monotonic()
+    hedged = [tries for tries in attempts.values() if tries[0][0] == "slow-key"]
+    assert hedged, "slow-key 应至少被选中一次"
+    for tries in hedged:
+        assert len(tries) == 2 and tries[1][0] == "healthy-key"
+        assert tries[1][1] - tries[0][1] >= hedge_after * 0.9
+    assert sum(row["hedges"] for row in generator.pool.snapshot()) == len(hedged)
+    assert all(future.exception() is None for future in submitted)
+    # 对冲请求先完成，不用等慢 key
+    assert finished - min(start for _, start in submitted.values()) < slow
+
+
+def test_all_requests_succeed_while_one_key_is_healthy(pool_env):
+    generator, config, attempts, submit_all = pool_env(
+        ["slow-key", "throttled-key", "flaky-key", "healthy-key"], hedge_after=0.5, latency=0.05,
+        key_latency={"slow-key": 1.0}, key_throttle_rate={"throttled-key": 1.0}, key_error_rate={"flaky-key": 1.0})
+    submitted = submit_all(40)
+
+    failures = [repr(future.exception()) for future in submitted if future.exception() is not None]
+    assert failures == []
+    assert config.stats["throttled"] + config.stats["errors"] > 0
@@ -0,0 +1,161 @@
+import io
+import os
+import glob
+import hashlib
+import datetime
+import threading
+import concurrent.futures
+from PIL import Image, ImageOps
+import storage
+
+WIDTHS = (128, 256, 512, 1024)  # 允许的缩略图宽度，请求的 ?w= 向上取到最近的一档
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png")}
+DEFAULT_FORMAT = "webp"  # WebP 支持透明通道，线稿 PNG 也能转
+QUALITY = 80
+THUMB_DIR = ".thumbs"  # 与原图同目录的隐藏子目录，列表接口不会列出
+PREWARM_WIDTHS = (256,)  # worker 写出结果后预先生成的宽度（图库网格用）
+PREWARM_WORKERS = 2
+
+_locks = {}
+_locks_guard = threading.Lock()
+_prewarm_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PREWARM_WORKERS, thread_name_prefix="thumb")
+
+
+def snap_width(w):
+    """把请求的宽度取到允许的档位；非法值返回 None"""
+    try:
+        w = int(w)
+    except (TypeError, ValueError):
+        return None
+    if w <= 0:
+        return None
+    for allowed in WIDTHS:
+        if w <= allowed:
+            return allowed
+    return WIDTHS[-1]
+
+
+def _source_tag(st):
+    """原图版本标识：原图被替换（新 inode / 新 mtime）后旧缩略图自动失效"""
+    return hashlib.sha1(f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:10]
+
+
+def derivative_path(src, width, fmt, st=None):
+    st = st or os.stat(src)
+    directory, name = os.path.split(src)
+    return os.path.join(directory, THUMB_DIR, f"{name}.{width}.{_source_tag(st)}.{fmt}")
+
+
+def _lock_for(path):
+    with _locks_guard:
+        lock = _locks.get(path)
+        if lock is None:
+            lock = _locks[path] = threading.Lock()
+        return lock
+
+
+def _render(src, dst, width, fmt):
+    pil_format = FORMATS[fmt][0]
+    with Image.open(src) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (width, width))  # JPEG 按 1/2、1/4、1/8 直接缩小解码（两边都不小于 width）
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if pil_format == "JPEG" or not has_alpha:
+            img = img.convert("RGB")
+        else:
+            img = img.convert("RGBA")
+        if img.width > width:
+            height = max(1, round(img.height * width / img.width))
+            img = img.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = storage.temp_path_for(dst)
+        try:
+            if pil_format == "PNG":
+                img.save(tmp, pil_format, optimize=True)
+            else:
+                img.save(tmp, pil_format, quality=QUALITY)
+            storage.file_sha256(tmp)  # 写入时记下内容哈希（xattr），发送时直接用作 ETag
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # 清理同一原图同一规格的旧版本
+    for old in glob.glob(glob.escape(dst.rsplit(".", 2)[0]) + ".*." + fmt):
+        if old != dst:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def _get(open_src, dst, width, fmt):
+    if os.path.exists(dst):
+        return dst
+    with Image.open(open_src()) as img:
+        if img.width <= width and fmt == (img.format or "").lower():
+            return None
+    with _lock_for(dst):
+        if not os.path.exists(dst):
+            _render(open_src(), dst, width, fmt)
+    with _locks_guard:
+        _locks.pop(dst, None)
+    return dst
+
+
+def get_derivative(src, width, fmt=DEFAULT_FORMAT):
+    """
+    返回 src 缩放到 width 宽的衍生图路径（不存在则生成，生成一次后复用）。
+    原图本身不超过该宽度时返回 None，调用方直接发原图。原图不存在时抛 FileNotFoundError。
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unsupported format: {fmt}")
+    st = os.stat(src)
+    return _get(lambda: src, derivative_path(src, width, fmt, st), width, fmt)
+
+
+def get_blob_derivative(src, sha256, load, width, fmt=DEFAULT_FORMAT):
+    """
+    已归档原图（blob_pack）的缩略图：src 为原图归档前应在的位置（缩略图仍放在它的 .thumbs/ 下），
+    版本标识改用内容哈希；load() 返回原图内容（bytes），只在需要生成时调用一次。返回值同 get_derivative。
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unsupported format: {fmt}")
+    directory, name = os.path.split(src)
+    dst = os.path.join(directory, THUMB_DIR, f"{name}.{width}.{sha256[:10]}.{fmt}")
+    data = []
+
+    def open_src():
+        if not data:
+            data.append(load())
+        return io.BytesIO(data[0])
+
+    return _get(open_src, dst, width, fmt)
+
+
+def remove_derivatives(src):
+    """原图删除时一并删除它的所有缩略图"""
+    directory, name = os.path.split(src)
+    prefix = os.path.join(glob.escape(os.path.join(directory, THUMB_DIR)), glob.escape(name))
+    for width in WIDTHS:
+        for path in glob.glob(f"{prefix}.{width}.*.*"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _prewarm(src, widths, fmt):
+    try:
+        storage.file_sha256(src)  # 原图的内容哈希也预先记下（ETag 用）
+        for width in widths:
+            get_derivative(src, width, fmt)
+    except Exception as e:
+        print(f"[{datetime.datetime.now().isoformat()}] 缩略图预生成失败: {src}，错误: {e}")
+
+
+def prewarm(src, widths=PREWARM_WIDTHS, fmt=DEFAULT_FORMAT):
+    """后台线程预先生成缩略图，不阻塞调用方"""
+    return _prewarm_pool.submit(_prewarm, src, widths, fmt)
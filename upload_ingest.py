@@ -0,0 +1,222 @@
+import os
+import uuid
+import hashlib
+import threading
+import collections
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+import storage
+import metrics
+
+CHUNK_SIZE = 256 * 1024
+MAX_CONTENT_LENGTH = 256 * 1024 * 1024  # 单个请求体上限（app.config["MAX_CONTENT_LENGTH"]）
+MAX_FILE_BYTES = 50 * 1024 * 1024  # 单个文件上限
+MAX_FORM_MEMORY = 1024 * 1024  # 普通表单字段（metadata 等）总大小上限
+MAX_FORM_PARTS = 200
+USER_MAX_INFLIGHT_BYTES = 200 * 1024 * 1024  # 单个用户同时在传的总字节数上限
+MAX_CONCURRENT_INGESTS = 16  # 同时处理的上传请求数，超过直接 503，让客户端稍后重试
+RETRY_AFTER = 3  # 秒
+STAGING_DIR = ".staging"  # 表单字段在文件之后到达、暂时不知道目标目录时的落盘位置
+
+
+class IngestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class UserByteBudget:
+    """按用户统计正在上传的字节数，超过上限的请求尽早拒绝"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._inflight = collections.Counter()
+        self._lock = threading.Lock()
+
+    def charge(self, user, nbytes):
+        with self._lock:
+            if self._inflight[user] + nbytes > self.max_bytes:
+                return False
+            self._inflight[user] += nbytes
+            return True
+
+    def release(self, user, nbytes):
+        with self._lock:
+            self._inflight[user] -= nbytes
+            if self._inflight[user] <= 0:
+                del self._inflight[user]
+
+
+user_budget = UserByteBudget(USER_MAX_INFLIGHT_BYTES)
+_ingest_slots = threading.BoundedSemaphore(MAX_CONCURRENT_INGESTS)
+
+ingest_bytes = metrics.registry.counter("ingest_bytes", "已接收的上传文件字节数")
+ingest_files = metrics.registry.counter("ingest_files", "已接收的上传文件数")
+ingest_rejected = metrics.registry.counter("ingest_rejected", "被拒绝的上传请求数", ("status",))
+ingest_inflight = metrics.registry.gauge("ingest_inflight", "正在接收的上传请求数")
+
+
+class StagedFile:
+    """
+    已经边收边写到目标目录（同一文件系统）隐藏临时文件里的上传文件，
+    commit 时只做 rename，不再复制数据。sha256 在写入时同步计算。
+    """
+
+    def __init__(self, name, filename, directory):
+        self.name = name
+        self.filename = filename
+        self.path = os.path.join(directory, f".{uuid.uuid4().hex}.part")
+        self.size = 0
+        self.sha256 = None
+        self._hash = hashlib.sha256()
+        self._file = open(self.path, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        self._file.close()
+        self.sha256 = self._hash.hexdigest()
+        ingest_files.inc()
+        ingest_bytes.inc(self.size)
+
+    def commit(self, dest, extra_paths=()):
+        """把文件放到 dest，extra_paths 为硬链接；最后 rename，监控目录的 worker 只会看到完整文件"""
+        storage.fan_out(self.path, extra_paths)
+        storage.move(self.path, dest)
+        storage.record_sha256(dest, self.sha256)
+        self.path = None
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+
+class StreamingForm:
+    """
+    流式解析 multipart/form-data：
+      - 普通字段先到（客户端先写 user_id / metadata），第一个文件开始时调用 resolve_dir(fields) 决定目标目录，
+        文件按块直接写入该目录，不经过 Flask 默认的临时文件，也不整块读入内存
+      - 单文件超过 MAX_FILE_BYTES、单用户在传字节超过 USER_MAX_INFLIGHT_BYTES 时立即 413，不再读取剩余数据
+      - 同时处理的上传请求数受 MAX_CONCURRENT_INGESTS 限制，满了直接 503
+    用法：
+        with StreamingForm(request, resolve_dir, user_of) as form:
+            form.fields / form.files（StagedFile 列表，未 commit 的在退出时删除）
+    resolve_dir(fields) 返回目标目录，返回 None 时先写到 STAGING_DIR；user_of(fields) 返回用户标识。
+    """
+
+    def __init__(self, request, resolve_dir, user_of):
+        self.request = request
+        self.resolve_dir = resolve_dir
+        self.user_of = user_of
+        self.fields = MultiDict()
+        self.files = []
+        self._charged = collections.Counter()
+        self._slot = False
+
+    def __enter__(self):
+        if not _ingest_slots.acquire(blocking=False):
+            ingest_rejected.inc(status=503)
+            raise IngestError(503, "server busy, retry later")
+        self._slot = True
+        ingest_inflight.inc()
+        try:
+            self._parse()
+        except IngestError as e:
+            ingest_rejected.inc(status=e.status)
+            self.__exit__(None, None, None)
+            raise
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for f in self.files:
+            f.discard()
+        for user, nbytes in self._charged.items():
+            user_budget.release(user, nbytes)
+        self._charged.clear()
+        if self._slot:
+            _ingest_slots.release()
+            ingest_inflight.dec()
+            self._slot = False
+        return False
+
+    def _charge(self, user, nbytes):
+        if not user_budget.charge(user, nbytes):
+            raise IngestError(413, "too many bytes in flight for this user")
+        self._charged[user] += nbytes
+
+    @staticmethod
+    def _feed(decoder, data=b""):
+        """送入一块数据（data 为 b"" 时只取下一个事件）；请求体格式错误或被截断时 400"""
+        try:
+            if data != b"":
+                decoder.receive_data(data)
+            return decoder.next_event()
+        except ValueError:
+            raise IngestError(400, "malformed multipart body")
+
+    def _parse(self):
+        mimetype, options = parse_options_header(self.request.headers.get("Content-Type", ""))
+        boundary = options.get("boundary", "").encode("latin-1")
+        if mimetype != "multipart/form-data":
+            # 不带文件的普通表单照常解析
+            self.fields = self.request.form
+            return
+        if not boundary:
+            raise IngestError(400, "multipart boundary missing")
+
+        # request.stream 已按 MAX_CONTENT_LENGTH 截断；声明长度超限时 Flask 在读取前就返回 413
+        stream = self.request.stream
+        decoder = MultipartDecoder(boundary, max_form_memory_size=MAX_FORM_MEMORY, max_parts=MAX_FORM_PARTS)
+        part = None
+        field_chunks = []
+        field_bytes = 0
+        target_dir = None
+        user = None
+
+        while True:
+            data = stream.read(CHUNK_SIZE)
+            event = self._feed(decoder, data or None)
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    part = event
+                    field_chunks = []
+                elif isinstance(event, File):
+                    if target_dir is None:
+                        user = self.user_of(self.fields)
+                        target_dir = self.resolve_dir(self.fields) or STAGING_DIR
+                        os.makedirs(target_dir, exist_ok=True)
+                        # 声明的请求体本身就超过用户预算时，不读文件数据直接拒绝
+                        declared = self.request.content_length
+                        if declared is not None and declared > USER_MAX_INFLIGHT_BYTES:
+                            raise IngestError(413, "request body too large")
+                    part = StagedFile(event.name, event.filename, target_dir)
+                    self.files.append(part)
+                elif isinstance(event, Data):
+                    if isinstance(part, StagedFile):
+                        if part.size + len(event.data) > MAX_FILE_BYTES:
+                            raise IngestError(413, f"file too large: {part.filename}")
+                        self._charge(user, len(event.data))
+                        part.write(event.data)
+                        if not event.more_data:
+                            part.finish()
+                    else:
+                        field_bytes += len(event.data)
+                        if field_bytes > MAX_FORM_MEMORY:
+                            raise IngestError(413, "form fields too large")
+                        field_chunks.append(event.data)
+                        if not event.more_data:
+                            self.fields.add(part.name, b"".join(field_chunks).decode("utf-8", "replace"))
+                event = self._feed(decoder)
+            if isinstance(event, Epilogue) or not data:
+                break
@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import heapq
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import collections
+
+# inotify 常量（见 <sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+MAX_WAIT = 1.0  # 单次阻塞上限，保证其他线程 task_done 加入的延迟任务能及时被取出
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class UploadWatcher:
+    """
+    监听上传目录，只把新写完的文件放入队列，替代每次轮询时的全量 os.walk。
+      - Linux 下使用 inotify（IN_CLOSE_WRITE / IN_MOVED_TO），子目录（user_*）自动加入监听
+      - 其他平台或 inotify 不可用时回退为轮询，但只重新扫描 mtime 发生变化的目录
+    用法：
+        path = watcher.get(timeout)      # 取出一个待处理文件（标记为处理中）
+        watcher.task_done(path)          # 处理结束；retry_after 秒后重新入队
+    """
+
+    def __init__(self, root_dir, allowed_exts, poll_interval=3):
+        self.root_dir = root_dir
+        self.allowed_exts = {e.lower() for e in allowed_exts}
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._ready = collections.deque()
+        self._delayed = []  # (due, path) 小顶堆
+        self._queued = set()  # ready + delayed 中的文件，用于去重
+        self._active = set()  # 已取出、处理中的文件
+
+        self._libc = _load_libc()
+        self._fd = None
+        self._wd_to_dir = {}
+        self._dir_mtimes = {}  # 轮询模式：目录 -> (mtime_ns, 子目录列表)
+        self._next_poll = 0.0
+
+    @property
+    def mode(self):
+        return "inotify" if self._fd is not None else "polling"
+
+    # ---------- 生命周期 ----------
+    def start(self):
+        """建立监听并扫描一次已有文件（处理 worker 停机期间到达的上传）"""
+        os.makedirs(self.root_dir, exist_ok=True)
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+        if self._fd is not None:
+            self._watch_tree(self.root_dir)
+        else:
+            self._poll_changed_dirs()
+        return self
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    # ---------- 队列接口 ----------
+    def get(self, timeout=None):
+        """阻塞直到有待处理文件或超时；超时返回 None"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                self._promote_delayed(now)
+                if self._ready:
+                    path = self._ready.popleft()
+                    self._queued.discard(path)
+                    self._active.add(path)
+                    return path
+                next_due = self._delayed[0][0] if self._delayed else None
+
+            if deadline is not None and now >= deadline:
+                return None
+            wait = MAX_WAIT
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            if next_due is not None:
+                wait = min(wait, max(next_due - now, 0))
+            self._wait_for_events(wait)
+
+    def task_done(self, path, retry_after=None):
+        """标记处理结束；文件仍需处理时（如缺少 metadata）在 retry_after 秒后重新入队"""
+        with self._lock:
+            self._active.discard(path)
+            if retry_after is not None and path not in self._queued:
+                heapq.heappush(self._delayed, (time.monotonic() + retry_after, path))
+                self._queued.add(path)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._ready) + len(self._delayed)
+
+    def _promote_delayed(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            _, path = heapq.heappop(self._delayed)
+            self._ready.append(path)
+
+    def _enqueue(self, path):
+        name = os.path.basename(path)
+        if name.startswith("."):
+            return
+        if os.path.splitext(name)[1].lower() not in self.allowed_exts:
+            return
+        with self._lock:
+            if path in self._queued or path in self._active:
+                return
+            self._queued.add(path)
+            self._ready.append(path)
+
+    def _scan_dir(self, dirpath, recursive):
+        """把目录下已有的文件入队（按文件名排序，保持原先的处理顺序）"""
+        try:
+            entries = sorted(os.scandir(dirpath), key=lambda e: e.name)
+        except FileNotFoundError:
+            return []
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                self._enqueue(entry.path)
+        if recursive:
+            for sub in subdirs:
+                self._scan_dir(sub, recursive)
+        return subdirs
+
+    # ---------- inotify ----------
+    def _watch_tree(self, top):
+        for dirpath, dirnames, _ in os.walk(top):
+            self._add_watch(dirpath)
+        # 先加监听再扫描，避免两步之间写完的文件被漏掉（重复入队由 _queued 去重）
+        self._scan_dir(top, recursive=True)
+
+    def _add_watch(self, dirpath):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), WATCH_MASK)
+        if wd >= 0:
+            self._wd_to_dir[wd] = dirpath
+
+    def _wait_for_events(self, wait):
+        if self._fd is None:
+            self._wait_polling(wait)
+            return
+        readable, _, _ = select.select([self._fd], [], [], wait)
+        if not readable:
+            return
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # 事件队列溢出：全量重扫一次兜底
+            self._scan_dir(self.root_dir, recursive=True)
+            return
+        dirpath = self._wd_to_dir.get(wd)
+        if dirpath is None:
+            return
+        if mask & IN_IGNORED:
+            self._wd_to_dir.pop(wd, None)
+            return
+        if not name:
+            return
+        path = os.path.join(dirpath, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+            return
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._enqueue(path)
+
+    # ---------- 轮询回退 ----------
+    def _wait_polling(self, wait):
+        now = time.monotonic()
+        if now < self._next_poll:
+            time.sleep(min(wait, self._next_poll - now))
+            return
+        self._next_poll = now + self.poll_interval
+        self._poll_changed_dirs()
+
+    def _poll_changed_dirs(self):
+        """只重新列出 mtime 变化过的目录，未变化的 user_* 目录只需一次 stat"""
+        stack = [self.root_dir]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except FileNotFoundError:
+                self._dir_mtimes.pop(dirpath, None)
+                continue
+            known = self._dir_mtimes.get(dirpath)
+            if known is not None and known[0] == mtime:
+                stack.extend(known[1])
+                continue
+            subdirs = self._scan_dir(dirpath, recursive=False)
+            self._dir_mtimes[dirpath] = (mtime, subdirs)
+            stack.extend(subdirs)